@@ -0,0 +1,178 @@
+'''
+	Sync pipeline benchmark
+
+	Generates synthetic trees, points macrup at a local filesystem rclone remote
+	standing in for B2 and times backup, restore, ls and the state backends at
+	each scale. Results are printed as JSON.
+
+	Scenarios:
+		small  many 4KiB files in a shallow tree
+		large  a few 8MiB files
+		deep   small files nested 16 directories deep
+
+	Every scale multiplies the file count of each scenario and the number of watched directories.
+
+	$ python benchmarks/pipeline.py --scales 1,10 --watched 4 --workers 4
+	$ python benchmarks/pipeline.py --scales 1,10 --watched 4 --workers 4 --rcd
+'''
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (files at scale 1, bytes per file, nesting depth, files per directory)
+SCENARIOS = dict(
+		small = (1000, 4 * 1024, 2, 100),
+		large = (4, 8 * 1024 * 1024, 1, 4),
+		deep = (500, 4 * 1024, 16, 20))
+
+REMOTE = 'bench'
+
+def make_tree(root, files, size, depth, per_dir):
+	'''Write `files` files of `size` bytes under root, `per_dir` to a directory, `depth` levels down'''
+	written = 0
+	block = os.urandom(min(size, 1024 * 1024))
+	while written < files:
+		parts = ['d%03d'%((written // per_dir) % 1000)] + ['n%02d'%level for level in range(depth - 1)]
+		directory = os.path.join(root, *parts)
+		os.makedirs(directory, exist_ok = True)
+		for i in range(min(per_dir, files - written)):
+			with open(os.path.join(directory, 'f%06d.bin'%(written + i)), 'wb') as out:
+				remaining = size
+				while remaining > 0:
+					out.write(block[:remaining])
+					remaining -= len(block)
+		written += per_dir
+	return files
+
+def touch_some(root, fraction):
+	'''Rewrite a fraction of the files under root so the next backup has something to send'''
+	touched = 0
+	for dirpath, dirnames, filenames in os.walk(root):
+		for name in filenames[:max(1, int(len(filenames) * fraction))]:
+			with open(os.path.join(dirpath, name), 'ab') as out:
+				out.write(b'x')
+			touched += 1
+	return touched
+
+def make_home(base, paths, rclone, workers, rcd = False):
+	home = os.path.join(base, 'home')
+	os.makedirs(home, exist_ok = True)
+	with open(os.path.join(home, '.macrup.yaml'), 'w') as config_file:
+		config_file.write('remote: %s\nprefix: bench\nfrequency: 1s\nconnection_check: ""\n'%REMOTE)
+		config_file.write('workers: %d\nretries: 0\nrclone: %s\nrcd: %s\n'%(workers, rclone, 'true' if rcd else 'false'))
+		config_file.write('logging:\n  loglvl: error\nwatched:\n')
+		for path in paths:
+			config_file.write("  - !path '%s'\n"%path)
+	return home
+
+def macrup(home, remote_root, *args):
+	'''Run the CLI in a fresh interpreter, returns wall time in seconds'''
+	env = dict(os.environ, HOME = home, PYTHONPATH = REPO)
+	# A local rclone remote, bucket names become directories under remote_root
+	env['RCLONE_CONFIG_%s_TYPE'%REMOTE.upper()] = 'local'
+	code = 'import sys, macrup; sys.argv = ["macrup"] + sys.argv[1:]; macrup.entry()'
+	started = time.perf_counter()
+	proc = subprocess.run([sys.executable, '-c', code] + list(args), env = env, cwd = remote_root,
+							stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+	elapsed = time.perf_counter() - started
+	if proc.returncode != 0:
+		raise RuntimeError('macrup %s failed: %s'%(' '.join(args), proc.stderr.decode()[-2000:]))
+	return elapsed
+
+def bench_pipeline(scenario, scale, watched, workers, rclone, rcd = False):
+	files, size, depth, per_dir = SCENARIOS[scenario]
+	files *= scale
+	base = tempfile.mkdtemp(prefix = 'macrup-bench-')
+	try:
+		paths = []
+		for i in range(watched):
+			path = os.path.join(base, 'data', '%s%03d'%(scenario, i))
+			make_tree(path, files, size, depth, per_dir)
+			paths.append(path)
+		remote_root = os.path.join(base, 'remote')
+		os.makedirs(remote_root)
+		home = make_home(base, paths, rclone, workers, rcd)
+		timings = dict(
+				backup_initial = macrup(home, remote_root, 'backup'),
+				backup_unchanged = macrup(home, remote_root, 'backup'))
+		touched = sum(touch_some(path, 0.01) for path in paths)
+		timings['backup_incremental'] = macrup(home, remote_root, 'backup')
+		timings['ls'] = macrup(home, remote_root, 'ls')
+		restore_args = []
+		for i, path in enumerate(paths):
+			restore_args += ['-b', 'bench-%s'%os.path.basename(path), '-d', os.path.join(base, 'restored', str(i))]
+		timings['restore'] = macrup(home, remote_root, 'restore', *restore_args)
+		return dict(
+				scenario = scenario,
+				scale = scale,
+				watched = watched,
+				files = files * watched,
+				bytes = files * size * watched,
+				touched = touched,
+				seconds = timings)
+	finally:
+		shutil.rmtree(base, ignore_errors = True)
+
+def bench_state(records):
+	'''Load, save and single directory update of each state backend with `records` directories'''
+	from datetime import datetime
+	base = tempfile.mkdtemp(prefix = 'macrup-bench-')
+	os.environ['HOME'] = base
+	sys.path.insert(0, REPO)
+	from macrup.state import YAMLStore, SQLiteStore
+	try:
+		now = datetime.now()
+		rows = [dict(path = '/data/dir%06d'%i, bucket = 'bench-dir%06d'%i, synced = now,
+					full_synced = now, failures = 0) for i in range(records)]
+		results = {}
+		for name, store in (('yaml', YAMLStore(os.path.join(base, 'state.yaml'))),
+							('sqlite', SQLiteStore(os.path.join(base, 'state.db')))):
+			started = time.perf_counter()
+			store.save(rows)
+			saved = time.perf_counter()
+			store.load()
+			loaded = time.perf_counter()
+			store.update(rows[-1])
+			updated = time.perf_counter()
+			store.close()
+			results[name] = dict(save = saved - started, load = loaded - saved, update = updated - loaded)
+		return dict(records = records, seconds = results)
+	finally:
+		shutil.rmtree(base, ignore_errors = True)
+
+def main():
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--scales', default = '1,10', help = 'comma separated file count multipliers')
+	parser.add_argument('--scenarios', default = ','.join(SCENARIOS), help = 'comma separated, any of %s'%', '.join(SCENARIOS))
+	parser.add_argument('--watched', type = int, default = 2, help = 'watched directories per scenario')
+	parser.add_argument('--workers', type = int, default = 1)
+	parser.add_argument('--state-records', default = '100,1000,10000', help = 'comma separated directory counts for the state benchmark')
+	parser.add_argument('--rclone', default = shutil.which('rclone'), help = 'rclone binary to use')
+	parser.add_argument('--rcd', action = 'store_true', help = 'submit syncs to one rclone rcd per run instead of forking rclone')
+	args = parser.parse_args()
+	if not args.rclone:
+		parser.error('rclone was not found, pass --rclone')
+
+	scales = [int(s) for s in args.scales.split(',')]
+	results = dict(
+			benchmark = 'pipeline',
+			python = sys.version.split()[0],
+			rclone = subprocess.run([args.rclone, 'version'], stdout = subprocess.PIPE).stdout.decode().split('\n')[0],
+			workers = args.workers,
+			rcd = args.rcd,
+			pipeline = [bench_pipeline(scenario, scale, args.watched, args.workers, args.rclone, args.rcd)
+						for scenario in args.scenarios.split(',') for scale in scales],
+			state = [bench_state(int(n)) for n in args.state_records.split(',')])
+	json.dump(results, sys.stdout, indent = 2)
+	sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,88 @@
+'''
+	Startup benchmark
+
+	Measures how long `import macrup` and a cold `macrup ls` take in a fresh
+	interpreter, and which modules dominate the import. Results are printed as JSON.
+
+	$ python benchmarks/startup.py --runs 20 --watched 1000
+'''
+import argparse
+import json
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = 'import macrup'
+LS = 'import sys, macrup; sys.argv = ["macrup", "ls"]; macrup.entry()'
+
+def make_home(watched):
+	'''A throwaway $HOME with a config watching `watched` empty directories'''
+	home = tempfile.mkdtemp(prefix = 'macrup-bench-')
+	paths = []
+	for i in range(watched):
+		path = os.path.join(home, 'data', 'dir%05d'%i)
+		os.makedirs(path)
+		paths.append(path)
+	with open(os.path.join(home, '.macrup.yaml'), 'w') as config_file:
+		config_file.write('remote: bench\nprefix: bench\nlogging:\n  loglvl: error\nwatched:\n')
+		for path in paths:
+			config_file.write("  - !path '%s'\n"%path)
+	return home
+
+def run(code, home, *args):
+	env = dict(os.environ, HOME = home, PYTHONPATH = REPO)
+	started = time.perf_counter()
+	subprocess.run([sys.executable] + list(args) + ['-c', code], env = env, check = True,
+					stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+	return time.perf_counter() - started
+
+def timings(code, home, runs):
+	samples = [run(code, home) for _ in range(runs)]
+	return dict(
+			runs = runs,
+			min = min(samples),
+			median = statistics.median(samples),
+			mean = statistics.mean(samples),
+			max = max(samples))
+
+def import_profile(home, top = 10):
+	'''Cumulative import time in microseconds of the slowest modules'''
+	env = dict(os.environ, HOME = home, PYTHONPATH = REPO)
+	proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT], env = env,
+							check = True, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+	modules = []
+	for line in proc.stderr.decode().splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		self_us, cumulative, name = [f.strip() for f in line[len('import time:'):].split('|')]
+		modules.append(dict(module = name, self_us = int(self_us), cumulative_us = int(cumulative)))
+	return sorted(modules, key = lambda m: m['cumulative_us'], reverse = True)[:top]
+
+def main():
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--runs', type = int, default = 10)
+	parser.add_argument('--watched', type = int, default = 100, help = 'number of watched directories in the config')
+	args = parser.parse_args()
+
+	home = make_home(args.watched)
+	# The first ls creates the state database, keep it out of the numbers
+	run(LS, home)
+	results = dict(
+			benchmark = 'startup',
+			python = sys.version.split()[0],
+			watched = args.watched,
+			interpreter = timings('pass', home, args.runs),
+			import_macrup = timings(IMPORT, home, args.runs),
+			ls = timings(LS, home, args.runs),
+			slowest_imports = import_profile(home))
+	json.dump(results, sys.stdout, indent = 2)
+	sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main()
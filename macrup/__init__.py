@@ -1,10 +1,10 @@
-# Setup logging
-from .log import Log
+from .log import Log, setupLogging
 _log = Log('root')
 
 from .cli import macrup
 
 
 def entry():
+    setupLogging()
     _log.debug('Starting CLI')
     macrup()
\ No newline at end of file
@@ -1,17 +1,30 @@
-from .error import RequiredArguementError
+import time
+from .error import ConfigError, RequiredArguementError
 from .rclone import RClone
-from .conf import config, loadYAML
-from itertools import chain
+from .rcd import JOB_FAILED
+from .conf import config
+from .log import Log
+from .manifest import Manifest
+from . import engine
+from . import excludes
+from . import hashcache
+from . import metrics
+from . import retry
+from .snapshot import EXCLUDES as SNAPSHOT_EXCLUDES, Retention, Snapshots
+from .state import open_store
+from .stats import SyncResult
+from . import tuning
 from datetime import datetime
 from .util import convert_delta
-import yaml
 import getpass
 from hashlib import blake2b
 from pathlib import PosixPath
 from os.path import expanduser
 
+_log = Log('backup')
+
 class Directory(RClone):
-	def __init__(self, path = None, ts = None, exclude = [], prefix = None, remote = None, dry_run = False, bucket = None):
+	def __init__(self, path = None, ts = None, exclude = [], prefix = None, remote = None, dry_run = False, bucket = None, full_ts = None, failures = 0, track = True, store = None, options = {}):
 		if not path:
 			raise RequiredArguementError('You must provide a directory path!')
 		if not remote:
@@ -19,9 +32,17 @@ class Directory(RClone):
 		
 		self._path = path
 		self._last_sync = ts
+		self._last_full_sync = full_ts
 		self._exclude = exclude
 		self._prefix = prefix
 		self._bucket = bucket
+		self._manifest = None
+		self._result = None
+		self._failures = failures
+		self._track = track
+		self._store = store
+		self._options = options
+		self._engine = None
 		super().__init__(remote, dry_run)
 		
 	def __repr__(self):
@@ -32,23 +53,272 @@ class Directory(RClone):
 			return '%s-%s'%(self._prefix, self._path.name)
 		return self._bucket
 
+	@property
+	def options(self):
+		'''Settings from this directory's entry in `watched`'''
+		return self._options
+
+	@options.setter
+	def options(self, options):
+		self._options = options
+		self._engine = None
+
+	@property
+	def excludes(self):
+		'''The run's exclude rules merged with those of this directory's entry in `watched`, compiled'''
+		own = self._options.get('exclude', [])
+		return excludes.compile_rules(list(self._exclude) + ([own] if isinstance(own, str) else list(own)))
+
+	@property
+	def mode(self):
+		'''How the directory is stored, sync mirrors it with rclone sync, anything else names an Engine'''
+		return self._options.get('mode', 'sync')
+
+	@property
+	def snapshotted(self):
+		'''Whether pushes keep dated snapshots in the bucket, only sync mode directories can'''
+		return self.mode == 'sync' and bool(self._options.get('snapshots', config.snapshots))
+
+	@property
+	def retention(self):
+		'''The snapshot Retention policy, `keep_*` from the watched entry or the config'''
+		return Retention(**{period: self._options.get('keep_%s'%period, getattr(config, 'keep_%s'%period))
+									for period in ('hourly', 'daily', 'weekly')})
+
+	@property
+	def engine(self):
+		'''The Engine storing this directory, None when it is mirrored with rclone sync'''
+		if self.mode == 'sync':
+			return None
+		if self._engine is None:
+			self._engine = engine.load(self.mode)(self, self._options)
+		return self._engine
+
 	@property
 	def synced(self):
 		if self._last_sync is not None:
 			return self._last_sync
 		return datetime(month=1, day=1, year=1)
 
-	def push(self):
-		if self._push(self.name, self.bucket, excludes = self._exclude):
-			self._last_sync = datetime.now()
+	@property
+	def result(self):
+		'''SyncResult of the most recent push or pull, None if neither has run'''
+		return self._result
+
+	@property
+	def state(self):
+		'''The record persisted for this directory'''
+		return dict(
+				path = self.path,
+				bucket = self.bucket,
+				synced = self.synced,
+				full_synced = self.full_synced,
+				failures = self.failures)
+
+	@property
+	def history(self):
+		'''Results of this directory's recent backups, newest first'''
+		if self._store is None:
+			return []
+		return self._store.directory_history(self.name)
+
+	@property
+	def transfer_settings(self):
+		'''rclone transfer settings picked from the manifest, run history and `tuning` config'''
+		overrides = tuning.overrides_for(config.tuning, self.name, self.bucket)
+		settings = tuning.choose(tuning.profile(self.manifest, self.history), overrides)
+		_log.debug('Tuning for %s: %s'%(self.name, settings))
+		return settings
+
+	@property
+	def failures(self):
+		'''Number of syncs that have failed since the last success'''
+		return self._failures
+
+	def _record(self, result, started):
+		result.duration = time.monotonic() - started
+		self._failures = 0 if result else self._failures + 1
+		self._result = result
+		return result
+
+	@property
+	def full_synced(self):
+		if self._last_full_sync is not None:
+			return self._last_full_sync
+		return datetime(month=1, day=1, year=1)
+
+	@property
+	def full_sync_due(self):
+		'''True if the next push must sync the whole tree rather than a list of changed files'''
+		if self.manifest is None or not self.manifest.exists:
 			return True
-		return False
-			
-	def pull(self):
-		if self._pull(self.name, self.bucket, excludes = self._exclude):
+		if not config.full_sync:
+			return False
+		return datetime.now() - self.full_synced > convert_delta(config.full_sync)
+
+	@property
+	def manifest(self):
+		# Untracked directories, like a restore to somewhere else, must not touch the bucket's manifest
+		# Engines and snapshots always need one
+		if not (config.manifest or self.mode != 'sync' or self.snapshotted) or not self._track:
+			return None
+		if self._manifest is None:
+			path = '%s.manifests/%s.json'%(expanduser(config.state_path), self.bucket)
+			self._manifest = Manifest(path, self.name, excludes = self.excludes, hash_content = config.manifest_hash,
+										cache = hashcache.shared())
+		return self._manifest
+
+	@property
+	def changes(self):
+		'''Files changed since the last successful push, None if no manifest is kept'''
+		if self.manifest is None:
+			return None
+		return self.manifest.diff()
+
+	def push(self, full = False, policy = None):
+		import asyncio
+		return asyncio.run(self.push_async(full, policy))
+
+	def pull(self, policy = None, files = None, snapshot = None):
+		import asyncio
+		return asyncio.run(self.pull_async(policy, files, snapshot))
+
+	async def push_async(self, full = False, policy = None):
+		'''
+			Push the directory, only sending what changed unless `full` or a full sync is due
+			Failed syncs are retried following `policy`, the configured RetryPolicy by default
+		'''
+		import asyncio
+		started = time.monotonic()
+		loop = asyncio.get_running_loop()
+		full = full or self.full_sync_due
+		baseline = self.manifest is not None and self.manifest.exists
+		# Walking the tree is blocking, keep it off the event loop
+		changes = await loop.run_in_executor(None, lambda: self.changes)
+		files = None
+		if changes is not None:
+			if not full and not changes:
+				_log.info('%s is unchanged since last sync, skipping'%self.name)
+				self._last_sync = datetime.now()
+				# Files that were only touched keep their hashes, remember their new mtimes
+				# so they aren't hashed again on every run
+				if not self._dry_run and self.manifest.current != self.manifest.entries:
+					await loop.run_in_executor(None, self.manifest.commit)
+				return self._record(SyncResult(True, skipped = True), started)
+			_log.info('%s is dirty: %s added, %s modified, %s deleted'%(self.name,
+						len(changes.added), len(changes.modified), len(changes.deleted)))
+			if not full:
+				files = changes.added + changes.modified + changes.deleted
+		flags = await loop.run_in_executor(None, lambda: tuning.flags(self.transfer_settings))
+		checksum = self.checksum_needed(baseline, full)
+		policy = policy if policy is not None else retry.from_config(config)
+		# Nothing is committed until a sync succeeds, so each attempt sends the same changes
+		# and rclone skips whatever made it across last time
+		if self.engine is not None:
+			sync = lambda: self.engine.push_async(changes, full = full, tuning = flags)
+		elif self.snapshotted:
+			sync = lambda: self._push_snapshot_async(files, flags, checksum)
+		else:
+			sync = lambda: self._push_async(self.name, self.bucket, excludes = self.excludes, files = files, tuning = flags, checksum = checksum)
+		result = self._record(await policy.run(self.name, sync), started)
+		if result:
 			self._last_sync = datetime.now()
-			return True
-		return False
+			if full:
+				self._last_full_sync = datetime.now()
+			if changes is not None and not self._dry_run:
+				await loop.run_in_executor(None, self.manifest.commit)
+		return result
+
+	def checksum_needed(self, baseline, full = False):
+		'''
+			Whether a push must have rclone hash every file it compares
+
+			With `checksum` auto it doesn't once a committed manifest, `baseline`, already says which files
+			changed: they go by size and mtime, and everything else was uploaded with the mtime it still has.
+			A `full` sync always does, it is the safety net for changes the manifest missed
+		'''
+		if config.checksum not in ('auto', 'always', 'never'):
+			raise ConfigError('Unknown checksum mode %s, expected auto, always or never'%config.checksum)
+		if config.checksum != 'auto':
+			return config.checksum == 'always'
+		return full or not baseline
+
+	async def _push_snapshot_async(self, files, flags, checksum = True):
+		'''Push, moving whatever is replaced into the newest snapshot, then record this push as a new one'''
+		snapshots = Snapshots(self)
+		backup_dir = await snapshots.backup_flags()
+		if backup_dir is None:
+			_log.error('Unable to list the snapshots of %s, not pushing without them'%self.name)
+			return SyncResult(False, rc = JOB_FAILED)
+		when = datetime.now()
+		result = await self._push_async(self.name, self.bucket, excludes = self.excludes.merge(SNAPSHOT_EXCLUDES),
+						files = files, tuning = flags, extra = backup_dir, checksum = checksum)
+		if not result:
+			return result
+		return engine.merge(self.name, [result, await snapshots.record(when, self.manifest.current)])
+
+	async def pull_async(self, policy = None, files = None, snapshot = None):
+		'''
+			Restore the directory from its bucket, or only `files`, paths relative to the directory
+			`snapshot` restores the directory as it was at that snapshot, see macrup.snapshot
+			Failed restores are retried following `policy`, the configured RetryPolicy by default
+		'''
+		import asyncio
+		started = time.monotonic()
+		loop = asyncio.get_running_loop()
+		flags = await loop.run_in_executor(None, lambda: tuning.flags(self.transfer_settings))
+		policy = policy if policy is not None else retry.from_config(config)
+		if snapshot is not None:
+			if self.mode != 'sync':
+				_log.error('%s is stored in %s mode, which does not keep snapshots'%(self.name, self.mode))
+				return self._record(SyncResult(False), started)
+			sync = lambda: Snapshots(self).restore(snapshot, tuning = flags, files = files)
+		elif self.engine is not None:
+			sync = lambda: self.engine.pull_async(tuning = flags, files = files)
+		elif files is not None:
+			# copy, a sync limited to a few files would still delete any others the list names
+			sync = lambda: self._sync_async('%s:%s'%(self._remote, self.bucket), self.name, files = files, tuning = flags, command = 'copy')
+		else:
+			# A bucket may hold snapshots even if this copy of the config doesn't ask for them
+			sync = lambda: self._pull_async(self.name, self.bucket, excludes = self.excludes.merge(SNAPSHOT_EXCLUDES), tuning = flags)
+		result = self._record(await policy.run(self.name, sync), started)
+		if result:
+			self._last_sync = datetime.now()
+			# After restoring a few files the rest of the tree may still hold changes to push
+			if self.manifest is not None and not self._dry_run and files is None:
+				await loop.run_in_executor(None, self.manifest.scan)
+				await loop.run_in_executor(None, self.manifest.commit)
+		return result
+
+	async def prune_async(self, labels = None, keep = {}):
+		'''
+			Delete the snapshots labelled in `labels`, or those the retention policy doesn't keep
+			`keep` overrides the policy's counts, eg. dict(daily = 3)
+		'''
+		snapshots = Snapshots(self)
+		if labels:
+			return await snapshots.delete(labels)
+		retention = self.retention
+		retention.counts.update({period: count for period, count in keep.items() if count is not None})
+		return await snapshots.prune(retention)
+
+	async def snapshot_labels_async(self):
+		return await Snapshots(self).labels()
+
+	def scan(self, workers = None):
+		'''Walk the directory as a push would see it, returns its ScanTotals'''
+		from .scanner import scan
+		return scan(self.name, self.excludes, workers)
+
+	async def plan_async(self, full = False):
+		'''Estimate what a push would send without running it, see macrup.plan'''
+		import asyncio
+		from .plan import estimate
+		return await asyncio.get_running_loop().run_in_executor(None, lambda: estimate(self, full))
+
+	async def remote_size_async(self):
+		'''dict(count, bytes) of what is stored in the bucket'''
+		return await self._size_async(self.bucket)
 
 	@property
 	def name(self):
@@ -69,62 +339,84 @@ class Backup:
 		self._statefile = expanduser(config.state_path)
 		
 		
-	def __call__(self, ctx, remote, watched = [], exclude = [], prefix = None, notify = False, dry_run = False, freq = None):
+	def __call__(self, ctx, remote, watched = [], exclude = [], exclude_from = [], prefix = None, notify = False, dry_run = False, freq = None):
+		self._store = open_store(config.state_backend, self._statefile, expanduser(config.state_db), config.state_runs)
 		self._remote = remote if remote else config.remote
-		self._exclude = config.exclude
+		# Rules for every directory, per directory ones come from its entry in `watched`
+		self._exclude = list(config.exclude) + list(exclude or [])
+		for path in list(config.exclude_from) + list(exclude_from or []):
+			self._exclude += excludes.load(path)
+		# A bad rule fails here rather than halfway through a run
+		excludes.compile_rules(self._exclude)
 		prefix = prefix if prefix else config.prefix
 		if prefix is None:
 			prefix = blake2b(self._user.encode('utf-8')).hexdigest()[:10]
 		self._prefix = prefix
 		self._dry_run = dry_run
 		self._notify = notify if notify else getattr(config, 'pushbullet', None) is not None
-		self._watched = self._build_watched(watched, exclude) 
+		self._watched = self._build_watched(watched)
 		freq = config.frequency if not freq else freq
 		self._freq = convert_delta(freq)
 
+		self._command = ctx.invoked_subcommand
+		self._started = time.monotonic()
+		self._started_at = datetime.now()
+
 		ctx.obj = self
 		return self._func(ctx)
 
 	def _load_state(self):
-		saved = loadYAML(self._statefile)
-		if saved is None:
-			return []
 		loaded = []
-		for directory in saved:
-			loaded.append(Directory(path = directory['path'], ts = directory['synced'], bucket = directory['bucket'], remote = self._remote))
+		self._loaded = loaded
+		for directory in self._store.load():
+			loaded.append(Directory(path = directory['path'], ts = directory['synced'], bucket = directory['bucket'],
+							full_ts = directory.get('full_synced'), failures = directory.get('failures', 0),
+							exclude = self._exclude, prefix = self._prefix, remote = self._remote, dry_run = self._dry_run, store = self._store))
 		return loaded
 		
 
 	def _save_state(self):
-		with open(self._statefile, 'w') as state_file:
-			yaml.dump([dict(
-				path = d.path,
-				bucket = d.bucket, 
-				synced = d.synced) for d in self.watched],
-				state_file,
-				default_flow_style=False)
+		# Only write what this run knows better than the store,
+		# anything else may have been updated by another macrup since we loaded it
+		self._store.update_many([d.state for d in self.watched if d.result is not None or d not in self._loaded])
+
+	def checkpoint(self, directory):
+		'''Persist a single directory as soon as its sync finishes'''
+		if self._dry_run:
+			return
+		_log.debug('Checkpointing %s'%directory.name)
+		self._store.update(directory.state)
 
 	def _load_watched(self):
 		in_conf = getattr(config, 'watched', [])
-		configured = []
+		configured = {}
+		# Entries are a path, or a mapping of a path and its options eg. {path: ~/vms, mode: dedup}
 		for p in in_conf:
+			options = {}
+			if isinstance(p, dict):
+				options = {k: v for k, v in p.items() if k != 'path'}
+				p = PosixPath(expanduser(str(p['path'])))
 			if p.is_absolute():
-				configured.append(p)
+				configured[p] = options
 			else:
-				configured.append(p.home().joinpath(p))
+				configured[p.home().joinpath(p)] = options
+		by_name = {entry.resolve().as_posix(): options for entry, options in configured.items()}
 		watched = {d.name:d for d in self._load_state()}
-		for entry in configured:
+		for directory in watched.values():
+			directory.options = by_name.get(directory.name, {})
+		for entry, options in configured.items():
 			if not entry.resolve().as_posix() in watched:
-				watched[entry] = Directory(path = entry, prefix=self._prefix, remote=self._remote, dry_run=self._dry_run)
+				watched[entry.resolve().as_posix()] = Directory(path = entry, exclude = self._exclude, prefix=self._prefix, remote=self._remote, dry_run=self._dry_run, store=self._store, options=options)
 		return watched
 
-	def _build_watched(self, extra, exclude):
-		extra = {PosixPath(d).resolve().as_posix(): exclude for d in extra}
-		common = dict(prefix = self._prefix, remote = self._remote, dry_run = self._dry_run)
+	def _build_watched(self, extra):
+		common = dict(exclude = self._exclude, prefix = self._prefix, remote = self._remote, dry_run = self._dry_run, store = self._store)
+		# Keyed by resolved path, the same as _load_watched
 		watched = self._load_watched()
-		for path, exclude in extra.items():
-			if not path in watched:
-				watched[path] = Directory(path = path, exclude = exclude, **common)
+		for d in extra or []:
+			path = PosixPath(expanduser(d)).resolve()
+			if not path.as_posix() in watched:
+				watched[path.as_posix()] = Directory(path = path, **common)
 		return list(watched.values())
 
 	@property
@@ -139,12 +431,70 @@ class Backup:
 			if  now - directory.synced > self._freq:
 				yield directory
 
+	def due_at(self, directory):
+		'''When `directory` falls outdated'''
+		return directory.synced + self._freq
+
 	@property
 	def notify(self):
 		return self._notify
 
+	def restore_targets(self, mapping = {}, buckets = None):
+		'''
+			Directories to pull during a restore
+
+			Watched directories are restored to their own path unless `mapping` (bucket -> destination),
+			or the `restore_dest` config, names somewhere else. Buckets only found in the mapping
+			are restored too. If `buckets` is given only those are returned.
+			Relative destinations are taken from the current directory.
+		'''
+		dests = {entry['bucket']: entry['dest'] for entry in config.restore_dest}
+		dests.update(mapping)
+		common = dict(prefix = self._prefix, remote = self._remote, dry_run = self._dry_run, track = False)
+		targets = []
+		for directory in self.watched:
+			if directory.bucket in dests:
+				dest = PosixPath(dests.pop(directory.bucket)).expanduser().resolve()
+				directory = Directory(path = dest, bucket = directory.bucket, exclude = directory._exclude, options = directory.options, **common)
+			targets.append(directory)
+		for bucket, dest in dests.items():
+			targets.append(Directory(path = PosixPath(dest).expanduser().resolve(), bucket = bucket, exclude = self._exclude, **common))
+		if buckets:
+			targets = [d for d in targets if d.bucket in buckets]
+		return targets
+
 	def save(self):
+		'''Persist the run's directories and record it, a dry run leaves the store as it was'''
+		if self._dry_run:
+			return
 		self._save_state()
+		self.record_run()
+
+	def record_run(self, directories = None, command = None, started = None):
+		'''
+			Add this run to the state history and export its metrics
+			The daemon records each of its jobs as a run of `command` that began at `started`
+		'''
+		if self._dry_run:
+			return
+		directories = list(self.watched) if directories is None else list(directories)
+		hashcache.save()
+		finished = datetime.now()
+		self._store.record_run(command if command else self._command, started if started else self._started_at, finished,
+								[(d.state, d.result) for d in directories])
+		self.write_metrics(directories, command, (finished - started).total_seconds() if started else None)
+
+	@property
+	def history(self):
+		return self._store.history()
+
+	def write_metrics(self, directories = None, command = None, duration = None):
+		'''Write a Prometheus textfile describing this run, if enabled'''
+		if not config.metrics_path:
+			return
+		metrics.write(expanduser(config.metrics_path), command if command else self._command,
+						duration if duration is not None else time.monotonic() - self._started,
+						self.watched if directories is None else directories)
 
 
 
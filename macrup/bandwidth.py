@@ -0,0 +1,208 @@
+import base64
+import contextvars
+import json
+import re
+import secrets
+from datetime import datetime
+
+from .error import ConfigError
+from .log import Log
+
+_log = Log('bandwidth')
+
+# The budget for the run the current task belongs to, set by the Scheduler
+# asyncio copies the context into every task it starts, so each sync sees it
+active = contextvars.ContextVar('bandwidth_budget', default = None)
+
+_UNITS = dict(b = 1 / 1024, k = 1, m = 1024, g = 1024 * 1024, t = 1024 * 1024 * 1024)
+_RATE = re.compile(r'^\s*([\d.]+)\s*([bkmgt]?)\s*$', re.IGNORECASE)
+_SERVING = re.compile(r'Serving remote control on https?://[^/\s]*:(\d+)')
+
+def parse_rate(rate):
+	'''
+		Parse an rclone style bandwidth, eg. 512k, 10M or off, into bytes/s
+		A bare number is KiB/s as it is for rclone, off and None are unlimited
+	'''
+	if rate is None or str(rate).strip().lower() in ('off', ''):
+		return None
+	match = _RATE.match(str(rate))
+	if not match:
+		raise ConfigError('Unable to parse bandwidth %s'%rate)
+	value, unit = match.groups()
+	return int(float(value) * _UNITS[unit.lower() or 'k'] * 1024)
+
+def format_rate(rate):
+	'''bytes/s back into something rclone understands'''
+	if rate is None:
+		return 'off'
+	return '%dk'%max(1, rate // 1024)
+
+def parse_schedule(schedule):
+	'''
+		Parse an rclone style timetable, eg. "08:00,512k 19:00,10M 23:00,off"
+		into a sorted list of ((hour, minute), bytes/s)
+	'''
+	slots = []
+	for entry in (schedule or '').split():
+		when, _, rate = entry.partition(',')
+		try:
+			hour, minute = [int(p) for p in when.split(':')]
+		except ValueError:
+			raise ConfigError('Unable to parse bandwidth schedule entry %s'%entry)
+		slots.append(((hour, minute), parse_rate(rate)))
+	return sorted(slots)
+
+def serving_port(line):
+	'''The port in rclone's "Serving remote control on" log line, None for any other line'''
+	match = _SERVING.search(line)
+	return int(match.group(1)) if match else None
+
+def rc_auth(user, password):
+	'''The environment handing rclone its remote control login, where other users can't read it from ps'''
+	return dict(RCLONE_RC_USER = user, RCLONE_RC_PASS = password)
+
+def basic_auth(user, password):
+	return 'Basic %s'%base64.b64encode(('%s:%s'%(user, password)).encode('utf-8')).decode('ascii')
+
+class Transfer:
+	'''
+		An rclone child taking part in a budget, reachable on its remote control port
+
+		rclone picks a free port itself and logs it, `observe` is fed its output to learn it.
+		Its login is random, or `password` if it already has one, and only travels in its environment.
+	'''
+	def __init__(self, name, password = None):
+		self.name = name
+		self.port = None
+		self.rate = None
+		self._user = 'macrup'
+		self._password = password if password else secrets.token_hex(16)
+
+	def __repr__(self):
+		return 'Transfer(name=%s, port=%s, rate=%s)'%(self.name, self.port, format_rate(self.rate))
+
+	@property
+	def flags(self):
+		return "--rc --rc-addr 127.0.0.1:0 --bwlimit '%s'"%format_rate(self.rate)
+
+	@property
+	def env(self):
+		'''Environment to start the rclone child with'''
+		import os
+		return dict(os.environ, **rc_auth(self._user, self._password))
+
+	def observe(self, line):
+		'''Learn the port from a line of rclone's output, True if this line gave it'''
+		port = serving_port(line)
+		if port is None or self.port is not None:
+			return False
+		self.port = port
+		return True
+
+	def set_rate(self, rate):
+		'''Ask the running rclone to change its limit, blocking'''
+		import urllib.request
+		if self.port is None:
+			_log.debug('%s is not listening yet, leaving its bandwidth'%self.name)
+			return False
+		req = urllib.request.Request('http://127.0.0.1:%s/core/bwlimit'%self.port,
+									data = json.dumps(dict(rate = format_rate(rate))).encode('utf-8'),
+									headers = {'Content-Type': 'application/json', 'Authorization': basic_auth(self._user, self._password)})
+		try:
+			urllib.request.urlopen(req, timeout = 5).close()
+		except Exception as e:
+			# It may not be listening yet, it started with a limit of its own anyway
+			_log.debug('Unable to set bandwidth of %s: %s'%(self.name, e))
+			return False
+		self.rate = rate
+		return True
+
+class BandwidthBudget:
+	'''
+		A run wide bandwidth limit shared between every active transfer
+
+		Each transfer gets an equal share. When one starts or finishes,
+		or the schedule moves to a new slot, every running rclone
+		is told its new share over its remote control API.
+		One that wasn't listening yet is told as soon as it logs its port.
+	'''
+	RECHECK = 60
+
+	def __init__(self, limit = None, schedule = None):
+		self._limit = parse_rate(limit)
+		self._schedule = parse_schedule(schedule)
+		self._transfers = []
+		self._watcher = None
+		self._catching_up = set()
+
+	def __repr__(self):
+		return 'BandwidthBudget(limit=%s, active=%s)'%(format_rate(self.limit), len(self._transfers))
+
+	@property
+	def enabled(self):
+		return self._limit is not None or bool(self._schedule)
+
+	@property
+	def limit(self):
+		'''The limit in force right now, None when unlimited'''
+		if not self._schedule:
+			return self._limit
+		now = datetime.now()
+		current = self._schedule[-1][1]
+		for (hour, minute), rate in self._schedule:
+			if (now.hour, now.minute) >= (hour, minute):
+				current = rate
+		if current is not None and self._limit is not None:
+			return min(current, self._limit)
+		return current if current is not None else self._limit
+
+	def share(self, count = None):
+		limit = self.limit
+		count = count if count is not None else len(self._transfers)
+		if limit is None:
+			return None
+		return limit // max(1, count)
+
+	def join(self, name, password = None):
+		'''Reserve a share for a transfer about to start, returns a Transfer whose flags go on the command line'''
+		import asyncio
+		transfer = Transfer(name, password)
+		transfer.rate = self.share(len(self._transfers) + 1)
+		self._transfers.append(transfer)
+		if self._schedule and self._watcher is None:
+			self._watcher = asyncio.ensure_future(self._watch_schedule())
+		return transfer
+
+	def observe(self, transfer, line):
+		'''Feed a line of a transfer's output, it gets its current share once it says where it listens'''
+		import asyncio
+		if not transfer.observe(line) or transfer not in self._transfers or transfer.rate == self.share():
+			return
+		# Called from the process' reader, which mustn't wait on the HTTP call
+		task = asyncio.ensure_future(self.rebalance())
+		self._catching_up.add(task)
+		task.add_done_callback(self._catching_up.discard)
+
+	async def leave(self, transfer):
+		self._transfers.remove(transfer)
+		if not self._transfers and self._watcher is not None:
+			self._watcher.cancel()
+			self._watcher = None
+		await self.rebalance()
+
+	async def rebalance(self):
+		'''Give every running transfer its current share'''
+		import asyncio
+		rate = self.share()
+		loop = asyncio.get_running_loop()
+		pending = [t for t in self._transfers if t.rate != rate]
+		if not pending:
+			return
+		_log.info('Rebalancing %s transfers to %s/s each'%(len(self._transfers), format_rate(rate)))
+		await asyncio.gather(*[loop.run_in_executor(None, t.set_rate, rate) for t in pending])
+
+	async def _watch_schedule(self):
+		import asyncio
+		while True:
+			await asyncio.sleep(self.RECHECK)
+			await self.rebalance()
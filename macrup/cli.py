@@ -1,25 +1,50 @@
 import click
 # from .user import Backup
 from .backup import Backup
+from .error import ConfigError
+from functools import lru_cache
 import macrup.notify as notify
-import yaml
-import urllib.request
+import socket
 from .log import Log
 from .conf import config
-from .util import RequiredIf
+from .util import RequiredIf, convert_delta
+import time
 _log = Log('cli')
 
+@lru_cache(maxsize = None)
+def _connectionTarget(value):
+	'''(host, port) from a `connection_check` of host:port'''
+	host, _, port = value.rpartition(':')
+	if not host or not port.isdigit():
+		raise ConfigError('Unable to parse connection_check %s, expected host:port'%value)
+	return host, int(port)
+
 def checkConnection():
+	'''Cheap reachability check, a TCP connect to `connection_check` rather than a full HTTPS request'''
+	if not config.connection_check:
+		return True
+	target = _connectionTarget(config.connection_check)
 	try:
-		urllib.request.urlopen('https://google.com')
-	except Exception as e:
+		socket.create_connection(target, timeout = 10).close()
+	except OSError as e:
+		_log.debug('Connection check to %s failed: %s'%(config.connection_check, e))
 		return False
 	return True
 
+def pushNote(backup, body):
+	'''Send a Pushbullet note if notifications are enabled'''
+	if not backup.notify:
+		return
+	if config.pushbullet is None:
+		click.echo('You must supply a Pushbullet API key to enable push notifications!')
+		exit(1)
+	notify.push(config.pushbullet, 'note', title = 'Macrup', body = body)
+
 @click.group()
 @click.option('--remote', '-r', type = str, default = None)
 @click.option('--watched', '-w', type = str, default = None, multiple = True)
 @click.option('--exclude', '-x', type = str, default = None, multiple = True)
+@click.option('--exclude-from', type = str, default = None, multiple = True, help = 'file of exclude rules, one per line as for rclone')
 @click.option('--prefix', '-p', type = str, default = None)
 @click.option('--notify', '-n', is_flag = True)
 @click.option('--dry-run', is_flag = True)
@@ -31,8 +56,14 @@ def macrup(ctx):
 
 @macrup.command()
 @click.pass_context
-def backup(ctx):
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories to sync at once')
+@click.option('--full', is_flag = True, help = 'sync whole trees instead of only changed files')
+@click.option('--bwlimit', type = str, default = None, help = 'bandwidth shared by every transfer in the run eg. "10M"')
+@click.option('--retries', type = int, default = None, help = 'times to retry a directory that failed to sync')
+def backup(ctx, workers, full, bwlimit, retries):
 	'''Backup a directory'''
+	from .retry import from_config
+	from .scheduler import Scheduler
 	if not checkConnection():
 		click.echo('No internet connection detected, delaying backup.')
 		exit(0)
@@ -40,69 +71,257 @@ def backup(ctx):
 		click.echo('No watched directories')
 	if not list(ctx.obj.outdated):
 		click.echo('Up to date!')
+		ctx.obj.write_metrics()
 		return 0
-	failed = []
-	for directory in ctx.obj.outdated:
-		if not directory.push():
-			failed.append(directory)
+	scheduler = Scheduler(workers if workers else config.workers, bwlimit)
+	policy = from_config(config, retries)
+	results = scheduler.push(ctx.obj.outdated, on_done = lambda directory, result: ctx.obj.checkpoint(directory), full = full, policy = policy)
+	failed = [directory for directory, ok in results if not ok]
 	ctx.obj.save()
 	if failed:
 		click.echo("Some directories failed to sync!")
-		if ctx.obj.notify:
-			if config.pushbullet is None:
-				click.echo('You must supply a Pushbullet API key to enable push notifications!')
-				exit(1)
-			print(config.pushbullet)
-			notify.push(config.pushbullet, 'note', title = 'Macrup', body = 'Failed Sync\n' + '\n'.join([d.name for d in failed]))
+		pushNote(ctx.obj, 'Failed Sync\n' + '\n'.join([d.name for d in failed]))
 	else:
-		if ctx.obj.notify:
-			if config.pushbullet is None:
-				click.echo('You must supply a Pushbullet API key to enable push notifications!')
-				exit(1)
-			notify.push(config.pushbullet, 'note', title = 'Macrup', body = 'Successful Sync')
-			
-
+		pushNote(ctx.obj, 'Successful Sync')
 
 @macrup.command()
 @click.pass_obj
-@click.option('--bucket', '-b', help = 'bucket to pull from', required = False)
-@click.option('--dest', '-d', cls = RequiredIf, help = 'destination directory', required_if = 'bucket')
-def restore(backup, bucket, dest):
+@click.option('--bucket', '-b', multiple = True, help = 'bucket to pull from, may be repeated')
+@click.option('--dest', '-d', cls = RequiredIf, multiple = True, help = 'destination directory for each --bucket', required_if = 'bucket')
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories to restore at once')
+@click.option('--order', type = click.Choice(['priority', 'smallest']), default = None, help = 'order to restore directories in')
+@click.option('--retries', type = int, default = None, help = 'times to retry a directory that failed to restore')
+@click.option('--file', '-f', 'files', multiple = True, help = 'only restore this path, relative to the directory, may be repeated')
+@click.option('--snapshot', '-s', type = str, default = None, help = 'restore the snapshot with this label, or latest')
+def restore(backup, bucket, dest, workers, order, retries, files, snapshot):
 	'''Restore a bucket to a directory'''
+	from .retry import from_config
+	from .scheduler import Scheduler, prioritize
 	if not checkConnection():
 		click.echo('No internet connection detected, can not restore.')
 		exit(0)
-	# if bucket and not dest:
-	# 	raise click.BadArgumentUsage('You must provide a destination if a bucket is specified!')
-	if not backup.watched:
+	if len(bucket) != len(dest):
+		raise click.BadArgumentUsage('Every --bucket needs a matching --dest!')
+	targets = backup.restore_targets(dict(zip(bucket, dest)), buckets = bucket)
+	if not targets:
 		click.echo('No watched directories')
-	failed = []
-	for directory in backup.watched:
-		if not directory.pull():
-			failed.append(directory)
+		return
+	scheduler = Scheduler(workers if workers else config.workers)
+	order = order if order else config.restore_order
+	sizes = scheduler.sizes(targets) if order == 'smallest' else None
+	targets = prioritize(targets, config.restore_priority, sizes)
+	_log.info('Restoring in order: %s'%', '.join(d.bucket for d in targets))
+	results = scheduler.pull(targets, policy = from_config(config, retries), files = list(files) if files else None, snapshot = snapshot)
+	failed = [directory for directory, ok in results if not ok]
+	backup.record_run(targets)
 	if failed:
 		click.echo("Some directories failed to sync!")
-		if backup.notify:
-			if config.pushbullet is None:
-				click.echo('You must supply a Pushbullet API key to enable push notifications!')
-				exit(1)
-			notify.push(config.pushbullet, 'note', title = 'Macrup', body = 'Failed Sync\n' + '\n'.join([d.name for d in failed]))
+		pushNote(backup, 'Failed Sync\n' + '\n'.join([d.name for d in failed]))
+		exit(1)
 	else:
-		if backup.notify:
-			if config.pushbullet is None:
-				click.echo('You must supply a Pushbullet API key to enable push notifications!')
-				exit(1)
-			notify.push(config.pushbullet, 'note', title = 'Macrup', body = 'Successful Sync')
+		pushNote(backup, 'Successful Sync')
 
 @macrup.command()
-def delete():
-	'''Delete backups of a directory'''
-	pass
+@click.pass_obj
+@click.option('--bucket', '-b', multiple = True, help = 'only prune this bucket, may be repeated')
+@click.option('--snapshot', '-s', 'snapshots', multiple = True, help = 'delete the snapshot with this label instead of applying the retention policy, may be repeated, never the newest')
+@click.option('--keep-hourly', type = int, default = None, help = 'hourly snapshots to keep')
+@click.option('--keep-daily', type = int, default = None, help = 'daily snapshots to keep')
+@click.option('--keep-weekly', type = int, default = None, help = 'weekly snapshots to keep')
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories to prune at once')
+def delete(backup, bucket, snapshots, keep_hourly, keep_daily, keep_weekly, workers):
+	'''Prune snapshots of watched directories'''
+	from .scheduler import Scheduler
+	if not checkConnection():
+		click.echo('No internet connection detected, can not delete.')
+		exit(0)
+	targets = [d for d in backup.watched if d.snapshotted and (not bucket or d.bucket in bucket)]
+	if not targets:
+		click.echo('No watched directories keep snapshots')
+		return
+	keep = dict(hourly = keep_hourly, daily = keep_daily, weekly = keep_weekly)
+	scheduler = Scheduler(workers if workers else config.workers)
+	results = scheduler.run(targets, 'prune', labels = list(snapshots) or None, keep = keep)
+	failed = [directory for directory, ok in results if not ok]
+	if failed:
+		click.echo('Unable to prune %s'%', '.join(d.name for d in failed))
+		exit(1)
 
 @macrup.command()
-def watch():
+@click.pass_obj
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories to sync at once')
+@click.option('--debounce', type = str, default = None, help = 'quiet period to wait for before syncing a change eg. "30s"')
+def watch(backup, workers, debounce):
 	'''Watch for changes to a directory recursively'''
-	pass
+	from .retry import from_config
+	from .scheduler import Scheduler
+	from .inotify import RecursiveWatcher
+	debounce = convert_delta(debounce if debounce else config.debounce).total_seconds()
+	max_delay = convert_delta(config.debounce_max).total_seconds()
+	scheduler = Scheduler(workers if workers else config.workers)
+	policy = from_config(config)
+	directories = {d.name: d for d in backup.watched}
+	if not directories:
+		click.echo('No watched directories')
+		return
+	# name -> (time of first pending event, time of last pending event)
+	# Anything outdated on startup is synced straight away
+	pending = {d.name: (0, 0) for d in backup.outdated}
+	# name -> time to push a directory that failed again, whether or not it changes in the meantime
+	retrying = {}
+
+	def _deadline(first, last):
+		return min(last + debounce, first + max_delay)
+
+	with RecursiveWatcher(directories) as watcher:
+		click.echo('Watching %s directories'%len(directories))
+		try:
+			while True:
+				timeout = None
+				if pending or retrying:
+					deadlines = [_deadline(*p) for p in pending.values()] + list(retrying.values())
+					timeout = max(0, min(deadlines) - time.monotonic())
+				for name in watcher.poll(timeout):
+					now = time.monotonic()
+					first, _ = pending.get(name, (now, now))
+					pending[name] = (first, now)
+				now = time.monotonic()
+				due = [name for name, p in pending.items() if _deadline(*p) <= now]
+				due += [name for name, at in retrying.items() if at <= now and name not in due]
+				if not due:
+					continue
+				for name in due:
+					pending.pop(name, None)
+					retrying.pop(name, None)
+				_log.info('Changes detected in %s'%', '.join(due))
+				results = scheduler.push([directories[name] for name in due], on_done = lambda directory, result: backup.checkpoint(directory))
+				backup.save()
+				failed = [directory for directory, ok in results if not ok]
+				for directory in failed:
+					delay = policy.delay(directory.failures)
+					retrying[directory.name] = time.monotonic() + delay
+					_log.warning('%s failed, trying it again in %ds'%(directory.name, delay))
+				if failed:
+					click.echo("Some directories failed to sync!")
+					pushNote(backup, 'Failed Sync\n' + '\n'.join([d.name for d in failed]))
+		except KeyboardInterrupt:
+			click.echo('Stopped watching')
+
+@macrup.command()
+@click.pass_obj
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories to sync at once')
+@click.option('--bwlimit', type = str, default = None, help = 'bandwidth shared by every transfer eg. "10M"')
+@click.option('--retries', type = int, default = None, help = 'times to retry a directory that failed to sync')
+def daemon(backup, workers, bwlimit, retries):
+	'''Stay resident, backing up directories as they fall due and taking jobs over a socket'''
+	import asyncio
+	from .daemon import Daemon
+	if not list(backup.watched):
+		click.echo('No watched directories')
+	resident = Daemon(backup, workers, bwlimit, retries, online = checkConnection,
+						notify = lambda body: pushNote(backup, body))
+	asyncio.run(resident.serve())
+
+@macrup.command()
+@click.argument('job', type = click.Choice(['status', 'backup', 'restore']))
+@click.option('--bucket', '-b', multiple = True, help = 'only this bucket, may be repeated')
+@click.option('--path', 'paths', multiple = True, help = 'only this watched directory, may be repeated')
+@click.option('--full', is_flag = True, help = 'sync whole trees instead of only changed files')
+@click.option('--file', '-f', 'files', multiple = True, help = 'only restore this path, relative to the directory, may be repeated')
+@click.option('--snapshot', '-s', type = str, default = None, help = 'restore the snapshot with this label, or latest')
+@click.option('--wait', is_flag = True, help = 'wait for the job to finish')
+@click.option('--json', 'as_json', is_flag = True, help = 'print the response as JSON')
+def ctl(job, bucket, paths, full, files, snapshot, wait, as_json):
+	'''Send a job to, or ask the status of, a running daemon'''
+	import json
+	from pathlib import PosixPath
+	from .daemon import request
+	message = dict(job = job, buckets = list(bucket), paths = [PosixPath(p).resolve().as_posix() for p in paths],
+					full = full, files = list(files) if files else None, snapshot = snapshot, wait = wait)
+	try:
+		response = request(message)
+	except OSError as e:
+		click.echo('Unable to reach the daemon at %s: %s'%(config.daemon_socket, e))
+		exit(1)
+	if as_json:
+		click.echo(json.dumps(response, indent = 2))
+	elif not response['ok']:
+		click.echo(response['error'])
+	elif job == 'status':
+		for directory in response['status']['directories']:
+			click.echo('%s\t%s\t%s\t%s'%(directory['synced'], directory['state'], directory['failures'], directory['path']))
+	else:
+		failed = response['job']['failed']
+		click.echo('Job %s %s%s'%(response['job']['id'], response['job']['state'],
+					', %s failed'%len(failed) if failed else ''))
+	if not response['ok'] or (response.get('job') and response['job']['failed']):
+		exit(1)
+
+@macrup.command()
+@click.pass_obj
+@click.option('--workers', '-j', type = int, default = None, help = 'threads listing each tree')
+@click.option('--json', 'as_json', is_flag = True, help = 'print the totals as JSON')
+def scan(backup, workers, as_json):
+	'''Count the files and bytes in watched directories'''
+	import json
+	from .util import human_size
+	totals = [directory.scan(workers) for directory in backup.watched]
+	if as_json:
+		click.echo(json.dumps([t.as_dict() for t in totals], indent = 2))
+		return
+	for t in totals:
+		click.echo('%s\t%s\t%.1fs\t%d files/s\t%s'%(t.files, human_size(t.bytes), t.elapsed, t.rate, t.root))
+	click.echo('%s\t%s\t%.1fs\t\ttotal'%(sum(t.files for t in totals), human_size(sum(t.bytes for t in totals)),
+				sum(t.elapsed for t in totals)))
+
+@macrup.command()
+@click.pass_obj
+@click.option('--workers', '-j', type = int, default = None, help = 'number of directories the backup would sync at once')
+@click.option('--full', is_flag = True, help = 'plan a sync of whole trees instead of only changed files')
+@click.option('--bwlimit', type = str, default = None, help = 'bandwidth the backup would share eg. "10M"')
+@click.option('--all', 'everything', is_flag = True, help = 'plan every watched directory, not only outdated ones')
+@click.option('--json', 'as_json', is_flag = True, help = 'print the plan as JSON')
+def plan(backup, workers, full, bwlimit, everything, as_json):
+	'''Estimate what a backup would send and how long it would take'''
+	import json
+	from . import hashcache
+	from .bandwidth import BandwidthBudget
+	from .plan import schedule
+	from .scheduler import Scheduler
+	from .util import human_duration, human_size
+	directories = list(backup.watched if everything else backup.outdated)
+	workers = workers if workers else config.workers
+	# Planning only reads local trees, every directory is walked at once
+	results = Scheduler(max(1, len(directories))).plan(directories, full = full)
+	hashcache.save()
+	failed = [d for d, p in results if not p]
+	plans = [p for _, p in results if p]
+	limit = BandwidthBudget(bwlimit if bwlimit else config.bwlimit, config.bwlimit_schedule).limit
+	total = schedule(plans, workers, limit)
+	if as_json:
+		click.echo(json.dumps(dict(
+				directories = [p.as_dict() for p in plans],
+				failed = [d.name for d in failed],
+				workers = workers,
+				bwlimit = limit,
+				files = sum(p.files for p in plans),
+				bytes = sum(p.bytes for p in plans),
+				eta = total), indent = 2))
+	else:
+		if not directories:
+			click.echo('Up to date!')
+		for p in plans:
+			click.echo('%s%s\t%s\t%s\t%s%s\t%s%s'%(p.files, '' if p.exact else '?', human_size(p.bytes),
+						p.deletes if p.deletes is not None else '-',
+						human_duration(p.eta) if p.eta is not None else '-', '~' if p.guessed else '',
+						p.path, ' (skip)' if p.skipped else ' (full)' if p.full else ''))
+		for d in failed:
+			click.echo('failed\t\t\t\t%s'%d.name)
+		if plans:
+			click.echo('%s\t%s\t%s\t%s\ttotal, %s at a time'%(sum(p.files for p in plans), human_size(sum(p.bytes for p in plans)),
+						sum(p.deletes or 0 for p in plans), human_duration(total) if total is not None else '-', workers))
+	if failed:
+		exit(1)
 
 @macrup.command()
 def forget():
@@ -111,7 +330,15 @@ def forget():
 
 @macrup.command()
 @click.pass_context
-def ls(ctx):
+@click.option('--snapshots', is_flag = True, help = 'also list the snapshots of each directory')
+def ls(ctx, snapshots):
 	'''List watched directories and last sync time'''
+	labels = {}
+	if snapshots:
+		from .scheduler import Scheduler
+		snapshotted = [d for d in ctx.obj.watched if d.snapshotted]
+		labels = dict(Scheduler(config.workers).run(snapshotted, 'snapshot_labels'))
 	for dir in ctx.obj.watched:
 		click.echo('%s\t%s'%(dir.synced, dir.name))
+		for text in labels.get(dir) or []:
+			click.echo('\t%s'%text)
@@ -0,0 +1,226 @@
+import os
+import os.path
+import tarfile
+
+from .engine import Engine, merge, missing
+from .error import ConfigError
+from .log import Log
+
+_log = Log('compress')
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+SUFFIX = '.zst'
+ARCHIVE = 'archive.tar.zst'
+# Compressed and raw objects live apart, a raw x.zst and a compressed x must not share a name
+COMPRESSED = 'zst'
+RAW = 'raw'
+INDEX = '.macrup/index.json'
+BLOCK = 1024 * 1024
+
+class CompressEngine(Engine):
+	'''
+		Compresses a directory with zstd on its way to its bucket, nothing is staged on disk
+
+		layout: file     every file is its own zst/<name>.zst object, only changed files are sent.
+		                 Files matching `skip`, eg. media that is already compressed, are copied as is to raw/<name>
+		layout: archive  the whole tree is streamed as a single archive.tar.zst on every push,
+		                 best for dumps and logs that change wholesale anyway
+
+		The index of what is stored where lives in the bucket at .macrup/index.json
+			files: {path: [size, mtime, object, compressed]}
+	'''
+	MODE = 'compress'
+
+	def __init__(self, directory, options = {}):
+		if zstandard is None:
+			raise ConfigError('%s uses mode compress, which needs the zstandard package'%directory.name)
+		super().__init__(directory, options)
+
+	@property
+	def layout(self):
+		layout = self.option('layout')
+		if layout not in ('file', 'archive'):
+			raise ConfigError('Unknown compress layout %s, expected file or archive'%layout)
+		return layout
+
+	def compressor(self):
+		return zstandard.ZstdCompressor(level = int(self.option('level')), threads = int(self.option('threads')))
+
+	def _skipped(self, rel):
+		return any(rel.lower().endswith(ext.lower()) for ext in self.option('skip'))
+
+	@staticmethod
+	def _stored(rel, compressed):
+		'''Name of the object holding `rel`'''
+		return '%s/%s%s'%(COMPRESSED, rel, SUFFIX) if compressed else '%s/%s'%(RAW, rel)
+
+	@staticmethod
+	def _compressed(rel, entry):
+		'''Whether an index entry's object is compressed'''
+		if len(entry) > 3:
+			return entry[3]
+		# Older indexes kept raw files under their own path and compressed ones next to them as <path>.zst
+		return entry[2] != rel
+
+	def _compress_file(self, rel):
+		def _produce(out):
+			with open(os.path.join(self._directory.name, rel), 'rb') as f:
+				self.compressor().copy_stream(f, out, read_size = BLOCK, write_size = BLOCK)
+		return _produce
+
+	def _archive(self, files):
+		def _produce(out):
+			with self.compressor().stream_writer(out, closefd = False) as writer:
+				with tarfile.open(fileobj = writer, mode = 'w|') as tar:
+					for rel in files:
+						path = os.path.join(self._directory.name, rel)
+						# A file that can't be opened is left out before anything of it is written,
+						# any error after that leaves a broken member and aborts the whole archive
+						try:
+							info = tar.gettarinfo(path, arcname = rel)
+							f = open(path, 'rb') if info is not None and info.isreg() else None
+						except OSError as e:
+							_log.warning('Unable to archive %s: %s'%(rel, e))
+							continue
+						if info is None:
+							_log.warning('Unable to archive %s, unsupported file type'%rel)
+							continue
+						if f is None:
+							tar.addfile(info)
+							continue
+						with f:
+							tar.addfile(info, f)
+		return _produce
+
+	async def _upload_index(self, index):
+		spool = self.spool()
+		try:
+			index_path = os.path.join(spool, 'index.json')
+			self.save_index(index, index_path)
+			result = await self.upload(index_path, '%s/%s'%(self._directory.bucket, INDEX))
+			if result and not self._directory._dry_run:
+				os.makedirs(os.path.dirname(self.index_path), exist_ok = True)
+				os.replace(index_path, self.index_path)
+			return result
+		finally:
+			self.clear(spool)
+
+	async def push_async(self, changes, full = False, tuning = None):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		directory = self._directory
+		scanned = await loop.run_in_executor(None, lambda: directory.manifest.current)
+		bucket = directory.bucket
+		if self.layout == 'archive':
+			_log.info('Streaming %s files of %s into %s'%(len(scanned), directory.name, ARCHIVE))
+			result = await directory._rcat_async('%s/%s'%(bucket, ARCHIVE), self._archive(sorted(scanned)))
+			if not result:
+				return result
+			files = {rel: [e.size, e.mtime, ARCHIVE] for rel, e in scanned.items()}
+			return merge(directory.name, [result, await self._upload_index(dict(layout = 'archive', files = files))])
+
+		saved = self.load_index()
+		files = dict(saved['files']) if saved is not None and saved.get('layout') == 'file' else {}
+		if full or not files:
+			gone = [rel for rel in files if rel not in scanned]
+			todo = [rel for rel, e in scanned.items() if rel not in files or tuple(files[rel][:2]) != (e.size, e.mtime)]
+		else:
+			gone = list(changes.deleted)
+			todo = changes.added + changes.modified
+		stale = [files.pop(rel)[2] for rel in gone if rel in files]
+		raw = [rel for rel in todo if self._skipped(rel)]
+		packed = [rel for rel in todo if not self._skipped(rel)]
+		results = []
+		if raw:
+			results.append(await self.upload(directory.name, '%s/%s'%(bucket, RAW), files = raw, tuning = tuning))
+			if not results[-1]:
+				return merge(directory.name, results)
+		slots = asyncio.Semaphore(max(1, int(self.option('transfers'))))
+
+		async def _send(rel):
+			async with slots:
+				return await directory._rcat_async('%s/%s'%(bucket, self._stored(rel, True)), self._compress_file(rel))
+
+		_log.info('%s: compressing %s files, copying %s as they are'%(directory.name, len(packed), len(raw)))
+		sent = await asyncio.gather(*[_send(rel) for rel in packed])
+		results += sent
+		if not all(sent):
+			return merge(directory.name, results)
+		for rel in todo:
+			compressed = not self._skipped(rel)
+			stored = self._stored(rel, compressed)
+			if rel in files and files[rel][2] != stored:
+				stale.append(files[rel][2])
+			entry = scanned[rel]
+			files[rel] = [entry.size, entry.mtime, stored, compressed]
+		result = await self._upload_index(dict(layout = 'file', files = files))
+		results.append(result)
+		# Only drop old objects once the index no longer points at them
+		if result and stale:
+			rc = await directory._delete_async(bucket, stale)
+			if rc != 0:
+				_log.warning('Unable to delete %s stale objects from %s, rc %s'%(len(stale), bucket, rc))
+		return merge(directory.name, results)
+
+	def _decompress_to(self, path, mtime):
+		def _consume(stream):
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+			tmp_path = path + '.macrup-tmp'
+			with open(tmp_path, 'wb') as out:
+				zstandard.ZstdDecompressor().copy_stream(stream, out, read_size = BLOCK, write_size = BLOCK)
+			os.utime(tmp_path, ns = (mtime, mtime))
+			os.replace(tmp_path, path)
+		return _consume
+
+	def _extract_to(self, dest):
+		def _consume(stream):
+			os.makedirs(dest, exist_ok = True)
+			with zstandard.ZstdDecompressor().stream_reader(stream) as reader:
+				with tarfile.open(fileobj = reader, mode = 'r|') as tar:
+					if hasattr(tarfile, 'data_filter'):
+						tar.extractall(dest, filter = 'data')
+					else:
+						tar.extractall(dest)
+		return _consume
+
+	async def pull_async(self, tuning = None, files = None):
+		import asyncio
+		directory = self._directory
+		dest = directory.name
+		bucket = directory.bucket
+		result, index = await self.fetch_index('%s/%s'%(bucket, INDEX))
+		if index is None:
+			return result
+		results = [result]
+		if index['layout'] == 'archive':
+			if files is not None:
+				_log.warning('%s is a single archive, restoring all of it'%bucket)
+			_log.info('Extracting %s from %s into %s'%(ARCHIVE, bucket, dest))
+			result, _ = await directory._cat_async('%s/%s'%(bucket, ARCHIVE), self._extract_to(dest))
+			return merge(dest, results + [result])
+
+		results.append(missing(dest, index['files'], files))
+		todo = {rel: entry for rel, entry in index['files'].items()
+					if (rel in files if files is not None else not self.current(dest, rel, entry))}
+		raw = {}
+		for rel, entry in todo.items():
+			if not self._compressed(rel, entry):
+				# A raw object is the file's path under a prefix, raw/ or none for older indexes
+				raw.setdefault(entry[2][:len(entry[2]) - len(rel)].rstrip('/'), []).append(rel)
+		for prefix, paths in sorted(raw.items()):
+			source = '%s/%s'%(bucket, prefix) if prefix else bucket
+			results.append(await self.download(source, dest, files = paths, tuning = tuning))
+		slots = asyncio.Semaphore(max(1, int(self.option('transfers'))))
+
+		async def _fetch(rel, entry):
+			async with slots:
+				result, _ = await directory._cat_async('%s/%s'%(bucket, entry[2]), self._decompress_to(os.path.join(dest, rel), entry[1]))
+				return result
+
+		_log.info('%s: restoring %s of %s files from %s'%(dest, len(todo), len(index['files']), bucket))
+		results += await asyncio.gather(*[_fetch(rel, entry) for rel, entry in todo.items() if self._compressed(rel, entry)])
+		return merge(dest, results)
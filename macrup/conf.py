@@ -38,12 +38,64 @@ APP_DEFAULTS = {
 	'remote': None,
 	'watched': [],
 	'exclude': [],
+	'exclude_from': [],
 	'prefix': None,
 	'notify': False,
 	'pushbullet': None,
 	'frequency': '1d',
 	'timestamp': '%y:%m:%d:%H:%M:%S',
-	'state_path': '~/.macrup.state'
+	'state_path': '~/.macrup.state',
+	'workers': 1,
+	'manifest': True,
+	'manifest_hash': False,
+	'hash_cache': '~/.macrup.hashes',
+	'hash_cache_size': 500000,
+	'checksum': 'auto',
+	'scan_workers': 8,
+	'full_sync': '7d',
+	'debounce': '30s',
+	'debounce_max': '10m',
+	'timeout': None,
+	'kill_grace': '30s',
+	'stats_interval': '30s',
+	'metrics_path': None,
+	'state_backend': 'sqlite',
+	'state_db': '~/.macrup.state.db',
+	'state_runs': 1000,
+	'connection_check': 'api.backblazeb2.com:443',
+	'restore_order': 'priority',
+	'restore_priority': [],
+	'restore_dest': [],
+	'tuning': [],
+	'bwlimit': None,
+	'bwlimit_schedule': None,
+	'retries': 3,
+	'retry_backoff': '30s',
+	'retry_backoff_max': '10m',
+	'rclone': '/usr/bin/rclone',
+	'spool_path': None,
+	'dedup_bucket': None,
+	'dedup_chunk_size': 1024 * 1024,
+	'dedup_spool_max': 1024 * 1024 * 1024,
+	'compress_layout': 'file',
+	'compress_level': 3,
+	'compress_threads': 0,
+	'compress_transfers': 4,
+	'compress_skip': ['.zst', '.gz', '.xz', '.bz2', '.zip', '.7z', '.jpg', '.jpeg', '.png', '.mp4', '.mkv', '.mov', '.mp3'],
+	'pack_size': 64 * 1024 * 1024,
+	'pack_file_max': 4 * 1024 * 1024,
+	'pack_live': 0.5,
+	'pack_transfers': 4,
+	'snapshots': False,
+	'keep_hourly': 24,
+	'keep_daily': 7,
+	'keep_weekly': 4,
+	'daemon_socket': '~/.macrup.sock',
+	'daemon_interval': '5m',
+	'daemon_history': 20,
+	'rcd': False,
+	'rcd_poll': 0.25,
+	'rcd_start_timeout': '30s'
 }
 
 BUILT_IN_DEFAULTS.update(APP_DEFAULTS)
@@ -116,7 +168,7 @@ def createNamespace(mapping, name = 'config'):
 def loadYAML(path):
 	try:
 		with open(path) as configFile:
-			return yaml.load(configFile)
+			return yaml.load(configFile, Loader = yaml.Loader)
 	except Exception as e:
 		pass
 	return None
@@ -128,7 +180,7 @@ def loadConfig(path = None):
 		loadedConfig = {}
 		with open(path, 'w') as cf:
 			yaml.dump(defaults, cf, default_flow_style=False)
-	config = recursivelyUpdateDict(defaults, loadedConfig)
+	config = recursivelyUpdateDict(defaults, loadedConfig if loadedConfig else {})
 	config['logging']['loglvl'] = parseLogLevel(config['logging']['loglvl']) # Parse the loglvl
 	return createNamespace(config) # Return the config for good measure
 
@@ -0,0 +1,309 @@
+import asyncio
+import json
+import os
+import os.path
+import signal
+import socket
+import time
+from datetime import datetime
+from os.path import expanduser
+from pathlib import PosixPath
+
+from . import rcd
+from .conf import config
+from .error import ConfigError
+from .log import Log
+from .retry import from_config
+from .scheduler import Scheduler
+from .util import convert_delta
+
+_log = Log('daemon')
+
+JOBS = ('backup', 'restore', 'status')
+
+def _encode(value):
+	if isinstance(value, datetime):
+		return value.isoformat()
+	if isinstance(value, PosixPath):
+		return value.as_posix()
+	raise TypeError('Unable to encode %r'%value)
+
+def encode(message):
+	return (json.dumps(message, default = _encode) + '\n').encode('utf-8')
+
+def request(message, path = None, timeout = None):
+	'''Send one request to a running daemon and return its response'''
+	path = expanduser(path if path else config.daemon_socket)
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.settimeout(timeout)
+		sock.connect(path)
+		sock.sendall(encode(message))
+		with sock.makefile('rb') as reply:
+			line = reply.readline()
+	if not line:
+		raise ConnectionError('The daemon at %s closed the connection'%path)
+	return json.loads(line.decode('utf-8'))
+
+class Job:
+	'''A backup or restore queued on the daemon'''
+	def __init__(self, id, kind, directories, kwargs = {}):
+		self.id = id
+		self.kind = kind
+		self.directories = directories
+		self.kwargs = kwargs
+		self.state = 'queued'
+		self.submitted = datetime.now()
+		self.started = None
+		self.finished = None
+		self.results = None
+		self.done = asyncio.Event()
+
+	def __repr__(self):
+		return 'Job(id=%s, kind=%s, state=%s, directories=%s)'%(self.id, self.kind, self.state, len(self.directories))
+
+	def as_dict(self):
+		return dict(
+				id = self.id,
+				job = self.kind,
+				state = self.state,
+				submitted = self.submitted,
+				started = self.started,
+				finished = self.finished,
+				directories = [d.name for d in self.directories],
+				failed = [d.name for d, ok in self.results if not ok] if self.results is not None else None)
+
+class Daemon:
+	'''
+		Keeps a Backup and its directories in memory and runs jobs from a queue
+
+		Outdated directories are queued for backup as they fall due, more jobs
+		arrive as JSON lines on a Unix socket, eg. {"job": "backup", "buckets": ["pfx-docs"]}.
+		Jobs run one after another, the directories in a job `workers` at a time,
+		and every directory is checkpointed to the state store as it finishes.
+		A status request is answered straight from memory even while a job runs.
+
+		A directory that failed is not queued again until the retry backoff
+		for its number of consecutive failures has passed.
+	'''
+	def __init__(self, backup, workers = None, bwlimit = None, retries = None, online = None, notify = None):
+		self._backup = backup
+		self._scheduler = Scheduler(workers if workers else config.workers, bwlimit)
+		self._policy = from_config(config, retries)
+		self._online = online
+		self._notify = notify
+		self._jobs = {}
+		self._ids = 0
+		self._queue = None
+		self._wake = None
+		self._running = None
+		self._held = {}
+		self._started = datetime.now()
+
+	def __repr__(self):
+		return 'Daemon(socket=%s, workers=%s)'%(self.socket_path, self._scheduler.workers)
+
+	@property
+	def socket_path(self):
+		return expanduser(config.daemon_socket)
+
+	def _pending(self):
+		'''Names of the directories in a job that is queued or running'''
+		return set(d.name for job in self._jobs.values() if job.state != 'done' for d in job.directories)
+
+	def _select(self, paths = None, buckets = None):
+		directories = list(self._backup.watched)
+		if paths or buckets:
+			wanted = set(PosixPath(expanduser(p)).resolve().as_posix() for p in paths or [])
+			directories = [d for d in directories if d.name in wanted or d.bucket in (buckets or [])]
+			if not directories:
+				raise ConfigError('No watched directory matches %s'%', '.join(list(paths or []) + list(buckets or [])))
+		return directories
+
+	def submit(self, kind, directories, **kwargs):
+		self._ids += 1
+		job = Job(self._ids, kind, directories, kwargs)
+		self._jobs[job.id] = job
+		# Only the most recent finished jobs are worth reporting
+		for old in [j for j in self._jobs.values() if j.state == 'done'][:-config.daemon_history]:
+			del self._jobs[old.id]
+		self._queue.put_nowait(job)
+		_log.info('Queued %s of %s directories as job %s'%(kind, len(directories), job.id))
+		return job
+
+	def status(self):
+		pending = self._pending()
+		running = set(d.name for d in self._running.directories) if self._running else set()
+
+		def _directory(d):
+			return dict(
+					path = d.name,
+					bucket = d.bucket,
+					mode = d.mode,
+					synced = d.synced if d.synced.year > 1 else None,
+					full_synced = d.full_synced if d.full_synced.year > 1 else None,
+					failures = d.failures,
+					state = 'running' if d.name in running else 'queued' if d.name in pending else 'idle',
+					result = d.result.as_dict() if d.result is not None else None)
+
+		return dict(
+				started = self._started,
+				uptime = (datetime.now() - self._started).total_seconds(),
+				next_due = min((self._backup.due_at(d) for d in self._backup.watched), default = None),
+				jobs = [job.as_dict() for job in self._jobs.values()],
+				directories = [_directory(d) for d in self._backup.watched])
+
+	async def handle(self, message):
+		'''Answer one request from the socket'''
+		kind = message.get('job')
+		if kind not in JOBS:
+			raise ConfigError('Unknown job %s, expected one of %s'%(kind, ', '.join(JOBS)))
+		if kind == 'status':
+			return dict(ok = True, status = self.status())
+		if kind == 'backup':
+			job = self.submit('backup', self._select(message.get('paths'), message.get('buckets')),
+							full = bool(message.get('full', False)))
+		else:
+			targets = self._backup.restore_targets(message.get('dest', {}), buckets = message.get('buckets'))
+			if not targets:
+				raise ConfigError('No watched directory matches %s'%', '.join(message.get('buckets') or []))
+			job = self.submit('restore', targets, files = message.get('files'), snapshot = message.get('snapshot'))
+		if message.get('wait'):
+			await job.done.wait()
+		return dict(ok = True, job = job.as_dict())
+
+	async def _client(self, reader, writer):
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				try:
+					response = await self.handle(json.loads(line.decode('utf-8')))
+				except Exception as e:
+					_log.debug('Bad request %r: %s'%(line, e))
+					response = dict(ok = False, error = str(e))
+				writer.write(encode(response))
+				await writer.drain()
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	def _done(self, directory, result):
+		self._backup.checkpoint(directory)
+		if result:
+			self._held.pop(directory.name, None)
+		else:
+			delay = self._policy.delay(directory.failures)
+			self._held[directory.name] = time.monotonic() + delay
+			_log.warning('%s failed, not trying it again for %ds'%(directory.name, delay))
+
+	async def _run(self, job):
+		loop = asyncio.get_running_loop()
+		control = rcd.active.get()
+		if control is not None and not control.running:
+			_log.warning('rclone rcd went away, restarting it')
+			await control.start()
+		job.state = 'running'
+		job.started = datetime.now()
+		self._running = job
+		_log.info('Starting job %s, %s of %s'%(job.id, job.kind, ', '.join(d.name for d in job.directories)))
+		try:
+			if job.kind == 'backup':
+				job.results = await self._scheduler.run_async(job.directories, 'push', on_done = self._done,
+									full = job.kwargs['full'], policy = self._policy)
+			else:
+				job.results = await self._scheduler.run_async(job.directories, 'pull', policy = self._policy,
+									files = job.kwargs['files'], snapshot = job.kwargs['snapshot'])
+			await loop.run_in_executor(None, lambda: self._backup.record_run(job.directories, job.kind, job.started))
+		except Exception:
+			_log.exception('Job %s failed'%job.id)
+			job.results = [(d, False) for d in job.directories]
+		finally:
+			job.state = 'done'
+			job.finished = datetime.now()
+			self._running = None
+			job.done.set()
+			self._wake.set()
+		failed = [d for d, ok in job.results if not ok]
+		_log.info('Finished job %s, %s of %s directories failed'%(job.id, len(failed), len(job.directories)))
+		if self._notify and failed:
+			self._notify('Failed %s\n'%job.kind.capitalize() + '\n'.join(d.name for d in failed))
+
+	async def _work(self):
+		while True:
+			await self._run(await self._queue.get())
+
+	async def _plan(self):
+		'''Queue whatever is outdated, then sleep until the next directory falls due'''
+		loop = asyncio.get_running_loop()
+		interval = convert_delta(config.daemon_interval).total_seconds()
+		while True:
+			self._wake.clear()
+			pending = self._pending()
+			waits = {}
+			for directory in self._backup.watched:
+				if directory.name in pending:
+					continue
+				waits[directory] = max((self._backup.due_at(directory) - datetime.now()).total_seconds(),
+										self._held.get(directory.name, 0) - time.monotonic())
+			due = [d for d, wait in waits.items() if wait <= 0]
+			if due:
+				if self._online is None or await loop.run_in_executor(None, self._online):
+					self.submit('backup', due, full = False)
+				else:
+					_log.info('No internet connection detected, delaying backup of %s directories'%len(due))
+			timeout = min([wait for wait in waits.values() if wait > 0] + [interval])
+			try:
+				await asyncio.wait_for(self._wake.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+
+	def _claim_socket(self):
+		path = self.socket_path
+		if os.path.exists(path):
+			try:
+				request(dict(job = 'status'), path, timeout = 5)
+			except (OSError, ValueError):
+				_log.debug('Removing stale socket %s'%path)
+				os.remove(path)
+			else:
+				raise ConfigError('A macrup daemon is already listening on %s'%path)
+
+	async def serve(self):
+		'''Run until SIGINT or SIGTERM'''
+		loop = asyncio.get_running_loop()
+		self._queue = asyncio.Queue()
+		self._wake = asyncio.Event()
+		stopping = asyncio.Event()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, stopping.set)
+		self._claim_socket()
+		old_umask = os.umask(0o177)
+		try:
+			server = await asyncio.start_unix_server(self._client, path = self.socket_path)
+		finally:
+			os.umask(old_umask)
+		_log.info('Listening on %s, watching %s directories'%(self.socket_path, len(list(self._backup.watched))))
+		control = None
+		if config.rcd:
+			# Every job shares one rclone rcd for as long as the daemon runs
+			control = rcd.RemoteControl(budget = self._scheduler.budget)
+			if await control.start():
+				rcd.active.set(control)
+		tasks = [asyncio.ensure_future(self._work()), asyncio.ensure_future(self._plan())]
+		try:
+			await stopping.wait()
+			_log.info('Stopping, %s jobs still queued'%self._queue.qsize())
+		finally:
+			server.close()
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions = True)
+			await server.wait_closed()
+			if control is not None:
+				await control.stop()
+			try:
+				os.remove(self.socket_path)
+			except FileNotFoundError:
+				pass
@@ -0,0 +1,314 @@
+import os
+import os.path
+from hashlib import blake2b
+from os.path import expanduser
+
+from .conf import config
+from .engine import Engine, merge, missing
+from .log import Log
+from .stats import SyncResult
+
+_log = Log('dedup')
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# One random 64 bit value per byte, derived so every machine cuts chunks in the same places
+GEAR = [int.from_bytes(blake2b(bytes([i]), digest_size = 8, person = b'macrup-gear').digest(), 'big') for i in range(256)]
+GEAR_TABLE = numpy.array(GEAR, dtype = numpy.uint64) if numpy is not None else None
+
+# Bytes hashed at once when looking for a cut, a cut is usually found in the first few blocks
+SCAN_BLOCK = 64 * 1024
+
+# rclone's exit code for less serious errors, another attempt in the same run won't make a file readable
+UNREADABLE = 6
+
+class Chunker:
+	'''
+		Content defined chunking with a gear hash, as in FastCDC
+
+		A cut is made where the top bits of the rolling hash are all zero,
+		so an insert or delete only moves the boundaries of the chunks around it.
+		Chunks are at least `average` / 4 and at most `average` * 4 bytes,
+		normalised towards `average` by using a stricter mask before it and a looser one after.
+
+		The hash is computed a block at a time with numpy. Without numpy files are
+		cut into fixed blocks of `average` bytes, which only dedups unshifted content.
+	'''
+	def __init__(self, average = 1024 * 1024):
+		bits = max(8, int(average).bit_length() - 1)
+		self.average = 1 << bits
+		self.min = self.average // 4
+		self.max = self.average * 4
+		self._strict = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+		self._loose = ((1 << (bits - 1)) - 1) << (64 - bits + 1)
+
+	def __repr__(self):
+		return 'Chunker(average=%s)'%self.average
+
+	def _hashes(self, data, start, stop):
+		'''
+			The rolling hash after each byte of data[start:stop], as if it started from zero at `min`
+
+			A byte is shifted out of the 64 bit hash 64 bytes later, so the hash at j is the sum of
+			GEAR[data[j - k]] << k for k < 64, built up by doubling the window: 1, 2, 4 ... 64 bytes
+		'''
+		lo = max(self.min, start - 63)
+		h = GEAR_TABLE[numpy.frombuffer(data, dtype = numpy.uint8, count = stop - lo, offset = lo)]
+		width = 1
+		while width < 64:
+			h[width:] += h[:-width] << numpy.uint64(width)
+			width *= 2
+		return h[start - lo:]
+
+	def cut(self, data):
+		'''Length of the first chunk in data, a bytes-like object'''
+		size = len(data)
+		if size <= self.min:
+			return size
+		end = min(size, self.max)
+		if numpy is None:
+			return min(end, self.average)
+		normal = min(end, self.average)
+		for mask, lo, hi in ((self._strict, self.min, normal), (self._loose, normal, end)):
+			mask = numpy.uint64(mask)
+			for start in range(lo, hi, SCAN_BLOCK):
+				stop = min(hi, start + SCAN_BLOCK)
+				hits = numpy.flatnonzero((self._hashes(data, start, stop) & mask) == 0)
+				if len(hits):
+					return start + int(hits[0]) + 1
+		return end
+
+	def split(self, stream):
+		'''Yield the chunks of a binary file object, reading at most a few chunks ahead'''
+		buf = bytearray()
+		eof = False
+		while True:
+			if len(buf) < self.max and not eof:
+				more = stream.read(self.max * 4)
+				eof = not more
+				buf += more
+				continue
+			if not buf:
+				return
+			size = self.cut(buf)
+			yield bytes(buf[:size])
+			# Dropping from the front of a bytearray doesn't copy what is left
+			del buf[:size]
+
+def chunk_id(data):
+	return blake2b(data, digest_size = 32).hexdigest()
+
+def chunk_path(cid):
+	return 'chunks/%s/%s'%(cid[:2], cid)
+
+class DedupEngine(Engine):
+	'''
+		Stores a directory as content defined chunks in a bucket shared by every deduplicated directory
+
+		Each chunk is uploaded once however many files or directories contain it,
+		so identical files across watched directories and large files that change
+		by a few bytes only cost the chunks that are actually new.
+
+		Layout of the shared bucket
+			chunks/ab/abcdef...     chunk content, named by its blake2b hash
+			indexes/<bucket>.json   for every file its size, mtime and list of chunks
+	'''
+	MODE = 'dedup'
+
+	def __init__(self, directory, options = {}):
+		if numpy is None:
+			_log.warning('numpy is not installed, %s is cut into fixed size chunks'%directory.name)
+		super().__init__(directory, options)
+
+	@property
+	def bucket(self):
+		if self.option('bucket'):
+			return self.option('bucket')
+		return '%s-chunks'%self._directory._prefix
+
+	@property
+	def chunker(self):
+		return Chunker(self.option('chunk_size'))
+
+	@property
+	def _known_path(self):
+		return '%s.manifests/%s.chunks'%(expanduser(config.state_path), self.bucket)
+
+	async def known_chunks(self, refresh = False):
+		'''Ids of chunks already in the shared bucket, from the local cache or a listing of the bucket'''
+		if not refresh and os.path.exists(self._known_path):
+			with open(self._known_path) as known_file:
+				return set(line.strip() for line in known_file if line.strip())
+		_log.info('Listing chunks stored in %s'%self.bucket)
+		listing = await self._directory._lsf_async('%s/chunks'%self.bucket)
+		known = set(os.path.basename(p) for p in listing) if listing is not None else set()
+		if not self._directory._dry_run:
+			self._remember(known, replace = True)
+		return known
+
+	def _remember(self, cids, replace = False):
+		os.makedirs(os.path.dirname(self._known_path), exist_ok = True)
+		with open(self._known_path, 'w' if replace else 'a') as known_file:
+			for cid in cids:
+				known_file.write(cid + '\n')
+
+	def _chunk_file(self, rel, known, spool):
+		'''
+			Split a file into chunks, writing any not in `known` into the spool
+			Returns (list of chunk ids, new chunk ids, bytes spooled), or None if the file can't be read
+		'''
+		chunker = self.chunker
+		cids = []
+		new = []
+		spooled = 0
+		try:
+			with open(os.path.join(self._directory.name, rel), 'rb') as f:
+				for chunk in chunker.split(f):
+					cid = chunk_id(chunk)
+					cids.append(cid)
+					if cid in known:
+						continue
+					path = os.path.join(spool, chunk_path(cid))
+					os.makedirs(os.path.dirname(path), exist_ok = True)
+					with open(path, 'wb') as out:
+						out.write(chunk)
+					known.add(cid)
+					new.append(cid)
+					spooled += len(chunk)
+		except OSError as e:
+			_log.warning('Unable to read %s, the index keeps its previous version: %s'%(rel, e))
+			return None
+		return cids, new, spooled
+
+	async def push_async(self, changes, full = False, tuning = None):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		directory = self._directory
+		manifest = directory.manifest
+		scanned = await loop.run_in_executor(None, lambda: manifest.current)
+		saved = self.load_index()
+		files = dict(saved['files']) if saved is not None else {}
+		if full or saved is None:
+			full = True
+			files = {rel: f for rel, f in files.items() if rel in scanned}
+			todo = [rel for rel, e in scanned.items() if rel not in files or tuple(files[rel][:2]) != (e.size, e.mtime)]
+		else:
+			for rel in changes.deleted:
+				files.pop(rel, None)
+			todo = changes.added + changes.modified
+		known = await self.known_chunks(refresh = full)
+		spool = self.spool()
+		results = []
+		pending = []
+		pending_bytes = 0
+		total_bytes = new_bytes = 0
+		unreadable = []
+		try:
+			for rel in todo:
+				chunked = await loop.run_in_executor(None, self._chunk_file, rel, known, spool)
+				if chunked is None:
+					unreadable.append(rel)
+					continue
+				cids, new, spooled = chunked
+				entry = scanned[rel]
+				files[rel] = [entry.size, entry.mtime, cids]
+				total_bytes += entry.size
+				new_bytes += spooled
+				pending += new
+				pending_bytes += spooled
+				if pending_bytes >= self.option('spool_max'):
+					result = await self._flush(spool, pending, tuning)
+					results.append(result)
+					if not result:
+						return merge(directory.name, results)
+					pending, pending_bytes = [], 0
+			if pending:
+				result = await self._flush(spool, pending, tuning)
+				results.append(result)
+				if not result:
+					return merge(directory.name, results)
+			_log.info('%s: %s files chunked, %s of %s bytes were new to %s'%(directory.name, len(todo), new_bytes, total_bytes, self.bucket))
+			if directory._dry_run:
+				return merge(directory.name, results)
+			index_path = os.path.join(spool, 'index.json')
+			self.save_index(dict(root = directory.name, chunk_size = self.chunker.average, files = files), index_path)
+			result = await self.upload(index_path, '%s/indexes/%s.json'%(self.bucket, directory.bucket))
+			results.append(result)
+			if result:
+				os.makedirs(os.path.dirname(self.index_path), exist_ok = True)
+				os.replace(index_path, self.index_path)
+			# Failing keeps the manifest from being committed, so the next push tries these again
+			if unreadable:
+				_log.error('%s: %s files could not be read'%(directory.name, len(unreadable)))
+				results.append(SyncResult(False, rc = UNREADABLE))
+			return merge(directory.name, results)
+		finally:
+			self.clear(spool)
+
+	async def _flush(self, spool, cids, tuning):
+		'''Upload the spooled chunks and start over with an empty spool'''
+		result = await self.upload(spool, self.bucket, files = [chunk_path(cid) for cid in cids], tuning = tuning)
+		if result and not self._directory._dry_run:
+			self._remember(cids)
+		for cid in cids:
+			try:
+				os.remove(os.path.join(spool, chunk_path(cid)))
+			except FileNotFoundError:
+				pass
+		return result
+
+	def _assemble(self, dest, rel, entry, spool):
+		size, mtime, cids = entry
+		path = os.path.join(dest, rel)
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		tmp_path = path + '.macrup-tmp'
+		with open(tmp_path, 'wb') as out:
+			for cid in cids:
+				with open(os.path.join(spool, chunk_path(cid)), 'rb') as chunk:
+					out.write(chunk.read())
+		os.utime(tmp_path, ns = (mtime, mtime))
+		os.replace(tmp_path, path)
+
+	def _restore_batch(self, dest, batch, spool):
+		for rel, entry in batch:
+			self._assemble(dest, rel, entry, spool)
+
+	async def pull_async(self, tuning = None, files = None):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		directory = self._directory
+		dest = directory.name
+		result, index = await self.fetch_index('%s/indexes/%s.json'%(self.bucket, directory.bucket))
+		if index is None:
+			return result
+		spool = self.spool()
+		results = [result, missing(dest, index['files'], files)]
+		try:
+			todo = [(rel, entry) for rel, entry in sorted(index['files'].items())
+						if (rel in files if files is not None else not self.current(dest, rel, entry))]
+			_log.info('%s: restoring %s of %s files from %s'%(dest, len(todo), len(index['files']), self.bucket))
+			# Fetch chunks a spool's worth at a time so a restore never needs twice the space
+			batch, wanted, wanted_bytes = [], set(), 0
+			for i, (rel, entry) in enumerate(todo):
+				batch.append((rel, entry))
+				wanted.update(entry[2])
+				wanted_bytes += entry[0]
+				if wanted_bytes < self.option('spool_max') and i < len(todo) - 1:
+					continue
+				result = await self.download(self.bucket, spool, files = [chunk_path(cid) for cid in sorted(wanted)], tuning = tuning)
+				results.append(result)
+				if not result:
+					break
+				await loop.run_in_executor(None, self._restore_batch, dest, batch, spool)
+				for cid in wanted:
+					try:
+						os.remove(os.path.join(spool, chunk_path(cid)))
+					except FileNotFoundError:
+						pass
+				batch, wanted, wanted_bytes = [], set(), 0
+			return merge(directory.name, results)
+		finally:
+			self.clear(spool)
@@ -0,0 +1,177 @@
+import importlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+from os.path import expanduser
+
+from .conf import config
+from .error import ConfigError
+from .log import Log
+from .stats import SyncResult, TransferStats
+
+_log = Log('engine')
+
+# mode -> module:class, imported when a directory using the mode is first synced
+ENGINES = {
+	'dedup': 'dedup:DedupEngine',
+	'compress': 'compress:CompressEngine',
+	'pack': 'pack:PackEngine',
+}
+
+def load(mode):
+	'''The Engine class for a watched entry's `mode`'''
+	if mode not in ENGINES:
+		raise ConfigError('Unknown mode %s, expected sync or one of %s'%(mode, ', '.join(sorted(ENGINES))))
+	module, _, name = ENGINES[mode].partition(':')
+	return getattr(importlib.import_module('.%s'%module, __package__), name)
+
+def merge(name, results):
+	'''Fold the SyncResults of several rclone runs into one'''
+	results = [r for r in results if r is not None]
+	stats = TransferStats(name)
+	for result in results:
+		if result.stats is None:
+			continue
+		stats.bytes += result.stats.bytes
+		stats.total_bytes += result.stats.total_bytes
+		stats.checks += result.stats.checks
+		stats.transfers += result.stats.transfers
+		stats.deletes += result.stats.deletes
+		stats.errors += result.stats.errors
+		stats.retries += result.stats.retries
+		stats.elapsed += result.stats.elapsed
+		stats.last_error = result.stats.last_error or stats.last_error
+	failed = [r for r in results if not r]
+	rc = failed[-1].rc if failed else 0
+	return SyncResult(not failed, stats = stats, rc = rc)
+
+# rclone's exit code for a missing file, not worth a retry
+FILE_NOT_FOUND = 4
+
+def missing(name, known, files):
+	'''
+		A failed SyncResult if some of `files`, paths asked for by a restore, are not in `known`, otherwise None
+		The caller restores the rest, so the run still fails without stopping at the first typo
+	'''
+	if files is None:
+		return None
+	absent = [rel for rel in files if rel not in known]
+	if not absent:
+		return None
+	_log.warning('%s: not in the backup, skipping %s'%(name, ', '.join(absent)))
+	return SyncResult(False, rc = FILE_NOT_FOUND)
+
+class Engine:
+	'''
+		Base for modes that store a directory as something other than a plain mirror of its files
+
+		An engine is given the Directory it stores and the options from its `watched` entry.
+		It keeps a local index of what it has stored next to the directory's manifest,
+		and a copy of that index on the remote so a restore needs nothing local.
+	'''
+	MODE = None
+	INDEX_VERSION = 1
+
+	def __init__(self, directory, options = {}):
+		self._directory = directory
+		self._options = options
+
+	def __repr__(self):
+		return '%s(directory=%s)'%(self.__class__.__name__, self._directory.name)
+
+	def option(self, key):
+		'''A setting from the watched entry, falling back to the `<mode>_<key>` config'''
+		if key in self._options:
+			return self._options[key]
+		return getattr(config, '%s_%s'%(self.MODE, key))
+
+	@property
+	def index_path(self):
+		return '%s.manifests/%s.%s.json'%(expanduser(config.state_path), self._directory.bucket, self.MODE)
+
+	def load_index(self, path = None):
+		path = path if path is not None else self.index_path
+		try:
+			with open(path) as index_file:
+				saved = json.load(index_file)
+		except FileNotFoundError:
+			return None
+		except Exception as e:
+			_log.warning('Unable to read index %s, treating as empty: %s'%(path, e))
+			return None
+		if saved.get('version') != self.INDEX_VERSION:
+			_log.warning('Index %s has an unknown version, treating as empty'%path)
+			return None
+		return saved
+
+	def save_index(self, index, path = None):
+		path = path if path is not None else self.index_path
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'w') as index_file:
+			json.dump(dict(index, version = self.INDEX_VERSION), index_file, separators = (',', ':'))
+		os.replace(tmp_path, path)
+
+	def spool(self):
+		'''A scratch directory for objects on their way to or from the remote'''
+		spool_path = expanduser(config.spool_path) if config.spool_path else None
+		if spool_path:
+			os.makedirs(spool_path, exist_ok = True)
+		return tempfile.mkdtemp(prefix = 'macrup-%s-'%self.MODE, dir = spool_path)
+
+	@staticmethod
+	def clear(spool):
+		shutil.rmtree(spool, ignore_errors = True)
+
+	def remote(self, path):
+		return '%s:%s'%(self._directory._remote, path)
+
+	async def upload(self, local, remote_path, files = None, tuning = None):
+		'''Copy local, a file or a spool directory, to remote_path without deleting anything'''
+		command = 'copy' if os.path.isdir(local) else 'copyto'
+		# Objects are named by content or are new, there is nothing at the destination worth listing
+		return await self._directory._sync_async(local, self.remote(remote_path), files = files,
+						tuning = tuning, command = command, extra = '--no-traverse')
+
+	async def download(self, remote_path, local, files = None, tuning = None):
+		command = 'copy' if files is not None else 'copyto'
+		return await self._directory._sync_async(self.remote(remote_path), local, files = files,
+						tuning = tuning, command = command)
+
+	async def fetch_index(self, remote_path):
+		'''
+			Download and read the index at remote_path
+			Returns (SyncResult, index), index is None on a dry run or if the index is missing or unusable
+		'''
+		spool = self.spool()
+		try:
+			index_path = os.path.join(spool, 'index.json')
+			result = await self.download(remote_path, index_path)
+			if not result or self._directory._dry_run:
+				return result, None
+			index = self.load_index(index_path)
+		finally:
+			self.clear(spool)
+		if index is None:
+			_log.error('No usable index at %s'%self.remote(remote_path))
+			return SyncResult(False), None
+		return result, index
+
+	@staticmethod
+	def current(dest, rel, entry):
+		'''Whether the file at rel under dest matches the size and mtime an index entry starts with'''
+		try:
+			st = os.stat(os.path.join(dest, rel))
+		except OSError:
+			return False
+		return (st.st_size, st.st_mtime_ns) == tuple(entry[:2])
+
+	async def push_async(self, changes, full = False, tuning = None):
+		'''Store what changed, or everything if `full`, returns a SyncResult'''
+		raise NotImplementedError
+
+	async def pull_async(self, tuning = None, files = None):
+		'''Rebuild the directory, or only `files`, from the remote, returns a SyncResult'''
+		raise NotImplementedError
@@ -0,0 +1,180 @@
+import os
+import re
+import tempfile
+import threading
+from functools import lru_cache
+
+from .error import ConfigError
+from .log import Log
+
+_log = Log('excludes')
+
+def glob_to_regex(glob):
+	'''
+		Translate an rclone filter glob into a Python regex, following rclone's own rules
+
+		A leading / anchors the pattern at the root, otherwise it matches the end of a path.
+		* matches within a path segment, ** across segments, ? a single character.
+		[...] are character classes, {a,b} alternatives and {{...}} a raw regex.
+		A trailing / only matches directories, which are matched with a trailing /
+	'''
+	out = ['^'] if glob.startswith('/') else ['(^|/)']
+	chars = glob[1:] if glob.startswith('/') else glob
+	stars = 0
+	in_braces = False
+	i = 0
+	while i < len(chars):
+		c = chars[i]
+		if c != '*' and stars:
+			if stars > 2:
+				raise ConfigError('Too many stars in exclude %s'%glob)
+			out.append('.*' if stars == 2 else '[^/]*')
+			stars = 0
+		if c == '\\':
+			if i + 1 >= len(chars):
+				raise ConfigError('Trailing \\ in exclude %s'%glob)
+			out.append(re.escape(chars[i + 1]))
+			i += 2
+			continue
+		if chars.startswith('{{', i):
+			end = chars.find('}}', i + 2)
+			if end == -1:
+				raise ConfigError('Unclosed {{ in exclude %s'%glob)
+			out.append('(%s)'%chars[i + 2:end])
+			i = end + 2
+			continue
+		if c == '*':
+			stars += 1
+		elif c == '?':
+			out.append('[^/]')
+		elif c == '[':
+			end = chars.find(']', i + 1)
+			if end == -1:
+				raise ConfigError('Unclosed [ in exclude %s'%glob)
+			out.append(chars[i:end + 1])
+			i = end
+		elif c == ']':
+			raise ConfigError('Unopened ] in exclude %s'%glob)
+		elif c == '{':
+			if in_braces:
+				raise ConfigError('Nested { in exclude %s'%glob)
+			in_braces = True
+			out.append('(')
+		elif c == '}':
+			if not in_braces:
+				raise ConfigError('Unopened } in exclude %s'%glob)
+			in_braces = False
+			out.append(')')
+		elif c == ',' and in_braces:
+			out.append('|')
+		else:
+			out.append(re.escape(c))
+		i += 1
+	if stars > 2:
+		raise ConfigError('Too many stars in exclude %s'%glob)
+	if stars:
+		out.append('.*' if stars == 2 else '[^/]*')
+	if in_braces:
+		raise ConfigError('Unclosed { in exclude %s'%glob)
+	out.append('$')
+	return ''.join(out)
+
+class ExcludeRules:
+	'''
+		A set of rclone exclude globs compiled into a single regex
+
+		macrup's own scans match paths with it, and rclone is handed the same
+		rules in an --exclude-from file, so both always agree on what is left out.
+	'''
+	def __init__(self, patterns = ()):
+		# Order doesn't matter for excludes, duplicates only make the regex longer
+		self.patterns = tuple(dict.fromkeys(str(p) for p in patterns if str(p).strip()))
+		self._regex = None
+		self._each = []
+		self._warned = set()
+		self._lock = threading.Lock()
+		if self.patterns:
+			parts = []
+			for pattern in self.patterns:
+				translated = glob_to_regex(pattern)
+				try:
+					self._each.append((pattern, re.compile(translated)))
+				except re.error as e:
+					raise ConfigError('Unable to compile exclude %s: %s'%(pattern, e))
+				parts.append('(?:%s)'%translated)
+			self._regex = re.compile('|'.join(parts))
+
+	def __repr__(self):
+		return 'ExcludeRules(patterns=%s)'%len(self.patterns)
+
+	def __bool__(self):
+		return bool(self.patterns)
+
+	def __iter__(self):
+		return iter(self.patterns)
+
+	def __eq__(self, other):
+		return isinstance(other, ExcludeRules) and self.patterns == other.patterns
+
+	def __hash__(self):
+		return hash(self.patterns)
+
+	def merge(self, *more):
+		'''These rules plus every pattern in `more`'''
+		return compile_rules(self.patterns + tuple(p for patterns in more for p in patterns))
+
+	def excluded(self, rel, is_dir = False):
+		'''Whether a path relative to the root is excluded, directories are tested with a trailing / as rclone does'''
+		if self._regex is None:
+			return False
+		if not is_dir:
+			return self._regex.search(rel) is not None
+		if self._regex.search(rel + '/') is not None:
+			return True
+		if self._regex.search(rel) is not None:
+			self._warn_directory(rel)
+		return False
+
+	def _warn_directory(self, rel):
+		'''Point out rules that name a directory but, as for rclone, only exclude files, eg. node_modules'''
+		for pattern, regex in self._each:
+			if regex.search(rel) is None:
+				continue
+			with self._lock:
+				if pattern in self._warned:
+					continue
+				self._warned.add(pattern)
+			_log.warning('Exclude %s matches directory %s but only excludes files, use %s/ to skip the directory'%(
+						pattern, rel, pattern.rstrip('*').rstrip('/')))
+
+	def write(self):
+		'''Write the rules to a temporary rclone --exclude-from file and return its path, the caller removes it'''
+		fd, path = tempfile.mkstemp(prefix = 'macrup-', suffix = '.excludes')
+		with os.fdopen(fd, 'w') as exclude_file:
+			for pattern in self.patterns:
+				# A leading # or ; would make the line a comment
+				exclude_file.write(('\\' + pattern if pattern[0] in '#;' else pattern) + '\n')
+		return path
+
+@lru_cache(maxsize = 256)
+def _compile(patterns):
+	return ExcludeRules(patterns)
+
+def compile_rules(patterns):
+	'''ExcludeRules for `patterns`, directories sharing a set of rules share one compiled matcher'''
+	if isinstance(patterns, ExcludeRules):
+		return patterns
+	return _compile(tuple(patterns or ()))
+
+def load(path):
+	'''Read the patterns in an rclone --exclude-from file'''
+	patterns = []
+	try:
+		with open(os.path.expanduser(path)) as exclude_file:
+			for line in exclude_file:
+				line = line.strip()
+				if line and line[0] not in '#;':
+					patterns.append(line)
+	except OSError as e:
+		raise ConfigError('Unable to read excludes from %s: %s'%(path, e))
+	return patterns
@@ -0,0 +1,122 @@
+import json
+import os
+import os.path
+import threading
+from collections import OrderedDict
+from os.path import expanduser
+
+from .conf import config
+from .log import Log
+
+_log = Log('hashcache')
+
+class HashCache:
+	'''
+		Content hashes of local files keyed by path, only trusted while inode, size and mtime are unchanged
+
+		Shared by every manifest in a run, so a file is read again only once it has changed on disk,
+		even if the manifest that last hashed it was lost or belongs to another directory.
+		Past `max_entries` the least recently used entries are dropped.
+		The cache is loaded on first use and written back in one go by `save`.
+	'''
+	VERSION = 1
+
+	def __init__(self, path, max_entries = 500000):
+		self._path = path
+		self._max_entries = int(max_entries)
+		self._entries = None
+		self._dirty = False
+		self._hits = 0
+		self._misses = 0
+		# Manifests are scanned on executor threads, several at once
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return 'HashCache(path=%s, entries=%s)'%(self._path, len(self._entries) if self._entries is not None else None)
+
+	@property
+	def path(self):
+		return self._path
+
+	def _load(self):
+		entries = OrderedDict()
+		try:
+			with open(self._path) as cache_file:
+				saved = json.load(cache_file)
+		except FileNotFoundError:
+			return entries
+		except Exception as e:
+			_log.warning('Unable to read hash cache %s, starting empty: %s'%(self._path, e))
+			return entries
+		if saved.get('version') != self.VERSION:
+			_log.warning('Hash cache %s has an unknown version, starting empty'%self._path)
+			return entries
+		# Saved oldest first, so the order of use survives a round trip
+		for path, inode, size, mtime, digest in saved['entries']:
+			entries[path] = (inode, size, mtime, digest)
+		return entries
+
+	def _ensure(self):
+		if self._entries is None:
+			self._entries = self._load()
+		return self._entries
+
+	def get(self, path, st):
+		'''The hash of `path` if it is cached for a file with the inode, size and mtime in `st`'''
+		with self._lock:
+			entries = self._ensure()
+			cached = entries.get(path)
+			if cached is None or cached[:3] != (st.st_ino, st.st_size, st.st_mtime_ns):
+				self._misses += 1
+				return None
+			entries.move_to_end(path)
+			self._hits += 1
+			return cached[3]
+
+	def put(self, path, st, digest):
+		if digest is None:
+			return
+		with self._lock:
+			entries = self._ensure()
+			entries[path] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+			entries.move_to_end(path)
+			while len(entries) > self._max_entries:
+				entries.popitem(last = False)
+			self._dirty = True
+
+	def save(self):
+		'''Write the cache back if anything was added since it was loaded'''
+		with self._lock:
+			if not self._dirty:
+				return
+			_log.debug('Saving %s hashes to %s, %s hits and %s misses this run'%(
+						len(self._entries), self._path, self._hits, self._misses))
+			os.makedirs(os.path.dirname(self._path) or '.', exist_ok = True)
+			tmp_path = self._path + '.tmp'
+			with open(tmp_path, 'w') as cache_file:
+				json.dump(dict(
+					version = self.VERSION,
+					entries = [[path] + list(entry) for path, entry in self._entries.items()]),
+					cache_file,
+					separators = (',', ':'))
+			os.replace(tmp_path, self._path)
+			self._dirty = False
+
+_shared = None
+
+def shared():
+	'''The cache every manifest of this process uses, None if `hash_cache` is off'''
+	global _shared
+	if not config.hash_cache:
+		return None
+	if _shared is None:
+		_shared = HashCache(expanduser(config.hash_cache), config.hash_cache_size)
+	return _shared
+
+def save():
+	'''Persist the shared cache, if one was used'''
+	if _shared is not None:
+		try:
+			_shared.save()
+		except OSError as e:
+			_log.error('Unable to save hash cache %s: %s'%(_shared.path, e))
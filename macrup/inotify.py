@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+
+from .log import Log
+
+_log = Log('inotify')
+
+# Flags from <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Everything that can change what ends up in a bucket
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+				| IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _load_libc():
+	global _libc
+	if _libc is None:
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+		libc.inotify_init1.argtypes = [ctypes.c_int]
+		libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+		_libc = libc
+	return _libc
+
+def _check(rc, msg):
+	if rc == -1:
+		err = ctypes.get_errno()
+		raise OSError(err, '%s: %s'%(msg, os.strerror(err)))
+	return rc
+
+class Inotify:
+	'''
+		A thin wrapper around an inotify file descriptor
+	'''
+	def __init__(self):
+		self._libc = _load_libc()
+		self._fd = _check(self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC), 'inotify_init1')
+
+	def fileno(self):
+		return self._fd
+
+	def add_watch(self, path, mask = IN_CHANGES):
+		return _check(self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask), 'Unable to watch %s'%path)
+
+	def rm_watch(self, wd):
+		return _check(self._libc.inotify_rm_watch(self._fd, wd), 'inotify_rm_watch')
+
+	def read(self, timeout = None):
+		'''
+			Wait up to `timeout` seconds for events and
+			return them as a list of (wd, mask, cookie, name)
+		'''
+		ready, _, _ = select.select([self._fd], [], [], timeout)
+		if not ready:
+			return []
+		try:
+			data = os.read(self._fd, 64 * 1024)
+		except BlockingIOError:
+			return []
+		events = []
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+			offset += _EVENT.size
+			name = data[offset:offset + length].rstrip(b'\0')
+			offset += length
+			events.append((wd, mask, cookie, os.fsdecode(name)))
+		return events
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class RecursiveWatcher:
+	'''
+		Watches a set of root directories and every directory below them
+
+		`poll` returns the roots that saw at least one change.
+		New subdirectories are picked up as they are created or moved in.
+	'''
+	def __init__(self, roots):
+		self._inotify = Inotify()
+		self._roots = list(roots)
+		self._watches = {}
+		for root in self._roots:
+			self._watch_tree(root, root)
+
+	@property
+	def roots(self):
+		return self._roots
+
+	def _watch(self, root, path):
+		try:
+			wd = self._inotify.add_watch(path, IN_CHANGES | IN_ONLYDIR | IN_DONT_FOLLOW)
+		except OSError as e:
+			if e.errno == errno.ENOSPC:
+				_log.error('Out of inotify watches while adding %s, raise fs.inotify.max_user_watches'%path)
+			elif e.errno not in (errno.ENOENT, errno.ENOTDIR):
+				_log.warning(str(e))
+			return False
+		self._watches[wd] = (root, path)
+		return True
+
+	def _watch_tree(self, root, top):
+		if not self._watch(root, top):
+			return
+		for dirpath, dirnames, _ in os.walk(top):
+			for name in dirnames:
+				self._watch(root, os.path.join(dirpath, name))
+
+	def poll(self, timeout = None):
+		changed = set()
+		for wd, mask, cookie, name in self._inotify.read(timeout):
+			if mask & IN_Q_OVERFLOW:
+				_log.warning('inotify queue overflowed, treating every directory as changed')
+				changed.update(self._roots)
+				continue
+			if wd not in self._watches:
+				continue
+			root, path = self._watches[wd]
+			if mask & IN_IGNORED:
+				del self._watches[wd]
+				continue
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				self._watch_tree(root, os.path.join(path, name))
+			changed.add(root)
+		return changed
+
+	def close(self):
+		self._inotify.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
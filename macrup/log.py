@@ -1,4 +1,5 @@
 import logging
+import logging.handlers
 from .conf import config
 
 levels = dict(
@@ -58,7 +59,9 @@ def setupLogging():
 	baseLogger.info('Starting %s: version %s'%(config.meta.app, config.meta.version))
 	return baseLogger
 
-BASE_LOGGER = setupLogging()
+# Handlers are only attached once setupLogging is called from the entry point,
+# loggers handed out before then are still children of this one
+BASE_LOGGER = logging.getLogger(config.meta.app)
 
 # return a nested child of root 
 # levels are indicated in name by "."
@@ -0,0 +1,158 @@
+import json
+import os
+import os.path
+from collections import namedtuple
+from hashlib import blake2b
+
+from .excludes import compile_rules
+from .log import Log
+from .scanner import Scanner
+
+_log = Log('manifest')
+
+# A single file as it was seen on disk
+# mtime is in nanoseconds, hash is None unless content hashing is enabled
+Entry = namedtuple('Entry', ['size', 'mtime', 'inode', 'hash'])
+
+class Changes(namedtuple('Changes', ['added', 'modified', 'deleted'])):
+	'''Relative paths that differ between two manifests'''
+	def __bool__(self):
+		return bool(self.added or self.modified or self.deleted)
+
+	def __len__(self):
+		return len(self.added) + len(self.modified) + len(self.deleted)
+
+	def __repr__(self):
+		return 'Changes(added=%s, modified=%s, deleted=%s)'%(len(self.added), len(self.modified), len(self.deleted))
+
+class Manifest:
+	'''
+		Persistent index of every file under a directory as of its last successful sync
+
+		`scan` walks the tree with a Scanner, doing nothing more than a stat per file.
+		Content is only hashed when hashing is enabled and a file's
+		size, mtime or inode has moved since the last committed scan,
+		and isn't already in `cache`, a HashCache shared between manifests.
+	'''
+	VERSION = 1
+
+	def __init__(self, path, root, excludes = [], hash_content = False, cache = None):
+		self._path = path
+		self._root = root
+		self._excludes = compile_rules(excludes)
+		self._hash_content = hash_content
+		self._cache = cache
+		self._entries = None
+		self._scanned = None
+		self.totals = None
+
+	def __repr__(self):
+		return 'Manifest(path=%s, root=%s)'%(self._path, self._root)
+
+	@property
+	def path(self):
+		return self._path
+
+	@property
+	def exists(self):
+		return os.path.exists(self._path)
+
+	@property
+	def entries(self):
+		if self._entries is None:
+			self._entries = self._load()
+		return self._entries
+
+	@property
+	def current(self):
+		'''Entries from the most recent scan, scanning now if there hasn't been one'''
+		if self._scanned is None:
+			self.scan()
+		return self._scanned
+
+	def _load(self):
+		try:
+			with open(self._path) as manifest_file:
+				saved = json.load(manifest_file)
+		except FileNotFoundError:
+			return {}
+		except Exception as e:
+			_log.warning('Unable to read manifest %s, treating as empty: %s'%(self._path, e))
+			return {}
+		if saved.get('version') != self.VERSION:
+			_log.warning('Manifest %s has an unknown version, treating as empty'%self._path)
+			return {}
+		return {rel: Entry(*entry) for rel, entry in saved['entries'].items()}
+
+	def _save(self, entries):
+		os.makedirs(os.path.dirname(self._path), exist_ok = True)
+		tmp_path = self._path + '.tmp'
+		with open(tmp_path, 'w') as manifest_file:
+			json.dump(dict(
+				version = self.VERSION,
+				root = self._root,
+				entries = {rel: list(entry) for rel, entry in entries.items()}),
+				manifest_file,
+				separators = (',', ':'))
+		os.replace(tmp_path, self._path)
+
+	def _hash(self, rel, st):
+		path = os.path.join(self._root, rel)
+		if self._cache is not None:
+			cached = self._cache.get(path, st)
+			if cached is not None:
+				return cached
+		digest = blake2b()
+		try:
+			with open(path, 'rb') as f:
+				for block in iter(lambda: f.read(1024 * 1024), b''):
+					digest.update(block)
+		except OSError as e:
+			_log.warning('Unable to hash %s: %s'%(rel, e))
+			return None
+		if self._cache is not None:
+			self._cache.put(path, st, digest.hexdigest())
+		return digest.hexdigest()
+
+	def scan(self):
+		'''Walk the tree and return the current entries, reusing hashes of unmoved files'''
+		previous = self.entries
+		scanned = {}
+		scanner = Scanner(self._root, self._excludes)
+		for rel, st in scanner.scan():
+			prev = previous.get(rel)
+			unmoved = prev is not None and (prev.size, prev.mtime, prev.inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
+			digest = prev.hash if unmoved else None
+			if self._hash_content and digest is None:
+				digest = self._hash(rel, st)
+			scanned[rel] = Entry(st.st_size, st.st_mtime_ns, st.st_ino, digest)
+		self._scanned = scanned
+		self.totals = scanner.totals
+		_log.info('Scanned %s: %s'%(self._root, scanner.totals.summary()))
+		return scanned
+
+	def diff(self):
+		'''Scan the tree and compare it against the last committed manifest'''
+		previous = self.entries
+		current = self.scan()
+		added = sorted(rel for rel in current if rel not in previous)
+		deleted = sorted(rel for rel in previous if rel not in current)
+		modified = []
+		for rel, entry in current.items():
+			prev = previous.get(rel)
+			if prev is None or prev == entry:
+				continue
+			# A file that was only touched keeps its hash, there is nothing to upload
+			if entry.hash is not None and entry.hash == prev.hash and entry.size == prev.size:
+				continue
+			modified.append(rel)
+		modified.sort()
+		return Changes(added, modified, deleted)
+
+	def commit(self):
+		'''Persist the most recent scan as the new baseline'''
+		if self._scanned is None:
+			self.scan()
+		self._save(self._scanned)
+		self._entries = self._scanned
+		self._scanned = None
@@ -0,0 +1,99 @@
+import os
+import os.path
+import tempfile
+import time
+
+from .log import Log
+
+_log = Log('metrics')
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(**labels):
+	return '{%s}'%','.join('%s="%s"'%(k, _escape(v)) for k, v in sorted(labels.items()))
+
+class Metrics:
+	'''
+		Collects samples and renders them in the Prometheus text exposition format
+	'''
+	def __init__(self):
+		self._families = {}
+
+	def add(self, name, value, help = '', type = 'gauge', **labels):
+		family = self._families.setdefault(name, dict(help = help, type = type, samples = []))
+		family['samples'].append((labels, value))
+
+	def render(self):
+		lines = []
+		for name, family in self._families.items():
+			lines.append('# HELP %s %s'%(name, family['help']))
+			lines.append('# TYPE %s %s'%(name, family['type']))
+			for labels, value in family['samples']:
+				lines.append('%s%s %s'%(name, _labels(**labels) if labels else '', float(value)))
+		return '\n'.join(lines) + '\n'
+
+	def write(self, path):
+		'''Atomically replace `path` so a scrape never sees a partial file'''
+		dirname = os.path.dirname(path) or '.'
+		fd, tmp_path = tempfile.mkstemp(prefix = '.macrup-', suffix = '.prom', dir = dirname)
+		try:
+			with os.fdopen(fd, 'w') as metrics_file:
+				metrics_file.write(self.render())
+			os.chmod(tmp_path, 0o644)
+			os.replace(tmp_path, path)
+		except Exception:
+			os.remove(tmp_path)
+			raise
+
+def collect(command, duration, directories):
+	'''Build the metrics for a single run over `directories`'''
+	metrics = Metrics()
+	now = time.time()
+	counts = dict(synced = 0, skipped = 0, failed = 0)
+	for directory in directories:
+		labels = dict(path = directory.name, bucket = directory.bucket)
+		if directory.synced.year > 1:
+			metrics.add('macrup_directory_last_success_timestamp_seconds', directory.synced.timestamp(),
+						'Time of the last successful sync', **labels)
+		metrics.add('macrup_directory_consecutive_failures', directory.failures,
+					'Number of syncs that have failed since the last success', **labels)
+		result = directory.result
+		if result is None:
+			continue
+		if not result:
+			counts['failed'] += 1
+		elif result.skipped:
+			counts['skipped'] += 1
+		else:
+			counts['synced'] += 1
+		metrics.add('macrup_directory_success', 1 if result else 0,
+					'Whether the directory synced successfully during the last run', **labels)
+		metrics.add('macrup_directory_duration_seconds', result.duration,
+					'Time spent syncing the directory during the last run', **labels)
+		metrics.add('macrup_directory_attempts', result.attempts,
+					'Attempts needed to sync the directory during the last run', **labels)
+		if result.stats is not None:
+			metrics.add('macrup_directory_transferred_bytes', result.stats.bytes,
+						'Bytes transferred during the last run', **labels)
+			metrics.add('macrup_directory_transferred_files', result.stats.transfers,
+						'Files transferred during the last run', **labels)
+			metrics.add('macrup_directory_checked_files', result.stats.checks,
+						'Files checked during the last run', **labels)
+			metrics.add('macrup_directory_errors', result.stats.errors,
+						'Errors reported by rclone during the last run', **labels)
+	for status, count in counts.items():
+		metrics.add('macrup_run_directories', count, 'Directories by outcome of the last run',
+					command = command, status = status)
+	metrics.add('macrup_run_duration_seconds', duration, 'Wall time of the last run', command = command)
+	metrics.add('macrup_run_timestamp_seconds', now, 'Time the last run finished', command = command)
+	return metrics
+
+def write(path, command, duration, directories):
+	try:
+		collect(command, duration, directories).write(path)
+	except OSError as e:
+		_log.error('Unable to write metrics to %s: %s'%(path, e))
+		return False
+	_log.debug('Wrote metrics to %s'%path)
+	return True
@@ -1,9 +1,9 @@
-import requests
 from .log import Log
 
 _log = Log('notify')
 
 def push(token, type, **kwargs):
+    import requests # Only needed when a note is actually sent
     _log.debug(kwargs)
     kwargs['type'] = type
     headers = {'Content-type': 'application/json', 'Access-Token': token}
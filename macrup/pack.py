@@ -0,0 +1,237 @@
+import os
+import os.path
+import uuid
+
+from .engine import Engine, merge, missing
+from .log import Log
+
+_log = Log('pack')
+
+INDEX = '.macrup/index.json'
+BLOCK = 1024 * 1024
+
+def pack_path(pid):
+	return 'packs/%s.pack'%pid
+
+def file_path(rel):
+	return 'files/%s'%rel
+
+class PackEngine(Engine):
+	'''
+		Bundles small files into pack objects so B2 sees a few large uploads instead of one request per file
+
+		Files up to `file_max` bytes are appended to packs of about `size` bytes, larger ones are
+		copied on their own under files/. Each push only writes new packs for what changed, the
+		space left by changed or deleted files is reclaimed by repacking a pack once less than
+		`live` of it is still in use. The index records the pack and offset of every file so a
+		single file is restored with one ranged read. `length` is how much of a file's slot
+		holds its contents, less than `size` when the file shrank while it was packed.
+
+		Layout of the bucket
+			packs/<id>.pack      concatenated file contents
+			files/<path>         files too large to pack
+			.macrup/index.json   files: {path: [size, mtime, pack id or null, offset, length]}
+			                     packs: {id: [size, live bytes]}
+	'''
+	MODE = 'pack'
+
+	def _plan(self, files, sizes):
+		'''Split `files` into groups of about the pack size, in path order so neighbours share a pack'''
+		groups, group, total = [], [], 0
+		for rel in sorted(files):
+			if group and total + sizes[rel] > int(self.option('size')):
+				groups.append(group)
+				group, total = [], 0
+			group.append(rel)
+			total += sizes[rel]
+		if group:
+			groups.append(group)
+		return groups
+
+	def _write_pack(self, group, sizes, lengths):
+		'''Stream the files in `group` into a pack, recording in `lengths` how much of each was read'''
+		root = self._directory.name
+
+		def _produce(out):
+			for rel in group:
+				remaining = sizes[rel]
+				try:
+					with open(os.path.join(root, rel), 'rb') as f:
+						while remaining > 0:
+							block = f.read(min(BLOCK, remaining))
+							if not block:
+								break
+							out.write(block)
+							remaining -= len(block)
+				except OSError as e:
+					_log.warning('Unable to read %s: %s'%(rel, e))
+				lengths[rel] = sizes[rel] - remaining
+				if remaining:
+					# The file shrank since the scan, keep the offsets of everything after it valid
+					# The next scan sees the change and packs it again
+					_log.warning('%s changed while packing'%rel)
+					out.write(b'\0' * remaining)
+		return _produce
+
+	async def push_async(self, changes, full = False, tuning = None):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		directory = self._directory
+		bucket = directory.bucket
+		scanned = await loop.run_in_executor(None, lambda: directory.manifest.current)
+		saved = self.load_index()
+		files = dict(saved['files']) if saved is not None else {}
+		packs = dict(saved['packs']) if saved is not None else {}
+		if full or saved is None:
+			gone = [rel for rel in files if rel not in scanned]
+			todo = [rel for rel, e in scanned.items() if rel not in files or tuple(files[rel][:2]) != (e.size, e.mtime)]
+		else:
+			gone = list(changes.deleted)
+			todo = changes.added + changes.modified
+		stale = []
+		gone = set(gone)
+		# Anything changed or gone no longer counts towards the pack it was in
+		for rel in gone | set(todo):
+			if rel not in files:
+				continue
+			size, mtime, pid, offset = files.pop(rel)[:4]
+			if pid is None:
+				# A large file that is still large is simply overwritten
+				if rel in gone or scanned[rel].size <= int(self.option('file_max')):
+					stale.append(file_path(rel))
+			elif pid in packs:
+				packs[pid][1] -= size
+		repack = [pid for pid, (size, live) in packs.items() if live < size * float(self.option('live'))]
+		for pid in repack:
+			moved = [rel for rel, entry in files.items() if entry[2] == pid]
+			for rel in moved:
+				files.pop(rel)
+			todo += [rel for rel in moved if rel in scanned]
+			del packs[pid]
+			stale.append(pack_path(pid))
+		sizes = {rel: scanned[rel].size for rel in todo}
+		large = [rel for rel in todo if sizes[rel] > int(self.option('file_max'))]
+		small = [rel for rel in todo if sizes[rel] <= int(self.option('file_max'))]
+		groups = self._plan(small, sizes)
+		_log.info('%s: %s files into %s new packs, %s copied alone, %s packs repacked'%(
+					directory.name, len(small), len(groups), len(large), len(repack)))
+		results = []
+		if large:
+			results.append(await self.upload(directory.name, '%s/files'%bucket, files = large, tuning = tuning))
+			if not results[-1]:
+				return merge(directory.name, results)
+		slots = asyncio.Semaphore(max(1, int(self.option('transfers'))))
+		lengths = {}
+
+		async def _send(group):
+			async with slots:
+				pid = uuid.uuid4().hex
+				result = await directory._rcat_async('%s/%s'%(bucket, pack_path(pid)), self._write_pack(group, sizes, lengths))
+				return pid, result
+
+		sent = await asyncio.gather(*[_send(group) for group in groups])
+		results += [result for _, result in sent]
+		if not all(results):
+			# Packs that did make it are unreferenced, clean them up rather than leave them behind
+			await directory._delete_async(bucket, [pack_path(pid) for pid, result in sent if result])
+			return merge(directory.name, results)
+		if directory._dry_run:
+			# Nothing was streamed, so there is nothing to index
+			return merge(directory.name, results)
+		for rel in large:
+			files[rel] = [sizes[rel], scanned[rel].mtime, None, 0, sizes[rel]]
+		for (pid, _), group in zip(sent, groups):
+			offset = 0
+			for rel in group:
+				files[rel] = [sizes[rel], scanned[rel].mtime, pid, offset, lengths[rel]]
+				offset += sizes[rel]
+			packs[pid] = [offset, offset]
+		spool = self.spool()
+		try:
+			index_path = os.path.join(spool, 'index.json')
+			self.save_index(dict(files = files, packs = packs), index_path)
+			result = await self.upload(index_path, '%s/%s'%(bucket, INDEX))
+			results.append(result)
+			if result:
+				os.makedirs(os.path.dirname(self.index_path), exist_ok = True)
+				os.replace(index_path, self.index_path)
+		finally:
+			self.clear(spool)
+		# Only drop old objects once the index no longer points at them
+		if result and stale:
+			rc = await directory._delete_async(bucket, stale)
+			if rc != 0:
+				_log.warning('Unable to delete %s stale objects from %s, rc %s'%(len(stale), bucket, rc))
+		return merge(directory.name, results)
+
+	def _unpack(self, dest, wanted, base = 0):
+		'''Split a stream of a pack, starting at offset `base`, into the files in `wanted`, a list of (rel, entry) by offset'''
+		def _consume(stream):
+			position = base
+			for rel, entry in wanted:
+				size, mtime, pid, offset = entry[:4]
+				while position < offset:
+					skipped = stream.read(min(BLOCK, offset - position))
+					if not skipped:
+						raise EOFError('Pack %s ended early'%pid)
+					position += len(skipped)
+				path = os.path.join(dest, rel)
+				os.makedirs(os.path.dirname(path), exist_ok = True)
+				tmp_path = path + '.macrup-tmp'
+				with open(tmp_path, 'wb') as out:
+					remaining = size
+					while remaining > 0:
+						block = stream.read(min(BLOCK, remaining))
+						if not block:
+							raise EOFError('Pack %s ended early'%pid)
+						out.write(block)
+						remaining -= len(block)
+					# Indexes written before lengths were recorded have none, their slots are never padded
+					length = entry[4] if len(entry) > 4 else size
+					if length < size:
+						# Drop the padding left by a file that shrank while it was packed
+						out.truncate(length)
+				os.utime(tmp_path, ns = (mtime, mtime))
+				os.replace(tmp_path, path)
+				position += size
+		return _consume
+
+	async def pull_async(self, tuning = None, files = None):
+		import asyncio
+		directory = self._directory
+		dest = directory.name
+		bucket = directory.bucket
+		result, index = await self.fetch_index('%s/%s'%(bucket, INDEX))
+		if index is None:
+			return result
+
+		results = [result, missing(dest, index['files'], files)]
+		if files is not None:
+			todo = {rel: index['files'][rel] for rel in files if rel in index['files']}
+		else:
+			todo = {rel: entry for rel, entry in index['files'].items() if not self.current(dest, rel, entry)}
+		_log.info('%s: restoring %s of %s files from %s'%(dest, len(todo), len(index['files']), bucket))
+		large = [rel for rel, entry in todo.items() if entry[2] is None]
+		if large:
+			results.append(await self.download('%s/files'%bucket, dest, files = large, tuning = tuning))
+		by_pack = {}
+		for rel, entry in todo.items():
+			if entry[2] is not None:
+				by_pack.setdefault(entry[2], []).append((rel, entry))
+		slots = asyncio.Semaphore(max(1, int(self.option('transfers'))))
+
+		async def _fetch(pid, wanted):
+			wanted.sort(key = lambda item: item[1][3])
+			async with slots:
+				if files is not None:
+					# Only read the span holding the requested files
+					start = wanted[0][1][3]
+					end = wanted[-1][1][3] + wanted[-1][1][0]
+					result, _ = await directory._cat_async('%s/%s'%(bucket, pack_path(pid)),
+									self._unpack(dest, wanted, start), offset = start, count = end - start)
+				else:
+					result, _ = await directory._cat_async('%s/%s'%(bucket, pack_path(pid)), self._unpack(dest, wanted))
+				return result
+
+		results += await asyncio.gather(*[_fetch(pid, wanted) for pid, wanted in by_pack.items()])
+		return merge(dest, results)
@@ -0,0 +1,110 @@
+import heapq
+import time
+
+from . import tuning
+from .log import Log
+
+_log = Log('plan')
+
+class Plan:
+	'''
+		What pushing one directory is expected to send, found without starting rclone
+
+		Upload and deletes come from diffing the tree against its manifest, so they are
+		what a push would hand rclone. Without a manifest there is nothing to diff,
+		the whole tree is counted as upload and `exact` is False.
+		`speed` is the bytes/s of the directory's recent backups, None if it has none.
+	'''
+	def __init__(self, directory, full = False):
+		self.path = directory.name
+		self.bucket = directory.bucket
+		self.mode = directory.mode
+		self.full = full
+		self.exact = True
+		self.files = 0
+		self.bytes = 0
+		self.deletes = None
+		self.speed = None
+		self.guessed = False
+		self.eta = None
+		self.scanned = None
+		self.elapsed = 0.0
+
+	def __repr__(self):
+		return 'Plan(path=%s, files=%s, bytes=%s, deletes=%s, eta=%s)'%(self.path, self.files, self.bytes, self.deletes, self.eta)
+
+	@property
+	def skipped(self):
+		'''True if the push would find nothing to do'''
+		return self.exact and not self.full and not self.files and not self.deletes
+
+	def as_dict(self):
+		return dict(
+				path = self.path,
+				bucket = self.bucket,
+				mode = self.mode,
+				full = self.full,
+				exact = self.exact,
+				skipped = self.skipped,
+				files = self.files,
+				bytes = self.bytes,
+				deletes = self.deletes,
+				speed = self.speed,
+				guessed = self.guessed,
+				eta = self.eta,
+				scanned = self.scanned.as_dict() if self.scanned is not None else None,
+				elapsed = self.elapsed)
+
+def estimate(directory, full = False):
+	'''Plan a push of `directory`, blocking while its tree is walked'''
+	started = time.monotonic()
+	plan = Plan(directory, full or directory.full_sync_due)
+	manifest = directory.manifest
+	if manifest is None:
+		plan.exact = False
+		plan.scanned = directory.scan()
+		plan.files, plan.bytes = plan.scanned.files, plan.scanned.bytes
+	else:
+		changes = manifest.diff()
+		current = manifest.current
+		upload = changes.added + changes.modified
+		plan.files = len(upload)
+		plan.bytes = sum(current[rel].size for rel in upload)
+		plan.deletes = len(changes.deleted)
+		plan.scanned = manifest.totals
+	plan.speed = tuning.profile(manifest, directory.history).speed
+	plan.elapsed = time.monotonic() - started
+	_log.debug('Planned %s in %.1fs: %s'%(directory.name, plan.elapsed, plan))
+	return plan
+
+def schedule(plans, workers = 1, limit = None):
+	'''
+		Fill in the ETA of every plan and return the wall time of pushing them all, None if it can't be told
+
+		Directories start in the order given, `workers` at a time, as the Scheduler runs them.
+		Those without a recorded speed borrow the average of the others, and none
+		goes faster than `limit`, the run's bandwidth limit in bytes/s if there is one.
+	'''
+	known = [p.speed for p in plans if p.speed]
+	fallback = sum(known) / len(known) if known else None
+	for plan in plans:
+		speed = plan.speed if plan.speed else fallback
+		plan.guessed = not plan.speed and bool(plan.bytes)
+		if limit and speed:
+			speed = min(speed, limit)
+		if not plan.bytes:
+			plan.eta = 0.0
+		elif speed:
+			plan.eta = plan.bytes / speed
+		else:
+			plan.eta = None
+	if any(plan.eta is None for plan in plans):
+		return None
+	finishing = [0.0] * max(1, int(workers))
+	for plan in plans:
+		heapq.heappush(finishing, heapq.heappop(finishing) + plan.eta)
+	total = max(finishing)
+	if limit:
+		# However the directories overlap they share the one limit
+		total = max(total, sum(plan.bytes for plan in plans) / limit)
+	return total
@@ -0,0 +1,128 @@
+import asyncio
+import shlex
+
+from .conf import config
+from .log import Log
+from .util import convert_delta
+
+_log = Log('rclone.process')
+
+class WatchedProcess:
+	"""
+		A light wrapper around an asyncio subprocess
+
+		all args are passed through to asyncio.create_subprocess_exec
+
+		additional keyword arguments
+			on_exit
+			on_error
+		These should contain a callable object taking 1 arguement return_code
+		on_exit will always be called when the process exits
+		on_error will be called when the process exits with return_code != 0
+
+			on_output
+		A callable taking 1 arguement, called with each decoded line
+		the process writes to stderr as soon as it is written
+
+			timeout
+		Seconds the process may run for before it is terminated, None to wait forever
+			grace
+		Seconds to wait after SIGTERM before resorting to SIGKILL
+
+		Many processes can be driven from a single event loop,
+		cancelling a task waiting on one terminates the child.
+	"""
+
+	def __init__(self, *args, on_exit = None, on_error = None, on_output = None, timeout = None, grace = None, **kwargs):
+		self._proc = None
+		self._reader = None
+		self._on_output = on_output
+		self._args = args
+		self._kwargs = kwargs
+		self._on_exit = on_exit
+		self._on_error = on_error
+		self._timeout = timeout
+		self._grace = grace if grace is not None else convert_delta(config.kill_grace).total_seconds()
+
+	def __call__(self):
+		"""for convenience return the asyncio Process object when called"""
+		return self._proc
+
+	async def start(self):
+		if self._on_output:
+			self._kwargs['stderr'] = asyncio.subprocess.PIPE
+			self._kwargs.setdefault('limit', 1024 * 1024)
+		self._proc = await asyncio.create_subprocess_exec(*self._args, **self._kwargs)
+		if self._on_output:
+			self._reader = asyncio.ensure_future(self._read(self._proc.stderr))
+		return self
+
+	async def _read(self, stream):
+		while True:
+			line = await stream.readline()
+			if not line:
+				break
+			try:
+				self._on_output(line.decode('utf-8', 'replace'))
+			except Exception:
+				_log.exception('Error handling output of process %s'%self._proc.pid)
+
+	async def wait(self):
+		if self._proc is None:
+			return None
+		if self._proc.returncode is not None:
+			return self._proc.returncode
+		try:
+			rc = await asyncio.wait_for(self._proc.wait(), self._timeout)
+		except asyncio.TimeoutError:
+			_log.error('Process %s timed out after %ss, terminating'%(self._proc.pid, self._timeout))
+			rc = await self.terminate()
+		except asyncio.CancelledError:
+			_log.warning('Process %s cancelled, terminating'%self._proc.pid)
+			await self.terminate()
+			if self._reader:
+				self._reader.cancel()
+			raise
+		if self._reader:
+			await self._reader
+		if self._on_exit:
+			self._on_exit(rc)
+		if self._on_error and rc != 0:
+			self._on_error(rc)
+		return rc
+
+	async def terminate(self):
+		'''Ask the process to stop, killing it if it is still running after the grace period'''
+		if self._proc is None or self._proc.returncode is not None:
+			return self._proc.returncode if self._proc else None
+		try:
+			self._proc.terminate()
+			return await asyncio.wait_for(self._proc.wait(), self._grace)
+		except ProcessLookupError:
+			pass
+		except asyncio.TimeoutError:
+			_log.error('Process %s ignored SIGTERM, killing'%self._proc.pid)
+			self.kill()
+		return await self._proc.wait()
+
+	def kill(self):
+		try:
+			self._proc.kill()
+		except ProcessLookupError:
+			pass
+
+	@property
+	def status(self):
+		if self._proc:
+			return self._proc.returncode
+
+
+async def WatchProcess(cmd, start = True, **kwargs):
+	_log.debug('Creating watched process, "%s"'%cmd)
+	if 'timeout' not in kwargs and config.timeout:
+		kwargs['timeout'] = convert_delta(config.timeout).total_seconds()
+	wp = WatchedProcess(*shlex.split(cmd), **kwargs)
+	if start:
+		_log.debug("Starting process...")
+		await wp.start()
+	return wp
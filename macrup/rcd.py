@@ -0,0 +1,317 @@
+import contextvars
+import json
+import queue
+import secrets
+import time
+
+from .bandwidth import basic_auth, format_rate, rc_auth, serving_port
+from .conf import config
+from .log import Log
+from .util import convert_delta
+
+_log = Log('rcd')
+
+# The rclone rcd serving the current run, set by the Scheduler or the daemon
+active = contextvars.ContextVar('rclone_rcd', default = None)
+
+# rclone flag -> (type of its value or None for a switch, where it goes in an rc call, name there)
+FLAGS = {
+	'--transfers': (int, '_config', 'Transfers'),
+	'--checkers': (int, '_config', 'Checkers'),
+	'--fast-list': (None, '_config', 'UseListR'),
+	'--checksum': (None, '_config', 'CheckSum'),
+	'--dry-run': (None, '_config', 'DryRun'),
+	'--no-traverse': (None, '_config', 'NoTraverse'),
+	'--ignore-existing': (None, '_config', 'IgnoreExisting'),
+	'--backup-dir': (str, '_config', 'BackupDir'),
+	'--exclude': (str, '_filter', 'ExcludeRule'),
+	'--exclude-from': (str, '_filter', 'ExcludeFrom'),
+	'--files-from-raw': (str, '_filter', 'FilesFromRaw'),
+	'--b2-chunk-size': (str, 'backend', 'chunk_size'),
+	'--b2-upload-cutoff': (str, 'backend', 'upload_cutoff'),
+}
+
+# Flags that only matter to a forked rclone, or that the rcd applies to every job itself
+# A --bwlimit of its own can't be, the rcd has one limit for all its jobs
+IGNORED = {'-v': None, '--use-json-log': None, '--auto-confirm': None, '--stats': str}
+
+# Commands that map onto an rc call taking a source and a destination
+COMMANDS = {'sync': 'sync/sync', 'copy': 'sync/copy', 'copyto': 'operations/copyfile'}
+
+# rclone exit code for a job that failed, error not otherwise categorised, so it is retried
+JOB_FAILED = 2
+
+class RcError(Exception):
+	def __init__(self, message, status = None):
+		super().__init__(message)
+		# The HTTP status rclone answered with, None if it never answered
+		self.status = status
+
+def _with_backend(fs, options):
+	'''Add backend options to a remote as a connection string, eg. b2:bucket -> b2,chunk_size=96M:bucket'''
+	if not options or ':' not in fs or fs.startswith('/'):
+		return fs
+	remote, _, path = fs.partition(':')
+	return '%s,%s:%s'%(remote, ','.join('%s=%s'%(k, v) for k, v in sorted(options.items())), path)
+
+def _split(path):
+	'''remote:dir/name -> (remote:dir, name), also for local paths'''
+	prefix, rest = '', path
+	if ':' in path and not path.startswith('/'):
+		remote, _, rest = path.partition(':')
+		prefix = remote + ':'
+	head, _, name = rest.rpartition('/')
+	if not head:
+		head = '/' if rest.startswith('/') else '' if prefix else '.'
+	return prefix + head, name
+
+def translate(argv):
+	'''
+		Turn an rclone command line, without the binary, into (rc method, params)
+		None if it uses a command or flag the rc API can't express
+	'''
+	params = {'_config': {}, '_filter': {}}
+	backend = {}
+	positional = []
+	args = iter(argv)
+	for arg in args:
+		if not arg.startswith('-'):
+			positional.append(arg)
+		elif arg in FLAGS:
+			kind, where, name = FLAGS[arg]
+			value = True if kind is None else kind(next(args))
+			if where == 'backend':
+				backend[name] = value
+			elif where == '_filter':
+				params['_filter'].setdefault(name, []).append(value)
+			else:
+				params[where][name] = value
+		elif arg in IGNORED:
+			if IGNORED[arg] is not None:
+				next(args)
+		else:
+			return None
+	if len(positional) != 3 or positional[0] not in COMMANDS:
+		return None
+	command, src, dst = positional
+	if command == 'copyto':
+		# A single file, named by the directory holding it and its name in there
+		(src, params['srcRemote']), (dst, params['dstRemote']) = _split(src), _split(dst)
+	params.update(srcFs = _with_backend(src, backend), dstFs = _with_backend(dst, backend))
+	if 'BackupDir' in params['_config']:
+		# rclone only moves server side within what it sees as the same remote
+		params['_config']['BackupDir'] = _with_backend(params['_config']['BackupDir'], backend)
+	return COMMANDS[command], {k: v for k, v in params.items() if v != {}}
+
+class RemoteControl:
+	'''
+		A long lived `rclone rcd` that syncs are submitted to over its HTTP API
+
+		Starting rclone once per run, or once for the whole life of the daemon,
+		saves re-reading its config and authorising with B2 for every directory.
+		Calls go over a small pool of keep-alive connections, each sync is
+		an async job whose status and stats are polled until it finishes.
+		rclone picks its own port, and its random login only travels in its environment.
+
+		With a `budget` the rcd takes part in it like any forked rclone, as one transfer
+		whose limit covers all of its jobs, so it follows --bwlimit and the schedule too.
+	'''
+	def __init__(self, rclone = None, budget = None):
+		self._rclone = rclone if rclone else config.rclone
+		self._budget = budget if budget is not None and budget.enabled else None
+		self._transfer = None
+		self._port = None
+		self._user = 'macrup'
+		self._password = secrets.token_hex(16)
+		self._pool = queue.LifoQueue()
+		self._proc = None
+
+	def __repr__(self):
+		return 'RemoteControl(port=%s)'%self._port
+
+	@property
+	def running(self):
+		return self._proc is not None and self._proc.status is None
+
+	def _connection(self):
+		import http.client
+		if self._port is None:
+			raise RcError('rclone rcd is not listening yet')
+		try:
+			return self._pool.get_nowait()
+		except queue.Empty:
+			return http.client.HTTPConnection('127.0.0.1', self._port, timeout = 60)
+
+	def _observe(self, line):
+		_log.debug(line.strip())
+		port = serving_port(line)
+		if port is not None:
+			self._port = port
+		if self._transfer is not None:
+			self._budget.observe(self._transfer, line)
+
+	def call_sync(self, method, **params):
+		'''POST to an rc method and return the decoded reply, blocking'''
+		conn = self._connection()
+		try:
+			conn.request('POST', '/%s'%method, body = json.dumps(params),
+						headers = {'Content-Type': 'application/json', 'Authorization': basic_auth(self._user, self._password)})
+			response = conn.getresponse()
+			body = response.read()
+		except Exception:
+			conn.close()
+			raise
+		self._pool.put(conn)
+		try:
+			reply = json.loads(body.decode('utf-8')) if body else {}
+		except ValueError:
+			raise RcError('%s returned something that is not JSON'%method)
+		if response.status != 200:
+			raise RcError('%s failed: %s'%(method, reply.get('error', response.status)), response.status)
+		return reply
+
+	async def call(self, method, **params):
+		import asyncio
+		return await asyncio.get_running_loop().run_in_executor(None, lambda: self.call_sync(method, **params))
+
+	async def start(self):
+		'''Start the rcd and wait for it to answer, False if it never does'''
+		import asyncio
+		import os
+		from .process import WatchProcess
+		self._port = None
+		cmd = "%s rcd -v --use-json-log --rc-addr 127.0.0.1:0"%self._rclone
+		if self._budget is not None:
+			self._transfer = self._budget.join('rclone rcd', self._password)
+			cmd += " --bwlimit '%s'"%format_rate(self._transfer.rate)
+		# It outlives any single sync, the per process timeout applies to jobs instead
+		try:
+			self._proc = await WatchProcess(cmd, on_output = self._observe, timeout = None,
+											env = dict(os.environ, **rc_auth(self._user, self._password)))
+		except BaseException:
+			await self.stop()
+			raise
+		deadline = time.monotonic() + convert_delta(config.rcd_start_timeout).total_seconds()
+		while time.monotonic() < deadline:
+			if not self.running:
+				break
+			try:
+				await self.call('rc/noop')
+			except (OSError, RcError):
+				await asyncio.sleep(0.1)
+				continue
+			_log.info('rclone rcd is listening on 127.0.0.1:%s'%self._port)
+			return True
+		_log.error('rclone rcd did not start, running rclone once per sync instead')
+		await self.stop()
+		return False
+
+	async def stop(self):
+		if self._transfer is not None:
+			transfer, self._transfer = self._transfer, None
+			await self._budget.leave(transfer)
+		if self._proc is None:
+			return
+		if self.running:
+			try:
+				await self.call('core/quit')
+			except (OSError, RcError):
+				pass
+			await self._proc.terminate()
+		while not self._pool.empty():
+			self._pool.get_nowait().close()
+		self._proc = None
+
+	async def __aenter__(self):
+		return self if await self.start() else None
+
+	async def __aexit__(self, *args):
+		await self.stop()
+
+	async def mkdir(self, fs):
+		'''Exit code of `rclone mkdir fs`'''
+		try:
+			await self.call('operations/mkdir', fs = fs, remote = '')
+		except (OSError, RcError) as e:
+			_log.error('Unable to create %s: %s'%(fs, e))
+			return JOB_FAILED
+		return 0
+
+	async def size(self, fs):
+		'''What `rclone size --json fs` prints, None if it fails'''
+		try:
+			reply = await self.call('operations/size', fs = fs)
+		except (OSError, RcError) as e:
+			_log.debug('Unable to size %s: %s'%(fs, e))
+			return None
+		return dict(count = reply['count'], bytes = reply['bytes'])
+
+	async def lsf(self, fs, extra, missing_ok = False):
+		'''
+			What `rclone lsf` prints for fs, as a list of lines, None if it fails
+			Returns False if `extra` holds flags other than -R, --files-only and --dirs-only
+			With `missing_ok` an fs that doesn't exist yet lists as empty
+		'''
+		flags = extra.split()
+		if not set(flags) <= {'-R', '--files-only', '--dirs-only'}:
+			return False
+		opt = dict(recurse = '-R' in flags, filesOnly = '--files-only' in flags, dirsOnly = '--dirs-only' in flags)
+		try:
+			reply = await self.call('operations/list', fs = fs, remote = '', opt = opt)
+		except RcError as e:
+			# rclone answers 404 for a directory that isn't there
+			if missing_ok and e.status == 404:
+				return []
+			_log.error('Unable to list %s: %s'%(fs, e))
+			return None
+		except OSError as e:
+			_log.error('Unable to list %s: %s'%(fs, e))
+			return None
+		return [item['Path'] + ('/' if item['IsDir'] else '') for item in reply.get('list') or []]
+
+	async def run_job(self, method, params, stats):
+		'''
+			Run an rc method as an async job, feeding its progress into `stats`
+			Returns the rclone exit code it stands in for
+		'''
+		import asyncio
+		poll = float(config.rcd_poll)
+		report = convert_delta(config.stats_interval).total_seconds()
+		timeout = convert_delta(config.timeout).total_seconds() if config.timeout else None
+		try:
+			jobid = (await self.call(method, _async = True, **params))['jobid']
+		except (OSError, RcError) as e:
+			_log.error('Unable to start %s: %s'%(method, e))
+			return JOB_FAILED
+		started = time.monotonic()
+		reported = started
+		try:
+			while True:
+				await asyncio.sleep(poll)
+				status = await self.call('job/status', jobid = jobid)
+				finished = status.get('finished')
+				now = time.monotonic()
+				if finished or now - reported >= report:
+					stats.update(await self.call('core/stats', group = 'job/%s'%jobid), report = not finished)
+					reported = now
+				if finished:
+					break
+				if timeout is not None and now - started > timeout:
+					_log.error('Job %s timed out after %ss, stopping'%(jobid, timeout))
+					await self.call('job/stop', jobid = jobid)
+					return JOB_FAILED
+		except asyncio.CancelledError:
+			_log.warning('Job %s cancelled, stopping'%jobid)
+			try:
+				await self.call('job/stop', jobid = jobid)
+			except (OSError, RcError):
+				pass
+			raise
+		except (OSError, RcError) as e:
+			_log.error('Lost track of job %s: %s'%(jobid, e))
+			return JOB_FAILED
+		if not status.get('success'):
+			stats.last_error = status.get('error')
+			_log.error('%s: %s'%(stats.name, status.get('error')))
+			return JOB_FAILED
+		return 0
@@ -1,13 +1,18 @@
+import os
 import shlex
-import subprocess
-import urllib.request
-from threading import Event, Thread
+import tempfile
 
+from . import rcd
 from .conf import config
+from .excludes import compile_rules
 from .log import Log
+from .stats import SyncResult, TransferStats
 
 _log = Log('rclone.process')
 
+# rclone's exit code when the path it was given doesn't exist
+DIRECTORY_NOT_FOUND = 3
+
 
 
 
@@ -19,99 +24,280 @@ class RClone:
 		self._remote = remote
 		self._dry_run = dry_run
 
-	def _build_excludes(self, *args):
-		return ' '.join(["--exclude '%s'"%ex for ex in args])
-
+	# asyncio and the process engine are imported on first use,
+	# commands like `ls` never start a process and shouldn't pay for them
 	def _mkdir(self, bucket):
-		cmd = '/usr/bin/rclone mkdir %s:%s'%(self._remote, bucket)
-		proc = WatchProcess(cmd)
-		return proc.wait()
+		import asyncio
+		return asyncio.run(self._mkdir_async(bucket))
+
+	async def _mkdir_async(self, bucket):
+		from .process import WatchProcess
+		control = rcd.active.get()
+		if control is not None:
+			return await control.mkdir('%s:%s'%(self._remote, bucket))
+		cmd = '%s mkdir %s:%s'%(config.rclone, self._remote, bucket)
+		proc = await WatchProcess(cmd)
+		return await proc.wait()
+
+	async def _size_async(self, bucket):
+		'''Object count and total bytes stored in a bucket, None if rclone fails'''
+		import asyncio
+		import json
+		from .process import WatchProcess
+		control = rcd.active.get()
+		if control is not None:
+			return await control.size('%s:%s'%(self._remote, bucket))
+		cmd = '%s size --json %s:%s'%(config.rclone, self._remote, bucket)
+		proc = await WatchProcess(cmd, stdout = asyncio.subprocess.PIPE)
+		output = await proc().stdout.read()
+		if await proc.wait() != 0:
+			return None
+		try:
+			return json.loads(output.decode('utf-8'))
+		except ValueError:
+			_log.error('Unable to parse the size of %s:%s'%(self._remote, bucket))
+			return None
+
+	async def _lsf_async(self, path, extra = '-R --files-only', missing_ok = False):
+		'''
+			Relative paths of every file under remote:path, None if rclone fails
+			With `missing_ok` a path that doesn't exist yet lists as empty
+		'''
+		import asyncio
+		from .process import WatchProcess
+		control = rcd.active.get()
+		if control is not None:
+			listing = await control.lsf('%s:%s'%(self._remote, path), extra, missing_ok)
+			if listing is not False:
+				return listing
+		cmd = '%s lsf %s %s:%s'%(config.rclone, extra, self._remote, path)
+		proc = await WatchProcess(cmd, stdout = asyncio.subprocess.PIPE)
+		output = await proc().stdout.read()
+		rc = await proc.wait()
+		if rc == DIRECTORY_NOT_FOUND and missing_ok:
+			return []
+		if rc != 0:
+			_log.error('Unable to list %s:%s'%(self._remote, path))
+			return None
+		return [line for line in output.decode('utf-8').split('\n') if line]
+
+	async def _command_async(self, command, *paths, extra = ''):
+		'''Run an rclone command taking remote paths, eg. move, purge or deletefile, returns its exit code'''
+		from .process import WatchProcess
+		dry_run = '--dry-run' if self._dry_run else ''
+		remotes = ' '.join("'%s:%s'"%(self._remote, path) for path in paths)
+		cmd = '%s %s %s %s %s'%(config.rclone, dry_run, extra, command, remotes)
+		_log.debug('Using command "%s"'%cmd)
+		proc = await WatchProcess(cmd)
+		rc = await proc.wait()
+		if rc != 0:
+			_log.error('rclone %s exited with %s, using cmd %s'%(command, rc, cmd))
+		return rc
 
-	def _sync(self, src, dest, excludes = [], verbose = True):
-		flags = '-v --fast-list --checksum --auto-confirm'
+	async def _delete_async(self, path, files):
+		'''Delete `files`, relative to remote:path'''
+		from .process import WatchProcess
+		if not files:
+			return 0
+		files_from = self._write_files_from(files)
 		dry_run = '--dry-run' if self._dry_run else ''
-		cmd = '/usr/bin/rclone %s %s %s sync %s %s'%(flags, dry_run, self._build_excludes(*excludes), src, dest)
+		cmd = "%s delete %s --files-from-raw '%s' %s:%s"%(config.rclone, dry_run, files_from, self._remote, path)
+		try:
+			proc = await WatchProcess(cmd)
+			return await proc.wait()
+		finally:
+			os.remove(files_from)
+
+	async def _rcat_async(self, path, produce):
+		'''
+			Stream into remote:path with rclone rcat
+			`produce` is called on an executor thread with a binary file to write the content to,
+			if it raises rclone is killed before the object is stored and a failed SyncResult returned
+		'''
+		import asyncio
+		from .process import WatchProcess
+		stats = TransferStats(path)
+		cmd = '%s -v --use-json-log rcat %s:%s'%(config.rclone, self._remote, path)
+		if self._dry_run:
+			_log.info('Not streaming to %s:%s during a dry run'%(self._remote, path))
+			return SyncResult(True, stats = stats, rc = 0)
+		read_fd, write_fd = os.pipe()
+		try:
+			proc = await WatchProcess(cmd, stdin = read_fd, on_output = stats.feed)
+		except BaseException:
+			os.close(write_fd)
+			raise
+		finally:
+			os.close(read_fd)
+
+		out = os.fdopen(write_fd, 'wb')
+
+		def _write():
+			produce(out)
+			# rclone commits the object on EOF, so only a complete stream may ever be closed
+			out.close()
+
+		def _abandon():
+			try:
+				out.close()
+			except OSError:
+				pass
+
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, _write)
+		except BrokenPipeError:
+			# rclone went away, its exit code says why
+			_abandon()
+		except BaseException as e:
+			# Kill rclone before it can see EOF and store a truncated object over the last good one
+			proc.kill()
+			await proc.wait()
+			_abandon()
+			if not isinstance(e, Exception):
+				raise
+			_log.error('Unable to stream to %s:%s: %s'%(self._remote, path, e))
+			return SyncResult(False, stats = stats, rc = rcd.JOB_FAILED)
+		rc = await proc.wait()
+		if rc != 0:
+			_log.error('rclone rcat to %s:%s exited with %s'%(self._remote, path, rc))
+		return SyncResult(rc == 0, stats = stats, rc = rc)
+
+	async def _cat_async(self, path, consume, offset = None, count = None):
+		'''
+			Stream remote:path, or `count` bytes of it from `offset`, out of rclone cat
+			`consume` is called on an executor thread with a binary file to read the content from
+		'''
+		import asyncio
+		from .process import WatchProcess
+		stats = TransferStats(path)
+		window = ''
+		if offset is not None:
+			window += ' --offset %d'%offset
+		if count is not None:
+			window += ' --count %d'%count
+		cmd = '%s -v --use-json-log cat%s %s:%s'%(config.rclone, window, self._remote, path)
+		read_fd, write_fd = os.pipe()
+		try:
+			proc = await WatchProcess(cmd, stdout = write_fd, on_output = stats.feed)
+		except BaseException:
+			os.close(read_fd)
+			raise
+		finally:
+			os.close(write_fd)
+
+		def _read():
+			with os.fdopen(read_fd, 'rb') as stream:
+				return consume(stream)
+
+		try:
+			consumed = await asyncio.get_running_loop().run_in_executor(None, _read)
+		except BaseException:
+			await proc.terminate()
+			raise
+		rc = await proc.wait()
+		if rc != 0:
+			_log.error('rclone cat of %s:%s exited with %s'%(self._remote, path, rc))
+		return SyncResult(rc == 0, stats = stats, rc = rc), consumed
+
+	def _write_files_from(self, files):
+		fd, path = tempfile.mkstemp(prefix = 'macrup-', suffix = '.files')
+		with os.fdopen(fd, 'w') as files_from:
+			for f in files:
+				files_from.write(f + '\n')
+		return path
+
+	def _sync(self, src, dest, excludes = [], verbose = True, files = None, tuning = None):
+		import asyncio
+		return asyncio.run(self._sync_async(src, dest, excludes, verbose, files, tuning))
+
+	async def _sync_async(self, src, dest, excludes = [], verbose = True, files = None, tuning = None, command = 'sync', extra = '', checksum = True):
+		'''
+			Sync src to dest
+
+			If `files` is given only those paths, relative to src, are considered.
+			Listed paths missing from src are deleted from dest.
+			`tuning` holds transfer flags picked for this directory, see macrup.tuning
+			`command` may be copy or copyto to transfer without deleting anything,
+			`extra` is added to the command line as is
+			`excludes` are patterns or ExcludeRules, handed to rclone in an --exclude-from file
+			Without `checksum` files are compared by size and mtime, rather than hashing both sides
+		'''
+		from . import bandwidth
+		from .process import WatchProcess
+		tuning = tuning if tuning is not None else '--fast-list'
+		flags = '-v --use-json-log --stats %s %s%s --auto-confirm'%(config.stats_interval, tuning, ' --checksum' if checksum else '')
+		dry_run = '--dry-run' if self._dry_run else ''
+		files_from = exclude_from = None
+		filters = ''
+		if files is not None:
+			# The list is already filtered, rclone refuses to mix it with other filters
+			files_from = self._write_files_from(files)
+			filters = "--files-from-raw '%s'"%files_from
+		elif excludes:
+			exclude_from = compile_rules(excludes).write()
+			filters = "--exclude-from '%s'"%exclude_from
+		stats = TransferStats(src if dest.startswith('%s:'%self._remote) else dest)
+		_build = lambda flags: '%s %s %s %s %s %s %s %s'%(config.rclone, flags, dry_run, filters, extra, command, src, dest)
+		cmd = _build(flags)
+		# Handed to the run's rclone rcd if there is one and it can express the command
+		control = rcd.active.get()
+		job = rcd.translate(shlex.split(cmd)[1:]) if control is not None else None
+		budget = bandwidth.active.get()
+		transfer = None
+		if job is None and budget is not None and budget.enabled:
+			# Comes after any per directory --bwlimit so the run budget wins
+			transfer = budget.join(stats.name)
+			cmd = _build('%s %s'%(flags, transfer.flags))
+		verb = 'Syncing' if command == 'sync' else 'Copying'
 
 		def _on_exit(rc):
 			if rc == 0:
-				_log.info('Done Syncing')
+				_log.info('Done %s %s to %s'%(verb, src, dest))
 
 		def _on_error(rc):
 			_log.error('rclone exited with %s, using cmd %s'%(rc, cmd))
 
-		_log.info('Syncing %s to %s'%(src, dest))
-		_log.debug('Using command "%s"'%cmd)
-		proc = WatchProcess(cmd, on_exit = _on_exit, on_error = _on_error)
-		proc.wait()
-		return proc.wait() == 0
-
-	def _push(self, local, bucket, excludes = []):
-		return self._sync(local, '%s:%s'%(self._remote, bucket), excludes)
-
-	def _pull(self, local, bucket, excludes = []):
-		return self._sync('%s:%s'%(self._remote, bucket), local, excludes)
-
-
-
-class WatchedProcess(Thread):
-	"""
-		A light wrapper around a Popen object
-
-		all args are passed through to the Popen constructor
-
-		2 additional keyword arguments are added
-			on_exit
-			on_error
-		These should contain a callable object taking 1 arguement return_code
-		on_exit will always be called when the process exits
-		on_error will be called when the process exits with return_code != 0
-	"""
-
-	def __init__(self, *args, on_exit = None, on_error = None, **kwargs):
-		super().__init__()
-		self.daemon = True
-		self._proc = None
-		self._started = Event()
-		self._args = args
-		self._kwargs = kwargs
-		self._on_exit = on_exit
-		self._on_error = on_error
-		self._proc = subprocess.Popen(*self._args, **self._kwargs)
-
-	def __call__(self):
-		"""for convenience return the popen object when called"""
-		return self._proc
-
-	def run(self):
-		self._started.set()
-		self._proc.wait()
-		rc = self._proc.returncode
-		if self._on_exit:
-			self._on_exit(rc)
-		if self._on_error and rc != 0:
-			self._on_error(rc)
-
-	def terminate(self):
-		return self._proc.terminate()
-
-	def kill(self):
-		return self._proc.kill()
-
-	@property
-	def status(self):
-		if self._proc:
-			return self._proc.poll()
-
-	def wait(self):
-		self._started.wait()
-		# print(self._proc)
-		return self._proc.wait() if self._proc else None
-
-
-def WatchProcess(cmd, start = True, **kwargs):
-	_log.debug('Creating watched process, "%s"'%cmd)
-	wp = WatchedProcess(shlex.split(cmd), **kwargs)
-	if start:
-		_log.debug("Starting process...")
-		wp.start()
-	return wp
+		_log.info('%s %s to %s'%(verb, src, dest))
+		_log.debug('Using command "%s"%s'%(cmd, ' through rclone rcd' if job is not None else ''))
+		try:
+			if job is not None:
+				rc = await control.run_job(*job, stats)
+				_on_exit(rc)
+				if rc != 0:
+					_on_error(rc)
+			else:
+				if transfer is not None:
+					def _on_output(line):
+						budget.observe(transfer, line)
+						stats.feed(line)
+
+					proc = await WatchProcess(cmd, on_exit = _on_exit, on_error = _on_error, on_output = _on_output, env = transfer.env)
+				else:
+					proc = await WatchProcess(cmd, on_exit = _on_exit, on_error = _on_error, on_output = stats.feed)
+				if transfer is not None:
+					await budget.rebalance()
+				rc = await proc.wait()
+			_log.info('%s: %s'%(stats.name, stats.summary()))
+			return SyncResult(rc == 0, stats = stats, rc = rc)
+		finally:
+			if files_from is not None:
+				os.remove(files_from)
+			if exclude_from is not None:
+				os.remove(exclude_from)
+			if transfer is not None:
+				await budget.leave(transfer)
+
+	def _push(self, local, bucket, excludes = [], files = None, tuning = None):
+		import asyncio
+		return asyncio.run(self._push_async(local, bucket, excludes, files, tuning))
+
+	def _pull(self, local, bucket, excludes = [], tuning = None):
+		import asyncio
+		return asyncio.run(self._pull_async(local, bucket, excludes, tuning))
+
+	async def _push_async(self, local, bucket, excludes = [], files = None, tuning = None, extra = '', checksum = True):
+		return await self._sync_async(local, '%s:%s'%(self._remote, bucket), excludes, files = files, tuning = tuning,
+						extra = extra, checksum = checksum)
+
+	async def _pull_async(self, local, bucket, excludes = [], tuning = None):
+		return await self._sync_async('%s:%s'%(self._remote, bucket), local, excludes, tuning = tuning)
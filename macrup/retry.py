@@ -0,0 +1,98 @@
+import contextvars
+import random
+
+from .log import Log
+from .util import convert_delta
+
+_log = Log('retry')
+
+# The Scheduler's worker slot the current task holds, given up while waiting to retry
+slot = contextvars.ContextVar('retry_slot', default = None)
+
+# rclone exit codes, see https://rclone.org/docs/#exit-code
+EXIT_CODES = {
+	1: 'syntax or usage error',
+	2: 'error not otherwise categorised',
+	3: 'directory not found',
+	4: 'file not found',
+	5: 'temporary error',
+	6: 'less serious errors',
+	7: 'fatal error',
+	8: 'transfer exceeded',
+	9: 'no files transferred',
+	10: 'duration exceeded',
+}
+
+# Worth another go, usually B2 returning 5xx or a connection dropping mid transfer
+RETRYABLE = {2, 5}
+
+def describe(rc):
+	if rc is None:
+		return 'did not start'
+	if rc < 0:
+		return 'killed by signal %s'%-rc
+	return EXIT_CODES.get(rc, 'unknown exit code')
+
+def retryable(result):
+	'''Whether a failed SyncResult might succeed if run again'''
+	return result.rc in RETRYABLE
+
+class RetryPolicy:
+	'''
+		How often and how soon a failed sync is run again within the same run
+
+		The wait doubles after every attempt up to `max_backoff`, and up to
+		`jitter` of it is taken off at random so parallel directories that
+		failed together don't all hit B2 again at the same moment
+	'''
+	def __init__(self, attempts = 1, backoff = '30s', max_backoff = '10m', jitter = 0.5):
+		self.attempts = max(1, int(attempts))
+		self.backoff = convert_delta(backoff).total_seconds()
+		self.max_backoff = convert_delta(max_backoff).total_seconds()
+		self.jitter = jitter
+
+	def __repr__(self):
+		return 'RetryPolicy(attempts=%s, backoff=%s, max_backoff=%s)'%(self.attempts, self.backoff, self.max_backoff)
+
+	def delay(self, attempt):
+		'''Seconds to wait after `attempt`, counting from 1, has failed'''
+		delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+		return delay * (1 - self.jitter * random.random())
+
+	async def run(self, name, sync):
+		'''
+			Await `sync()` until it succeeds, fails with a fatal exit code
+			or runs out of attempts, returning the last SyncResult
+		'''
+		import asyncio
+		attempt = 1
+		while True:
+			result = await sync()
+			result.attempts = attempt
+			if result or attempt >= self.attempts:
+				break
+			if not retryable(result):
+				_log.error('%s failed with exit code %s (%s), not retrying'%(name, result.rc, describe(result.rc)))
+				break
+			delay = self.delay(attempt)
+			_log.warning('%s failed with exit code %s (%s), attempt %s of %s, retrying in %ds'%(
+							name, result.rc, describe(result.rc), attempt, self.attempts, delay))
+			held = slot.get()
+			if held is None:
+				await asyncio.sleep(delay)
+			else:
+				# Let other directories run in the meantime rather than sit on a worker
+				held.release()
+				try:
+					await asyncio.sleep(delay)
+				finally:
+					await held.acquire()
+			attempt += 1
+		if not result and attempt > 1:
+			_log.error('%s failed after %s attempts'%(name, attempt))
+		return result
+
+def from_config(config, retries = None):
+	'''The configured policy, `retries` counts the attempts after the first'''
+	retries = retries if retries is not None else config.retries
+	return RetryPolicy(int(retries) + 1, config.retry_backoff, config.retry_backoff_max)
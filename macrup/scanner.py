@@ -0,0 +1,135 @@
+import os
+import os.path
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .conf import config
+from .excludes import compile_rules
+from .log import Log
+from .util import human_size
+
+_log = Log('scanner')
+
+class ScanTotals:
+	'''What a scan has found so far'''
+	def __init__(self, root = None):
+		self.root = root
+		self.files = 0
+		self.bytes = 0
+		self.dirs = 0
+		self.excluded = 0
+		self.errors = 0
+		self.elapsed = 0.0
+
+	def __repr__(self):
+		return 'ScanTotals(root=%s, files=%s, bytes=%s, dirs=%s, errors=%s)'%(self.root, self.files, self.bytes, self.dirs, self.errors)
+
+	@property
+	def rate(self):
+		'''Files scanned per second'''
+		return self.files / self.elapsed if self.elapsed else 0.0
+
+	def summary(self):
+		return '%s files, %s in %s directories, %s excluded, %s errors, %.1fs at %d files/s'%(
+					self.files, human_size(self.bytes), self.dirs, self.excluded, self.errors, self.elapsed, self.rate)
+
+	def as_dict(self):
+		return dict(
+				root = self.root,
+				files = self.files,
+				bytes = self.bytes,
+				dirs = self.dirs,
+				excluded = self.excluded,
+				errors = self.errors,
+				elapsed = self.elapsed,
+				rate = self.rate)
+
+class Scanner:
+	'''
+		Walks a tree with os.scandir on a pool of threads, one directory listing per task
+
+		scandir and stat release the GIL, so listings of a cold cache or a network
+		filesystem overlap. Excluded entries are dropped as they are listed, an
+		excluded directory is never opened. `scan` yields (relative path, stat) for
+		every regular file as soon as its directory has been listed, in no particular order.
+	'''
+	def __init__(self, root, excludes = [], workers = None):
+		self._root = root
+		self._excludes = compile_rules(excludes)
+		self._workers = max(1, int(workers if workers else config.scan_workers))
+		self._stopped = False
+		self.totals = ScanTotals(root)
+
+	def __repr__(self):
+		return 'Scanner(root=%s, workers=%s)'%(self._root, self._workers)
+
+	def excluded(self, rel, is_dir = False):
+		return self._excludes.excluded(rel, is_dir)
+
+	def _list(self, rel):
+		'''List one directory, returns (files as (rel, stat), subdirectories, excluded, errors)'''
+		files, dirs = [], []
+		excluded = errors = 0
+		if self._stopped:
+			return files, dirs, excluded, errors
+		path = os.path.join(self._root, rel)
+		try:
+			with os.scandir(path) as it:
+				listing = list(it)
+		except OSError as e:
+			_log.warning('Unable to list %s: %s'%(path, e))
+			return files, dirs, excluded, 1
+		for entry in listing:
+			entry_rel = os.path.join(rel, entry.name) if rel else entry.name
+			try:
+				is_dir = entry.is_dir(follow_symlinks = False)
+				if self.excluded(entry_rel, is_dir):
+					excluded += 1
+				elif is_dir:
+					dirs.append(entry_rel)
+				elif entry.is_file(follow_symlinks = False):
+					files.append((entry_rel, entry.stat(follow_symlinks = False)))
+			except OSError as e:
+				_log.warning('Unable to stat %s: %s'%(entry.path, e))
+				errors += 1
+		return files, dirs, excluded, errors
+
+	def scan(self):
+		totals = self.totals
+		started = time.monotonic()
+		self._stopped = False
+		done = queue.Queue()
+		pool = ThreadPoolExecutor(self._workers, thread_name_prefix = 'macrup-scan')
+
+		def _submit(rel):
+			pool.submit(self._list, rel).add_done_callback(done.put)
+
+		try:
+			_submit('')
+			pending = 1
+			while pending:
+				files, dirs, excluded, errors = done.get().result()
+				pending -= 1
+				for rel in dirs:
+					_submit(rel)
+				pending += len(dirs)
+				totals.dirs += 1
+				totals.files += len(files)
+				totals.bytes += sum(st.st_size for _, st in files)
+				totals.excluded += excluded
+				totals.errors += errors
+				totals.elapsed = time.monotonic() - started
+				yield from files
+		finally:
+			# Stopping early, eg. the consumer broke out, turns queued listings into no-ops
+			self._stopped = True
+			pool.shutdown(wait = False)
+			totals.elapsed = time.monotonic() - started
+
+def scan(root, excludes = [], workers = None):
+	'''Scan a whole tree and return its ScanTotals'''
+	scanner = Scanner(root, excludes, workers)
+	for _ in scanner.scan():
+		pass
+	return scanner.totals
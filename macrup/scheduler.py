@@ -0,0 +1,122 @@
+import asyncio
+
+from . import bandwidth
+from . import rcd
+from . import retry
+from .conf import config
+from .log import Log
+
+_log = Log('scheduler')
+
+class Scheduler:
+	'''
+		Runs push or pull for several Directory objects at once
+		with at most `workers` of them in flight
+
+		Every rclone child is driven from a single event loop
+		through its own WatchedProcess, so the on_exit/on_error
+		callbacks fire exactly as they do for a serial run
+
+		Directories are started in the order they are given,
+		see `prioritize` for putting the important ones first
+
+		A directory waiting to retry gives its slot up until its next attempt
+
+		All transfers started by one run share a BandwidthBudget,
+		`bwlimit` or the `bwlimit` config, following `bwlimit_schedule`
+
+		With `rcd` set the syncs of a run are jobs on one rclone rcd, which takes a share of the budget, see macrup.rcd
+	'''
+	# Actions that never start rclone, so have no use for an rcd
+	LOCAL = ('plan',)
+
+	def __init__(self, workers = 1, bwlimit = None):
+		self._workers = max(1, int(workers))
+		self._budget = bandwidth.BandwidthBudget(bwlimit if bwlimit else config.bwlimit, config.bwlimit_schedule)
+
+	@property
+	def workers(self):
+		return self._workers
+
+	@property
+	def budget(self):
+		return self._budget
+
+	async def _run(self, slots, directory, action, on_done, kwargs):
+		async with slots:
+			retry.slot.set(slots)
+			_log.debug('Starting %s of %s'%(action, directory.name))
+			try:
+				result = await getattr(directory, '%s_async'%action)(**kwargs)
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				_log.exception('Unhandled error during %s of %s'%(action, directory.name))
+				result = False
+			_log.debug('Finished %s of %s, success: %s'%(action, directory.name, bool(result)))
+			if on_done:
+				try:
+					on_done(directory, result)
+				except Exception:
+					_log.exception('Error handling completion of %s'%directory.name)
+			return result
+
+	async def run_async(self, directories, action = 'push', on_done = None, **kwargs):
+		directories = list(directories)
+		slots = asyncio.Semaphore(self._workers)
+		bandwidth.active.set(self._budget)
+		if config.rcd and rcd.active.get() is None and action not in self.LOCAL:
+			# One rclone rcd for the whole run, unless the daemon already keeps one
+			async with rcd.RemoteControl(budget = self._budget) as control:
+				rcd.active.set(control)
+				try:
+					results = await asyncio.gather(*[self._run(slots, d, action, on_done, kwargs) for d in directories])
+				finally:
+					rcd.active.set(None)
+		else:
+			results = await asyncio.gather(*[self._run(slots, d, action, on_done, kwargs) for d in directories])
+		return list(zip(directories, results))
+
+	def run(self, directories, action = 'push', on_done = None, **kwargs):
+		'''
+			Runs `action` for every directory, returning a list of (Directory, result)
+			in the order the directories were given
+
+			`on_done` is called with (Directory, result) as each one finishes.
+			Any extra keyword arguments are passed through to `action`
+		'''
+		return asyncio.run(self.run_async(directories, action, on_done, **kwargs))
+
+	def push(self, directories, **kwargs):
+		return self.run(directories, 'push', **kwargs)
+
+	def pull(self, directories, **kwargs):
+		return self.run(directories, 'pull', **kwargs)
+
+	def plan(self, directories, **kwargs):
+		'''Estimate a push of every directory at once, returns a list of (Directory, Plan), see macrup.plan'''
+		return self.run(directories, 'plan', **kwargs)
+
+	def sizes(self, directories):
+		'''Fetch the remote size of every directory at once, returns {Directory: dict(count, bytes) or None}'''
+		return dict(self.run(directories, 'remote_size'))
+
+def prioritize(directories, priority = [], sizes = None):
+	'''
+		Order directories for a restore
+
+		Anything named in `priority`, by path or bucket, comes first in the order listed.
+		The rest keep their order, or go smallest first if `sizes` is given.
+		Directories whose size is unknown go last.
+	'''
+	rank = {name: i for i, name in enumerate(priority)}
+
+	def _key(item):
+		index, directory = item
+		listed = min(rank.get(directory.name, len(rank)), rank.get(directory.bucket, len(rank)))
+		if sizes is None:
+			return (listed, index)
+		size = sizes.get(directory)
+		return (listed, size is None, size['bytes'] if size else 0, index)
+
+	return [d for _, d in sorted(enumerate(directories), key = _key)]
@@ -0,0 +1,208 @@
+import os
+import os.path
+import tempfile
+from datetime import datetime
+
+from .engine import merge, missing
+from .error import ConfigError
+from .log import Log
+from .stats import SyncResult
+
+_log = Log('snapshot')
+
+SNAPSHOTS = '.snapshots'
+GENERATIONS = '.macrup/generations'
+LABEL_FORMAT = '%Y%m%dT%H%M%S'
+
+# What the sync itself must never touch in a bucket that keeps snapshots
+EXCLUDES = ['/%s/**'%SNAPSHOTS, '/.macrup/**']
+
+def label(ts):
+	return ts.strftime(LABEL_FORMAT)
+
+def parse_label(text):
+	try:
+		return datetime.strptime(text, LABEL_FORMAT)
+	except ValueError:
+		raise ConfigError('Unable to parse snapshot %s, expected eg. %s'%(text, label(datetime.now())))
+
+class Retention:
+	'''
+		Which snapshots to keep, the newest in each of the last `hourly` hours,
+		`daily` days and `weekly` weeks, and always the newest one
+	'''
+	PERIODS = (('hourly', '%Y%m%d%H'), ('daily', '%Y%m%d'), ('weekly', '%G%V'))
+
+	def __init__(self, hourly = 0, daily = 0, weekly = 0):
+		self.counts = dict(hourly = int(hourly or 0), daily = int(daily or 0), weekly = int(weekly or 0))
+
+	def __repr__(self):
+		return 'Retention(hourly=%(hourly)s, daily=%(daily)s, weekly=%(weekly)s)'%self.counts
+
+	def keep(self, labels):
+		'''The subset of `labels` to keep'''
+		newest_first = sorted(labels, reverse = True)
+		keep = set(newest_first[:1])
+		for period, fmt in self.PERIODS:
+			seen = set()
+			for text in newest_first:
+				bucket = parse_label(text).strftime(fmt)
+				if bucket in seen:
+					continue
+				if len(seen) >= self.counts[period]:
+					break
+				seen.add(bucket)
+				keep.add(text)
+		return keep
+
+class Snapshots:
+	'''
+		Dated generations of a sync mode directory, kept in its own bucket
+
+		Every push moves the files it overwrites or deletes into .snapshots/<label of the previous push>
+		with --backup-dir, a server side move, so nothing unchanged is uploaded twice. The paths present
+		at each push are recorded in .macrup/generations/<label>.lst.
+
+		The tree as of snapshot S is the current tree limited to the paths in S's list, overlaid by
+		every generation from the newest down to S, so the earliest version at or after S wins.
+		Pruning S merges its files into the next older generation without overwriting
+		what that one holds, or drops them if nothing older is left.
+	'''
+	def __init__(self, directory):
+		self._directory = directory
+
+	def __repr__(self):
+		return 'Snapshots(directory=%s)'%self._directory.name
+
+	@property
+	def bucket(self):
+		return self._directory.bucket
+
+	async def labels(self):
+		'''Labels of every snapshot, oldest first, None if they can't be listed'''
+		listing = await self._directory._lsf_async('%s/%s'%(self.bucket, GENERATIONS), extra = '--files-only', missing_ok = True)
+		if listing is None:
+			return None
+		return sorted(name[:-len('.lst')] for name in listing if name.endswith('.lst'))
+
+	async def backup_flags(self):
+		'''
+			--backup-dir for the next push, keeping what it replaces under the newest snapshot
+			None if the snapshots can't be listed, pushing without it would destroy what they hold
+		'''
+		labels = await self.labels()
+		if labels is None:
+			return None
+		if not labels:
+			return ''
+		return "--backup-dir '%s:%s/%s/%s'"%(self._directory._remote, self.bucket, SNAPSHOTS, labels[-1])
+
+	async def record(self, when, paths):
+		'''Upload the list of paths present as of the push at `when`'''
+		fd, list_path = tempfile.mkstemp(prefix = 'macrup-', suffix = '.lst')
+		try:
+			with os.fdopen(fd, 'w') as list_file:
+				for path in sorted(paths):
+					list_file.write(path + '\n')
+			return await self._directory._sync_async(list_path,
+						'%s:%s/%s/%s.lst'%(self._directory._remote, self.bucket, GENERATIONS, label(when)),
+						command = 'copyto')
+		finally:
+			os.remove(list_path)
+
+	async def _generations(self):
+		'''Labels of the snapshots holding any files, None if they can't be listed'''
+		listing = await self._directory._lsf_async('%s/%s'%(self.bucket, SNAPSHOTS), extra = '--dirs-only', missing_ok = True)
+		if listing is None:
+			return None
+		return set(name.rstrip('/') for name in listing)
+
+	async def delete(self, doomed):
+		'''Prune the snapshots labelled in `doomed`, never the newest one, returns a SyncResult'''
+		directory = self._directory
+		labels = await self.labels()
+		if labels is None:
+			return SyncResult(False)
+		missing = set(doomed) - set(labels)
+		if missing:
+			_log.warning('%s has no snapshots %s'%(self.bucket, ', '.join(sorted(missing))))
+		if labels and labels[-1] in doomed:
+			# The next push moves what it replaces into the newest generation,
+			# merged into an older one that would overwrite the older snapshot's files
+			_log.error('Refusing to delete %s, the newest snapshot of %s'%(labels[-1], directory.name))
+			return SyncResult(False)
+		generations = await self._generations()
+		if generations is None:
+			return SyncResult(False)
+		# Newest first, so files merged down can be merged down again
+		for text in sorted(set(doomed) & set(labels), reverse = True):
+			older = [other for other in labels if other < text]
+			source = '%s/%s/%s'%(self.bucket, SNAPSHOTS, text)
+			if text in generations:
+				if older:
+					_log.info('Merging snapshot %s of %s into %s'%(text, directory.name, older[-1]))
+					rc = await directory._command_async('move', source, '%s/%s/%s'%(self.bucket, SNAPSHOTS, older[-1]),
+							extra = '--ignore-existing')
+					if rc != 0:
+						return SyncResult(False, rc = rc)
+					generations.add(older[-1])
+				_log.info('Dropping snapshot %s of %s'%(text, directory.name))
+				rc = await directory._command_async('purge', source)
+				if rc != 0:
+					return SyncResult(False, rc = rc)
+			rc = await directory._command_async('deletefile', '%s/%s/%s.lst'%(self.bucket, GENERATIONS, text))
+			if rc != 0:
+				return SyncResult(False, rc = rc)
+			labels.remove(text)
+		return SyncResult(True, rc = 0)
+
+	async def prune(self, retention):
+		labels = await self.labels()
+		if labels is None:
+			return SyncResult(False)
+		keep = retention.keep(labels)
+		doomed = [text for text in labels if text not in keep]
+		_log.info('%s: keeping %s of %s snapshots'%(self._directory.name, len(keep), len(labels)))
+		if not doomed:
+			return SyncResult(True, skipped = True)
+		return await self.delete(doomed)
+
+	async def restore(self, text, tuning = None, files = None):
+		'''Rebuild the directory as of snapshot `text`'''
+		directory = self._directory
+		labels = await self.labels()
+		if labels is None:
+			return SyncResult(False)
+		if text == 'latest' and labels:
+			text = labels[-1]
+		if text not in labels:
+			_log.error('%s has no snapshot %s, it has %s'%(self.bucket, text, ', '.join(labels) or 'none'))
+			return SyncResult(False)
+		fd, list_path = tempfile.mkstemp(prefix = 'macrup-', suffix = '.lst')
+		os.close(fd)
+		try:
+			result = await directory._sync_async('%s:%s/%s/%s.lst'%(directory._remote, self.bucket, GENERATIONS, text),
+						list_path, command = 'copyto')
+			if not result:
+				return result
+			with open(list_path) as list_file:
+				paths = [line.rstrip('\n') for line in list_file if line.rstrip('\n')]
+		finally:
+			os.remove(list_path)
+		absent = missing(directory.name, set(paths), files)
+		if files is not None:
+			paths = [path for path in paths if path in set(files)]
+		generations = await self._generations()
+		if generations is None:
+			return SyncResult(False)
+		sources = [self.bucket] + ['%s/%s/%s'%(self.bucket, SNAPSHOTS, other)
+						for other in sorted(generations, reverse = True) if other >= text]
+		_log.info('Restoring %s as of %s from %s generations'%(directory.name, text, len(sources)))
+		results = [absent]
+		for source in sources:
+			result = await directory._sync_async('%s:%s'%(directory._remote, source), directory.name,
+						files = paths, tuning = tuning, command = 'copy')
+			results.append(result)
+			if not result:
+				break
+		return merge(directory.name, results)
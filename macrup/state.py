@@ -0,0 +1,278 @@
+import fcntl
+import os
+import os.path
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import PosixPath
+
+import yaml
+
+from .conf import loadYAML
+from .error import ConfigError
+from .log import Log
+
+_log = Log('state')
+
+class StateStore:
+	'''
+		Persisted sync state of the watched directories
+
+		Records are dicts with the keys path, bucket, synced, full_synced and failures
+	'''
+	def load(self):
+		'''Return every saved record'''
+		raise NotImplementedError
+
+	def save(self, records):
+		'''Replace the saved state with `records`'''
+		raise NotImplementedError
+
+	def update(self, record):
+		'''Save or replace a single record'''
+		self.update_many([record])
+
+	def update_many(self, records):
+		'''Save or replace several records at once, leaving every other record alone'''
+		raise NotImplementedError
+
+	def record_run(self, command, started, finished, results):
+		'''
+			Append a run to the history, `results` is a list of (record, SyncResult)
+			Backends without history just ignore it
+		'''
+		pass
+
+	def history(self, limit = 10):
+		'''Return the most recent runs, newest first'''
+		return []
+
+	def directory_history(self, path, command = 'backup', limit = 5):
+		'''Return a directory's results from the most recent runs of `command`, newest first'''
+		return []
+
+	def close(self):
+		pass
+
+class StateLock:
+	'''
+		An exclusive flock on a file next to the state
+
+		Held around every read-modify-write of the state so
+		concurrent macrup processes never overwrite each other
+	'''
+	def __init__(self, path):
+		self._path = path
+		self._fd = None
+
+	def __enter__(self):
+		self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+		fcntl.flock(self._fd, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, *args):
+		fcntl.flock(self._fd, fcntl.LOCK_UN)
+		os.close(self._fd)
+		self._fd = None
+
+class YAMLStore(StateStore):
+	'''
+		The original state file, a YAML list
+
+		Writes go to a temporary file that is renamed over the state,
+		so a crash mid-write never leaves a truncated file behind
+	'''
+	def __init__(self, path):
+		self._path = path
+		self._lock = StateLock(path + '.lock')
+
+	def __repr__(self):
+		return 'YAMLStore(path=%s)'%self._path
+
+	def load(self):
+		saved = loadYAML(self._path)
+		return saved if saved is not None else []
+
+	def _write(self, records):
+		dirname = os.path.dirname(self._path) or '.'
+		fd, tmp_path = tempfile.mkstemp(prefix = '.macrup-', suffix = '.state', dir = dirname)
+		try:
+			with os.fdopen(fd, 'w') as state_file:
+				yaml.dump(list(records), state_file, default_flow_style=False)
+				state_file.flush()
+				os.fsync(state_file.fileno())
+			os.replace(tmp_path, self._path)
+		except Exception:
+			os.remove(tmp_path)
+			raise
+
+	def save(self, records):
+		with self._lock:
+			self._write(records)
+
+	def update_many(self, records):
+		with self._lock:
+			saved = {PosixPath(r['path']).as_posix(): r for r in self.load()}
+			for record in records:
+				saved[PosixPath(record['path']).as_posix()] = record
+			self._write(saved.values())
+
+class SQLiteStore(StateStore):
+	'''
+		State kept in an SQLite database
+
+		Single directories can be updated in place and the last `runs` runs are kept in a history table.
+		If the database is new and a YAML state file exists it is imported once.
+	'''
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS meta (
+			key TEXT PRIMARY KEY,
+			value TEXT
+		);
+		CREATE TABLE IF NOT EXISTS directories (
+			path TEXT PRIMARY KEY,
+			bucket TEXT NOT NULL,
+			synced TEXT,
+			full_synced TEXT,
+			failures INTEGER NOT NULL DEFAULT 0
+		);
+		CREATE TABLE IF NOT EXISTS runs (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			command TEXT,
+			started TEXT NOT NULL,
+			finished TEXT NOT NULL,
+			synced INTEGER NOT NULL,
+			skipped INTEGER NOT NULL,
+			failed INTEGER NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS run_directories (
+			run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+			path TEXT NOT NULL,
+			ok INTEGER NOT NULL,
+			skipped INTEGER NOT NULL,
+			duration REAL,
+			bytes INTEGER,
+			files INTEGER,
+			checks INTEGER,
+			errors INTEGER
+		);
+		CREATE INDEX IF NOT EXISTS run_directories_path ON run_directories(path, run_id);
+	'''
+
+	def __init__(self, path, migrate_from = None, runs = 1000):
+		self._path = path
+		self._runs = runs
+		# Manifest walks and tuning run on executor threads, the lock serialises their queries
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+		self._conn.row_factory = sqlite3.Row
+		with self._transaction():
+			self._conn.execute('PRAGMA journal_mode=WAL')
+			self._conn.execute('PRAGMA foreign_keys=ON')
+			self._conn.executescript(self.SCHEMA)
+		if migrate_from:
+			self._migrate(migrate_from)
+
+	def __repr__(self):
+		return 'SQLiteStore(path=%s)'%self._path
+
+	def _migrate(self, yaml_path):
+		if self._meta('migrated_from') is not None or not os.path.exists(yaml_path):
+			return
+		records = YAMLStore(yaml_path).load()
+		_log.info('Migrating %s directories from %s to %s'%(len(records), yaml_path, self._path))
+		with self._transaction():
+			self._conn.executemany(self._UPSERT, [self._to_row(r) for r in records])
+			self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('migrated_from', yaml_path))
+
+	@contextmanager
+	def _transaction(self):
+		with self._lock, self._conn:
+			yield self._conn
+
+	def _query(self, sql, args = ()):
+		with self._lock:
+			return self._conn.execute(sql, args).fetchall()
+
+	def _meta(self, key):
+		rows = self._query('SELECT value FROM meta WHERE key = ?', (key,))
+		return rows[0]['value'] if rows else None
+
+	_UPSERT = '''INSERT OR REPLACE INTO directories (path, bucket, synced, full_synced, failures)
+				VALUES (?, ?, ?, ?, ?)'''
+
+	@staticmethod
+	def _ts(value):
+		return value.isoformat() if value is not None else None
+
+	@staticmethod
+	def _to_row(record):
+		return (PosixPath(record['path']).as_posix(), record['bucket'],
+				SQLiteStore._ts(record.get('synced')), SQLiteStore._ts(record.get('full_synced')),
+				record.get('failures', 0))
+
+	@staticmethod
+	def _from_row(row):
+		return dict(
+				path = PosixPath(row['path']),
+				bucket = row['bucket'],
+				synced = datetime.fromisoformat(row['synced']) if row['synced'] else None,
+				full_synced = datetime.fromisoformat(row['full_synced']) if row['full_synced'] else None,
+				failures = row['failures'])
+
+	def load(self):
+		return [self._from_row(row) for row in self._query('SELECT * FROM directories ORDER BY path')]
+
+	def save(self, records):
+		with self._transaction():
+			self._conn.execute('DELETE FROM directories')
+			self._conn.executemany(self._UPSERT, [self._to_row(r) for r in records])
+
+	def update_many(self, records):
+		with self._transaction():
+			self._conn.executemany(self._UPSERT, [self._to_row(r) for r in records])
+
+	def record_run(self, command, started, finished, results):
+		results = [(record, result) for record, result in results if result is not None]
+		with self._transaction():
+			cur = self._conn.execute(
+				'INSERT INTO runs (command, started, finished, synced, skipped, failed) VALUES (?, ?, ?, ?, ?, ?)',
+				(command, self._ts(started), self._ts(finished),
+				sum(1 for _, r in results if r and not r.skipped),
+				sum(1 for _, r in results if r and r.skipped),
+				sum(1 for _, r in results if not r)))
+			self._conn.executemany(
+				'''INSERT INTO run_directories (run_id, path, ok, skipped, duration, bytes, files, checks, errors)
+					VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+				[(cur.lastrowid, PosixPath(record['path']).as_posix(), bool(r), r.skipped, r.duration,
+					r.stats.bytes if r.stats else None,
+					r.stats.transfers if r.stats else None,
+					r.stats.checks if r.stats else None,
+					r.stats.errors if r.stats else None) for record, r in results])
+			# The daemon and watch record a run per job, older ones go so the database doesn't grow forever
+			if self._runs:
+				self._conn.execute('DELETE FROM run_directories WHERE run_id <= ?', (cur.lastrowid - self._runs,))
+				self._conn.execute('DELETE FROM runs WHERE id <= ?', (cur.lastrowid - self._runs,))
+
+	def history(self, limit = 10):
+		return [dict(row) for row in self._query('SELECT * FROM runs ORDER BY id DESC LIMIT ?', (limit,))]
+
+	def directory_history(self, path, command = 'backup', limit = 5):
+		return [dict(row) for row in self._query(
+			'''SELECT d.*, r.started FROM run_directories d JOIN runs r ON r.id = d.run_id
+				WHERE d.path = ? AND r.command = ? AND d.skipped = 0
+				ORDER BY d.run_id DESC LIMIT ?''',
+			(PosixPath(path).as_posix(), command, limit))]
+
+	def close(self):
+		self._conn.close()
+
+def open_store(backend, state_path, db_path, runs = 1000):
+	'''Open the configured state backend, keeping the history of the last `runs` runs'''
+	if backend == 'yaml':
+		return YAMLStore(state_path)
+	if backend == 'sqlite':
+		return SQLiteStore(db_path, migrate_from = state_path, runs = runs)
+	raise ConfigError('Unknown state backend %s'%backend)
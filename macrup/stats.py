@@ -0,0 +1,128 @@
+import json
+import re
+
+from .log import Log
+from .util import human_size
+
+_log = Log('stats')
+
+# rclone logs this before each retry of a whole sync
+_RETRY = re.compile(r'Attempt \d+/\d+ failed')
+
+# json log level -> our log level for messages that aren't stats
+_LEVELS = dict(
+		critical = 'error',
+		error = 'error',
+		warning = 'warning',
+		notice = 'info',
+		info = 'debug',
+		debug = 'debug'
+		)
+
+class TransferStats:
+	'''
+		Running totals for a single rclone invocation,
+		fed line by line from its `--use-json-log` output
+	'''
+	def __init__(self, name = None):
+		self.name = name
+		self.bytes = 0
+		self.total_bytes = 0
+		self.checks = 0
+		self.transfers = 0
+		self.deletes = 0
+		self.speed = 0.0
+		self.elapsed = 0.0
+		self.errors = 0
+		self.retries = 0
+		self.last_error = None
+
+	def __repr__(self):
+		return 'TransferStats(name=%s, bytes=%s, transfers=%s, checks=%s, errors=%s, retries=%s)'%(
+					self.name, self.bytes, self.transfers, self.checks, self.errors, self.retries)
+
+	def summary(self):
+		return '%s transferred in %s files at %s/s, %s checks, %s deletes, %s errors, %s retries, %.1fs elapsed'%(
+					human_size(self.bytes), self.transfers, human_size(self.speed),
+					self.checks, self.deletes, self.errors, self.retries, self.elapsed)
+
+	def update(self, stats, report = True):
+		'''Take the totals from an rclone stats block, as logged or returned by core/stats'''
+		self._update(stats)
+		if report:
+			_log.info('%s: %s/%s, %s/s, %s checks, %s errors'%(self.name,
+						human_size(self.bytes), human_size(self.total_bytes),
+						human_size(self.speed), self.checks, self.errors))
+
+	def _update(self, stats):
+		self.bytes = stats.get('bytes', self.bytes)
+		self.total_bytes = stats.get('totalBytes', self.total_bytes)
+		self.checks = stats.get('checks', self.checks)
+		self.transfers = stats.get('transfers', self.transfers)
+		self.deletes = stats.get('deletes', self.deletes)
+		self.speed = stats.get('speed', self.speed)
+		self.elapsed = stats.get('elapsedTime', self.elapsed)
+		self.errors = stats.get('errors', self.errors)
+		self.last_error = stats.get('lastError', self.last_error)
+
+	def feed(self, line):
+		'''Consume one line of rclone output'''
+		line = line.strip()
+		if not line:
+			return
+		try:
+			record = json.loads(line)
+		except ValueError:
+			_log.debug('%s: %s'%(self.name, line))
+			return
+		if not isinstance(record, dict):
+			return
+		msg = record.get('msg', '').strip()
+		if _RETRY.search(msg):
+			self.retries += 1
+		if 'stats' in record:
+			self.update(record['stats'])
+			return
+		level = _LEVELS.get(record.get('level'), 'debug')
+		getattr(_log, level)('%s: %s'%(self.name, msg))
+
+	def as_dict(self):
+		return dict(
+				bytes = self.bytes,
+				checks = self.checks,
+				transfers = self.transfers,
+				deletes = self.deletes,
+				speed = self.speed,
+				elapsed = self.elapsed,
+				errors = self.errors,
+				retries = self.retries)
+
+class SyncResult:
+	'''
+		Outcome of a push or pull
+
+		Truthy when the sync succeeded, so existing `if directory.push():`
+		checks keep working
+	'''
+	def __init__(self, ok, stats = None, rc = None, skipped = False, duration = 0.0, attempts = 1):
+		self.ok = ok
+		self.stats = stats
+		self.rc = rc
+		self.skipped = skipped
+		self.duration = duration
+		self.attempts = attempts
+
+	def __bool__(self):
+		return bool(self.ok)
+
+	def as_dict(self):
+		return dict(
+				ok = bool(self.ok),
+				rc = self.rc,
+				skipped = self.skipped,
+				duration = self.duration,
+				attempts = self.attempts,
+				stats = self.stats.as_dict() if self.stats is not None else None)
+
+	def __repr__(self):
+		return 'SyncResult(ok=%s, rc=%s, skipped=%s, attempts=%s, stats=%s)'%(self.ok, self.rc, self.skipped, self.attempts, self.stats)
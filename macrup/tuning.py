@@ -0,0 +1,97 @@
+from collections import namedtuple
+from os.path import expanduser
+
+from .log import Log
+
+_log = Log('tuning')
+
+# What we know about a directory going into a sync
+# files and bytes describe the whole local tree, speed is bytes/s seen on recent runs
+# errors is the number of rclone errors on the last few runs
+Profile = namedtuple('Profile', ['files', 'bytes', 'speed', 'errors'])
+
+# rclone's own defaults, used when nothing is known about a directory
+DEFAULTS = dict(
+		transfers = 4,
+		checkers = 8,
+		fast_list = True,
+		chunk_size = None,
+		upload_cutoff = None,
+		bwlimit = None)
+
+# Past this many files --fast-list holds the whole listing in memory
+FAST_LIST_MAX_FILES = 1000000
+LARGE_FILE = 64 * 1024 * 1024
+SMALL_FILE = 1024 * 1024
+# Roughly what B2 spends on each object besides moving its bytes, and the most transfers worth running
+OBJECT_LATENCY = 0.5
+MAX_TRANSFERS = 64
+
+def profile(manifest = None, history = []):
+	'''
+		Build a Profile from the directory's manifest, if it has been scanned,
+		and its recent run history, newest first
+	'''
+	files = size = None
+	if manifest is not None and manifest.exists:
+		entries = manifest.entries
+		files = len(entries)
+		size = sum(e.size for e in entries.values())
+	timed = [h for h in history if h.get('duration') and h.get('bytes')]
+	speed = sum(h['bytes'] for h in timed) / sum(h['duration'] for h in timed) if timed else None
+	errors = sum(h.get('errors') or 0 for h in history[:3])
+	return Profile(files, size, speed, errors)
+
+def choose(prof, overrides = {}):
+	'''
+		Pick transfer settings for a Profile, anything in `overrides` wins
+
+		The average file size picks a starting point, which the throughput of recent
+		runs can only raise, so many small files on a fast link get enough transfers.
+	'''
+	settings = dict(DEFAULTS)
+	if prof.files:
+		average = prof.bytes / prof.files
+		if average >= LARGE_FILE:
+			# A few huge files, parallelise within each file rather than across them
+			settings.update(transfers = 4, checkers = 8, chunk_size = '96M', upload_cutoff = '200M')
+		elif average <= SMALL_FILE:
+			# Lots of tiny files, per object latency dominates
+			settings.update(transfers = 32, checkers = 64)
+		else:
+			settings.update(transfers = 8, checkers = 16)
+		if prof.speed:
+			# To carry speed bytes/s in files of this size, speed / average files/s must be on the wire,
+			# each in flight for at least OBJECT_LATENCY. Twice that leaves room to go faster than last time
+			needed = min(MAX_TRANSFERS, int(2 * prof.speed * OBJECT_LATENCY / average) + 1)
+			if needed > settings['transfers']:
+				settings.update(transfers = needed, checkers = 2 * needed)
+		if prof.files > FAST_LIST_MAX_FILES:
+			settings['fast_list'] = False
+	if prof.errors:
+		# Recent errors are usually B2 pushing back, ease off
+		settings['transfers'] = max(1, settings['transfers'] // 2)
+	settings.update({k: v for k, v in overrides.items() if k in DEFAULTS})
+	return settings
+
+def flags(settings):
+	'''Render settings as rclone command line flags'''
+	out = ['--transfers %d'%settings['transfers'], '--checkers %d'%settings['checkers']]
+	if settings['fast_list']:
+		out.append('--fast-list')
+	if settings['chunk_size']:
+		out.append('--b2-chunk-size %s'%settings['chunk_size'])
+	if settings['upload_cutoff']:
+		out.append('--b2-upload-cutoff %s'%settings['upload_cutoff'])
+	if settings['bwlimit']:
+		out.append("--bwlimit '%s'"%settings['bwlimit'])
+	return ' '.join(out)
+
+def overrides_for(entries, path, bucket):
+	'''The `tuning` config entries that apply to a directory, matched by path or bucket'''
+	matched = {}
+	for entry in entries:
+		entry_path = expanduser(entry['path']) if entry.get('path') else None
+		if entry_path in (path, None) and entry.get('bucket') in (bucket, None):
+			matched.update(entry)
+	return matched
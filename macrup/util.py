@@ -17,6 +17,26 @@ def convert_delta(interval):
 	kwargs = { seg_map[seg[-1]]: int(seg[:-1]) for seg in segs }
 	return timedelta(**kwargs)
 
+def human_size(num):
+	'''Format a byte count as a short human readable string eg. 1.5G'''
+	if abs(num) < 1024:
+		return '%dB'%num
+	for unit in 'KMGT':
+		num /= 1024
+		if abs(num) < 1024:
+			break
+	return '%.1f%s'%(num, unit)
+
+def human_duration(seconds):
+	'''Format seconds the way convert_delta reads them, to the two largest units eg. 1h 5m'''
+	seconds = int(round(seconds))
+	parts = []
+	for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+		if seconds >= size or (unit == 's' and not parts):
+			parts.append('%d%s'%(seconds // size, unit))
+			seconds %= size
+	return ' '.join(parts[:2])
+
 class RequiredIf(click.Option):
     def __init__(self, *args, **kwargs):
         self._required_if = kwargs.pop('required_if')
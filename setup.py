@@ -102,9 +102,13 @@ setup(
         'Programming Language :: Python :: 3',
         # 'Programming Language :: Python :: 3.4',
         # 'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
     ],
 
+    # asyncio.run, contextvars and datetime.fromisoformat all need 3.7
+    python_requires='>=3.7',
+
     # This field adds keywords for your project which will appear on the
     # project page. What does your project relate to?
     #
@@ -142,6 +146,10 @@ setup(
     extras_require={  # Optional
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        # Content defined chunking for mode: dedup, without it files are cut into fixed blocks
+        'dedup': ['numpy'],
+        # Needed by mode: compress
+        'compress': ['zstandard'],
     },
 
     # If there are data files included in your packages that need to be
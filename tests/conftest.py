@@ -0,0 +1,125 @@
+import io
+import os
+import shutil
+
+import pytest
+
+from macrup import dedup, engine
+from macrup.manifest import Manifest
+from macrup.stats import SyncResult
+
+
+class FakeDirectory:
+    '''
+    Just enough of a Directory for the engines, with the remote kept under a local folder
+
+    "fake:bucket/path" is remote/bucket/path. Like rclone a dry run stores nothing.
+    '''
+    _remote = 'fake'
+    _prefix = 'pfx'
+
+    def __init__(self, tmpdir, name='tree', bucket='pfx-tree', dry_run=False):
+        self._tmpdir = tmpdir
+        self.name = str(tmpdir.join(name))
+        self.bucket = bucket
+        self._dry_run = dry_run
+        self.remote_root = str(tmpdir.join('remote'))
+        self.manifest = Manifest(str(tmpdir.join('state', '%s.json' % name)), self.name)
+        os.makedirs(self.name, exist_ok=True)
+
+    def elsewhere(self, name, dry_run=False):
+        '''Another directory backed by the same bucket, eg. to restore into'''
+        return FakeDirectory(self._tmpdir, name, self.bucket, dry_run)
+
+    def write(self, rel, content):
+        path = os.path.join(self.name, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def tree(self):
+        '''{path: content} of every file in the directory'''
+        tree = {}
+        for top, _, names in os.walk(self.name):
+            for name in names:
+                path = os.path.join(top, name)
+                with open(path, 'rb') as f:
+                    tree[os.path.relpath(path, self.name)] = f.read()
+        return tree
+
+    def path(self, location):
+        if location.startswith('fake:'):
+            return os.path.join(self.remote_root, location[len('fake:'):])
+        return location
+
+    def objects(self, bucket=None):
+        '''Every object in `bucket`, relative to it'''
+        root = os.path.join(self.remote_root, bucket or self.bucket)
+        return sorted(os.path.relpath(os.path.join(top, name), root)
+                      for top, _, names in os.walk(root) for name in names)
+
+    async def _sync_async(self, src, dest, files=None, tuning=None, command='sync', **kwargs):
+        src, dest = self.path(src), self.path(dest)
+        if not os.path.exists(src):
+            return SyncResult(False, rc=3)
+        if self._dry_run:
+            return SyncResult(True, rc=0)
+        if command == 'copyto':
+            pairs = [(src, dest)]
+        else:
+            names = files if files is not None else [
+                os.path.relpath(os.path.join(top, name), src) for top, _, names in os.walk(src) for name in names]
+            pairs = [(os.path.join(src, rel), os.path.join(dest, rel)) for rel in names]
+        for source, target in pairs:
+            if not os.path.exists(source):
+                return SyncResult(False, rc=4)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+        return SyncResult(True, rc=0)
+
+    async def _lsf_async(self, path, extra='', missing_ok=False):
+        root = self.path('fake:%s' % path)
+        if not os.path.isdir(root):
+            return [] if missing_ok else None
+        return sorted(os.path.relpath(os.path.join(top, name), root)
+                      for top, _, names in os.walk(root) for name in names)
+
+    async def _rcat_async(self, path, produce):
+        if self._dry_run:
+            return SyncResult(True, rc=0)
+        target = self.path('fake:%s' % path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        out = io.BytesIO()
+        try:
+            produce(out)
+        except Exception:
+            return SyncResult(False, rc=2)
+        with open(target, 'wb') as f:
+            f.write(out.getvalue())
+        return SyncResult(True, rc=0)
+
+    async def _cat_async(self, path, consume, offset=None, count=None):
+        with open(self.path('fake:%s' % path), 'rb') as f:
+            f.seek(offset or 0)
+            data = f.read() if count is None else f.read(count)
+        return SyncResult(True, rc=0), consume(io.BytesIO(data))
+
+    async def _delete_async(self, path, files):
+        if not self._dry_run:
+            for rel in files:
+                os.remove(self.path('fake:%s/%s' % (path, rel)))
+        return 0
+
+
+@pytest.fixture
+def state(tmpdir, monkeypatch):
+    '''Keep engine indexes and spools under tmpdir instead of the home directory'''
+    patched = engine.config._replace(state_path=str(tmpdir.join('state', 'macrup')), spool_path=str(tmpdir.join('spool')))
+    for module in (engine, dedup):
+        monkeypatch.setattr(module, 'config', patched)
+    return tmpdir
+
+
+@pytest.fixture
+def directory(state):
+    return FakeDirectory(state)
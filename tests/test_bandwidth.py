@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from macrup import bandwidth
+from macrup.bandwidth import BandwidthBudget, Transfer, format_rate, parse_rate, parse_schedule, serving_port
+from macrup.error import ConfigError
+
+M = 1024 * 1024
+
+
+@pytest.fixture
+def rates(monkeypatch):
+    '''Stand in for rclone's core/bwlimit, a transfer only answers once its port is known'''
+    calls = []
+
+    def set_rate(transfer, rate):
+        if transfer.port is None:
+            return False
+        calls.append((transfer.name, rate))
+        transfer.rate = rate
+        return True
+
+    monkeypatch.setattr(Transfer, 'set_rate', set_rate)
+    return calls
+
+
+def at(monkeypatch, hour, minute=0):
+    class Now(datetime):
+        @classmethod
+        def now(cls):
+            return datetime(2020, 1, 1, hour, minute)
+
+    monkeypatch.setattr(bandwidth, 'datetime', Now)
+
+
+def serving(port):
+    return '{"level":"notice","msg":"Serving remote control on http://127.0.0.1:%s/\\n"}' % port
+
+
+def test_parse_rate():
+    assert parse_rate('512k') == 512 * 1024
+    assert parse_rate('10M') == 10 * M
+    assert parse_rate('1.5m') == int(1.5 * M)
+    # A bare number is KiB/s, as for rclone
+    assert parse_rate('100') == 100 * 1024
+    assert parse_rate('off') is None
+    assert parse_rate(None) is None
+    with pytest.raises(ConfigError):
+        parse_rate('fast')
+
+
+def test_format_rate():
+    assert format_rate(None) == 'off'
+    assert format_rate(10 * M) == '10240k'
+    assert format_rate(10) == '1k'
+
+
+def test_parse_schedule():
+    assert parse_schedule('19:00,10M 08:00,512k 23:00,off') == [
+        ((8, 0), 512 * 1024), ((19, 0), 10 * M), ((23, 0), None)]
+    assert parse_schedule(None) == []
+    with pytest.raises(ConfigError):
+        parse_schedule('8am,1M')
+
+
+def test_serving_port():
+    assert serving_port(serving(53682)) == 53682
+    assert serving_port('Transferred: 1 / 2') is None
+
+
+def test_transfer_learns_its_port_once():
+    transfer = Transfer('a')
+    assert not transfer.observe('something else')
+    assert transfer.observe(serving(1000))
+    assert not transfer.observe(serving(2000))
+    assert transfer.port == 1000
+
+
+def test_a_budget_needs_a_limit_or_schedule():
+    assert not BandwidthBudget().enabled
+    assert BandwidthBudget('10M').limit == 10 * M
+
+
+def test_the_tighter_of_schedule_and_limit(monkeypatch):
+    budget = BandwidthBudget('4M', '08:00,1M 19:00,10M 23:00,off')
+    at(monkeypatch, 9)
+    assert budget.limit == 1 * M
+    at(monkeypatch, 20)
+    assert budget.limit == 4 * M
+    at(monkeypatch, 23, 30)
+    assert budget.limit == 4 * M
+    # Before the first slot the last one of the day before still holds
+    at(monkeypatch, 2)
+    assert BandwidthBudget(schedule='08:00,1M 23:00,2M').limit == 2 * M
+
+
+def test_shares_are_equal():
+    budget = BandwidthBudget('8M')
+    assert budget.share() == 8 * M
+    assert budget.share(4) == 2 * M
+    assert BandwidthBudget().share(4) is None
+
+
+def test_transfers_start_with_the_share_they_would_have():
+    budget = BandwidthBudget('8M')
+    first, second = budget.join('a'), budget.join('b')
+    assert (first.rate, second.rate) == (8 * M, 4 * M)
+    assert "--bwlimit '4096k'" in second.flags
+
+
+def test_transfers_started_together_stay_within_the_limit(rates):
+    async def run():
+        budget = BandwidthBudget('12M')
+        transfers = [budget.join(name) for name in 'abcd']
+        # None of them is listening yet, so none can be told
+        await budget.rebalance()
+        assert rates == []
+        for port, transfer in enumerate(transfers, 1000):
+            budget.observe(transfer, serving(port))
+        await asyncio.gather(*budget._catching_up)
+        return transfers
+
+    transfers = asyncio.run(run())
+    assert [t.rate for t in transfers] == [3 * M] * 4
+
+
+def test_leaving_gives_the_others_more(rates):
+    async def run():
+        budget = BandwidthBudget('12M')
+        transfers = [budget.join(name) for name in 'abc']
+        for port, transfer in enumerate(transfers, 1000):
+            transfer.observe(serving(port))
+        await budget.rebalance()
+        await budget.leave(transfers[0])
+        return transfers
+
+    transfers = asyncio.run(run())
+    assert [t.rate for t in transfers[1:]] == [6 * M] * 2
+    assert ('a', 6 * M) not in rates
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+import pytest
+
+from macrup import compress
+from macrup.stats import SyncResult
+
+pytestmark = pytest.mark.skipif(compress.zstandard is None, reason='zstandard is not installed')
+
+OPTIONS = dict(layout='file', level=3, threads=0, transfers=2, skip=['.zst', '.jpg'])
+
+
+def push(directory, options=OPTIONS, full=False):
+    engine = compress.CompressEngine(directory, options)
+    changes = directory.manifest.diff()
+    result = asyncio.run(engine.push_async(changes, full=full))
+    if result:
+        directory.manifest.commit()
+    return result
+
+
+def pull(directory, options=OPTIONS, files=None):
+    return asyncio.run(compress.CompressEngine(directory, options).pull_async(files=files))
+
+
+def test_round_trip(directory):
+    directory.write('a.txt', b'hello ' * 1000)
+    directory.write('sub/b.log', b'log line\n' * 500)
+    directory.write('photo.jpg', b'\xff\xd8 not really a jpeg')
+    assert push(directory)
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == directory.tree()
+    assert os.stat(os.path.join(restored.name, 'a.txt')).st_mtime_ns == \
+        os.stat(os.path.join(directory.name, 'a.txt')).st_mtime_ns
+
+
+def test_zst_files_are_restored_as_they_are(directory):
+    zstd = compress.zstandard.ZstdCompressor().compress(b'inner content')
+    directory.write('log.txt.zst', zstd)
+    # Compressed, x is stored under the same name a raw x.zst used to be
+    directory.write('log.txt', b'plain content')
+    assert push(directory)
+    assert directory.objects() == ['.macrup/index.json', 'raw/log.txt.zst', 'zst/log.txt.zst']
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'log.txt.zst': zstd, 'log.txt': b'plain content'}
+
+
+def test_changed_and_deleted_files_replace_their_objects(directory):
+    directory.write('a.txt', b'one')
+    directory.write('b.txt', b'two')
+    assert push(directory)
+    os.remove(os.path.join(directory.name, 'b.txt'))
+    directory.write('a.txt', b'three')
+    assert push(directory)
+    assert directory.objects() == ['.macrup/index.json', 'zst/a.txt.zst']
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'a.txt': b'three'}
+
+
+def test_stale_objects_outlive_a_failed_index_upload(directory, monkeypatch):
+    directory.write('a.txt', b'one')
+    assert push(directory)
+    os.remove(os.path.join(directory.name, 'a.txt'))
+
+    async def fail(*args, **kwargs):
+        return SyncResult(False, rc=5)
+
+    monkeypatch.setattr(compress.CompressEngine, 'upload', fail)
+    assert not push(directory)
+    # The index on the remote still names the object, so it must still be there
+    assert 'zst/a.txt.zst' in directory.objects()
+
+
+def test_older_indexes_restore(directory):
+    zstd = compress.zstandard.ZstdCompressor()
+    os.makedirs(os.path.join(directory.remote_root, directory.bucket, '.macrup'))
+    with open(os.path.join(directory.remote_root, directory.bucket, 'a.txt.zst'), 'wb') as f:
+        f.write(zstd.compress(b'compressed'))
+    with open(os.path.join(directory.remote_root, directory.bucket, 'b.zst'), 'wb') as f:
+        f.write(b'raw')
+    engine = compress.CompressEngine(directory, OPTIONS)
+    engine.save_index(dict(layout='file', files={'a.txt': [10, 0, 'a.txt.zst'], 'b.zst': [3, 0, 'b.zst']}),
+                      os.path.join(directory.remote_root, directory.bucket, '.macrup', 'index.json'))
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'a.txt': b'compressed', 'b.zst': b'raw'}
+
+
+def test_archive_round_trip(directory):
+    options = dict(OPTIONS, layout='archive')
+    directory.write('a.txt', b'one')
+    directory.write('sub/b.zst', b'two')
+    assert push(directory, options)
+    assert directory.objects() == ['.macrup/index.json', 'archive.tar.zst']
+    restored = directory.elsewhere('restored')
+    assert pull(restored, options)
+    assert restored.tree() == directory.tree()
+
+
+def test_dry_run_stores_nothing(directory):
+    directory.write('a.txt', b'one')
+    assert push(directory.elsewhere('tree', dry_run=True))
+    assert not os.path.exists(os.path.join(directory.remote_root, directory.bucket))
@@ -0,0 +1,144 @@
+import asyncio
+import io
+import os
+import random
+
+import pytest
+
+from macrup import dedup
+from macrup.dedup import GEAR, Chunker, chunk_id
+
+needs_numpy = pytest.mark.skipif(dedup.numpy is None, reason='numpy is not installed')
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def reference_cut(chunker, data):
+    '''A byte at a time, as FastCDC describes it'''
+    size = len(data)
+    if size <= chunker.min:
+        return size
+    end = min(size, chunker.max)
+    normal = min(end, chunker.average)
+    h = 0
+    for i in range(chunker.min, end):
+        h = ((h << 1) + GEAR[data[i]]) & 0xffffffffffffffff
+        if not h & (chunker._strict if i < normal else chunker._loose):
+            return i + 1
+    return end
+
+
+def chunks(chunker, data):
+    return list(chunker.split(io.BytesIO(data)))
+
+
+def test_short_data_is_one_chunk():
+    chunker = Chunker(256)
+    assert chunker.cut(b'') == 0
+    assert chunker.cut(b'x' * chunker.min) == chunker.min
+
+
+def test_average_is_a_power_of_two():
+    assert Chunker(1000).average == 512
+    assert Chunker(1024 * 1024).average == 1024 * 1024
+    assert Chunker(10).average == 256
+
+
+@needs_numpy
+@pytest.mark.parametrize('seed', range(5))
+def test_cut_matches_the_rolling_hash(seed):
+    chunker = Chunker(256)
+    data = random_bytes(64 * 1024, seed)
+    offset = 0
+    while offset < len(data):
+        size = chunker.cut(memoryview(data)[offset:])
+        assert size == reference_cut(chunker, data[offset:])
+        offset += size
+
+
+@needs_numpy
+def test_cut_across_scan_blocks(monkeypatch):
+    monkeypatch.setattr(dedup, 'SCAN_BLOCK', 7)
+    chunker = Chunker(256)
+    data = random_bytes(16 * 1024, 3)
+    assert chunker.cut(data) == reference_cut(chunker, data)
+
+
+@needs_numpy
+def test_chunks_stay_within_bounds():
+    chunker = Chunker(256)
+    parts = chunks(chunker, random_bytes(256 * 1024))
+    assert b''.join(parts) == random_bytes(256 * 1024)
+    assert all(chunker.min < len(part) <= chunker.max for part in parts[:-1])
+    # Uniform data never hits the mask, so it is cut at the maximum
+    assert [len(part) for part in chunks(chunker, b'\0' * 4096)] == [1024] * 4
+
+
+@needs_numpy
+def test_boundaries_survive_an_insert():
+    chunker = Chunker(256)
+    data = random_bytes(256 * 1024)
+    before = [chunk_id(part) for part in chunks(chunker, data)]
+    middle = len(data) // 2
+    after = [chunk_id(part) for part in chunks(chunker, data[:middle] + b'inserted' + data[middle:])]
+    # Only the chunk holding the insert, and perhaps its neighbour, changes
+    assert len(set(after) - set(before)) <= 2
+    assert len(set(before) - set(after)) <= 2
+
+
+@needs_numpy
+def test_boundaries_survive_a_shift():
+    chunker = Chunker(256)
+    data = random_bytes(256 * 1024)
+    before = set(chunk_id(part) for part in chunks(chunker, data))
+    after = [chunk_id(part) for part in chunks(chunker, b'prefix' + data)]
+    assert len([cid for cid in after if cid not in before]) <= 2
+
+
+OPTIONS = dict(bucket='pfx-chunks', chunk_size=256, spool_max=4096)
+
+
+def push(directory, changes=None):
+    changes = directory.manifest.diff() if changes is None else changes
+    result = asyncio.run(dedup.DedupEngine(directory, OPTIONS).push_async(changes))
+    if result:
+        directory.manifest.commit()
+    return result
+
+
+def pull(directory, files=None):
+    return asyncio.run(dedup.DedupEngine(directory, OPTIONS).pull_async(files=files))
+
+
+def test_round_trip(directory):
+    directory.write('a', random_bytes(4096))
+    directory.write('sub/b', random_bytes(4096, 2))
+    # Shares every chunk with a
+    directory.write('copy_of_a', random_bytes(4096))
+    assert push(directory)
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == directory.tree()
+    stored = [name for name in directory.objects('pfx-chunks') if name.startswith('chunks/')]
+    assert sum(os.path.getsize(os.path.join(directory.remote_root, 'pfx-chunks', name)) for name in stored) == 8192
+
+
+def test_unreadable_files_are_tried_again(directory):
+    directory.write('a', b'one')
+    directory.write('b', b'two')
+    assert push(directory)
+    directory.write('a', b'three')
+    directory.write('b', b'four')
+    changes = directory.manifest.diff()
+    # Gone between the scan and the push
+    os.remove(os.path.join(directory.name, 'b'))
+    assert not push(directory, changes)
+    assert directory.manifest.diff().modified == ['a']
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'a': b'three', 'b': b'two'}
+    # Still uncommitted, so the next push sees b as deleted
+    assert push(directory)
+    assert not directory.manifest.diff()
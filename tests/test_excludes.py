@@ -0,0 +1,101 @@
+import pytest
+
+from macrup.error import ConfigError
+from macrup.excludes import compile_rules, glob_to_regex, load
+
+
+def excluded(pattern, rel, is_dir=False):
+    return compile_rules([pattern]).excluded(rel, is_dir)
+
+
+def test_unanchored_matches_the_end_of_a_path():
+    assert excluded('a.txt', 'a.txt')
+    assert excluded('a.txt', 'x/y/a.txt')
+    assert not excluded('a.txt', 'ba.txt')
+    assert not excluded('a.txt', 'a.txt/b')
+
+
+def test_leading_slash_anchors_at_the_root():
+    assert excluded('/a.txt', 'a.txt')
+    assert not excluded('/a.txt', 'x/a.txt')
+    assert excluded('/x/*.log', 'x/y.log')
+    assert not excluded('/x/*.log', 'z/x/y.log')
+
+
+def test_star_stays_within_a_segment():
+    assert excluded('*.log', 'y.log')
+    assert excluded('*.log', 'x/y.log')
+    assert not excluded('/*.log', 'x/y.log')
+    assert excluded('?.log', 'a.log')
+    assert not excluded('?.log', 'ab.log')
+
+
+def test_double_star_crosses_segments():
+    assert excluded('/build/**', 'build/a')
+    assert excluded('/build/**', 'build/a/b/c')
+    assert not excluded('/build/**', 'src/build/a')
+    assert excluded('/a/**/c', 'a/b/x/c')
+    assert not excluded('/a/*/c', 'a/b/x/c')
+
+
+def test_trailing_slash_only_matches_directories():
+    assert excluded('cache/', 'cache', is_dir=True)
+    assert excluded('cache/', 'x/cache', is_dir=True)
+    assert not excluded('cache/', 'cache')
+    # As for rclone a rule without the slash only excludes files of that name
+    assert not excluded('node_modules', 'node_modules', is_dir=True)
+    assert excluded('node_modules', 'node_modules')
+
+
+def test_braces_are_alternatives():
+    assert excluded('*.{jpg,png}', 'x.jpg')
+    assert excluded('*.{jpg,png}', 'a/x.png')
+    assert not excluded('*.{jpg,png}', 'x.gif')
+    assert not excluded('*.{jpg,png}', 'x.{jpg,png}')
+
+
+def test_classes_and_raw_regexes():
+    assert excluded('[ab].txt', 'a.txt')
+    assert not excluded('[ab].txt', 'c.txt')
+    assert excluded('{{[0-9]+}}.bak', '123.bak')
+    assert not excluded('{{[0-9]+}}.bak', 'x.bak')
+
+
+def test_escapes_are_literal():
+    assert excluded('\\*.txt', '*.txt')
+    assert not excluded('\\*.txt', 'a.txt')
+    assert excluded('a\\{b\\}', 'a{b}')
+    assert excluded('a.b', 'a.b')
+    assert not excluded('a.b', 'axb')
+
+
+@pytest.mark.parametrize('pattern', ['[ab', 'a]', '{a,b', 'a}', '{a,{b}}', '***', 'a\\', '{{a'])
+def test_bad_patterns_raise(pattern):
+    with pytest.raises(ConfigError):
+        glob_to_regex(pattern)
+
+
+def test_no_rules_exclude_nothing():
+    rules = compile_rules([])
+    assert not rules
+    assert not rules.excluded('anything')
+    assert not rules.excluded('anything', is_dir=True)
+
+
+def test_rules_are_shared_and_merged():
+    assert compile_rules(['a', 'b']) is compile_rules(['a', 'b'])
+    assert compile_rules(['a', 'a']).patterns == ('a',)
+    merged = compile_rules(['a']).merge(['/b/**'])
+    assert merged.patterns == ('a', '/b/**')
+    assert merged.excluded('b/c')
+
+
+def test_write_and_load_round_trip():
+    import os
+    rules = compile_rules(['#tag', ';semi', '*.tmp'])
+    path = rules.write()
+    try:
+        assert load(path) == ['\\#tag', '\\;semi', '*.tmp']
+        assert compile_rules(load(path)).excluded('#tag')
+    finally:
+        os.remove(path)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from macrup import backup
+from macrup.backup import Directory
+from macrup.error import ConfigError
+from macrup.hashcache import HashCache
+
+
+def stat(tmpdir, name, content):
+    path = tmpdir.join(name)
+    path.write_binary(content)
+    return str(path), os.stat(str(path))
+
+
+def test_hashes_are_trusted_while_the_file_is_unchanged(tmpdir):
+    cache = HashCache(str(tmpdir.join('hashes')))
+    path, st = stat(tmpdir, 'a', b'one')
+    assert cache.get(path, st) is None
+    cache.put(path, st, 'digest')
+    assert cache.get(path, st) == 'digest'
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert cache.get(path, os.stat(path)) is None
+
+
+def test_the_least_recently_used_go_first(tmpdir):
+    cache = HashCache(str(tmpdir.join('hashes')), max_entries=2)
+    files = [stat(tmpdir, name, name.encode()) for name in 'abc']
+    cache.put(*files[0], 'a')
+    cache.put(*files[1], 'b')
+    assert cache.get(*files[0]) == 'a'
+    cache.put(*files[2], 'c')
+    assert [cache.get(*f) for f in files] == ['a', None, 'c']
+
+
+def test_saved_and_loaded(tmpdir):
+    path, st = stat(tmpdir, 'a', b'one')
+    cache = HashCache(str(tmpdir.join('cache', 'hashes')))
+    cache.put(path, st, 'digest')
+    cache.save()
+    assert HashCache(str(tmpdir.join('cache', 'hashes'))).get(path, st) == 'digest'
+
+
+def test_an_unreadable_cache_starts_empty(tmpdir):
+    tmpdir.join('hashes').write('not json')
+    path, st = stat(tmpdir, 'a', b'one')
+    assert HashCache(str(tmpdir.join('hashes'))).get(path, st) is None
+
+
+@pytest.mark.parametrize('mode, baseline, full, needed', [
+    ('auto', True, False, False),
+    ('auto', False, False, True),
+    ('auto', True, True, True),
+    ('always', True, False, True),
+    ('never', False, True, False),
+])
+def test_checksum_needed(monkeypatch, mode, baseline, full, needed):
+    monkeypatch.setattr(backup, 'config', backup.config._replace(checksum=mode))
+    assert Directory.checksum_needed(None, baseline, full) is needed
+
+
+def test_unknown_checksum_modes_are_refused(monkeypatch):
+    monkeypatch.setattr(backup, 'config', backup.config._replace(checksum='sometimes'))
+    with pytest.raises(ConfigError):
+        Directory.checksum_needed(None, True)
@@ -0,0 +1,79 @@
+import os
+
+from macrup.manifest import Manifest
+
+
+def write(root, rel, content):
+    path = os.path.join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def touch(root, rel, seconds=1000):
+    st = os.stat(os.path.join(root, rel))
+    os.utime(os.path.join(root, rel), ns=(st.st_atime_ns, st.st_mtime_ns + seconds * 10 ** 9))
+
+
+def make(tmpdir, files, **kwargs):
+    root = str(tmpdir.mkdir('tree'))
+    for rel, content in files.items():
+        write(root, rel, content)
+    return root, Manifest(str(tmpdir.join('state', 'manifest.json')), root, **kwargs)
+
+
+def test_without_a_baseline_everything_is_added(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1', 'b/c': '2'})
+    assert not manifest.exists
+    changes = manifest.diff()
+    assert changes == (['a', 'b/c'], [], [])
+    assert len(changes) == 2
+
+
+def test_commit_makes_the_scan_the_baseline(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1', 'b/c': '2'})
+    manifest.diff()
+    manifest.commit()
+    assert manifest.exists
+    assert not manifest.diff()
+    # A fresh instance reads the committed manifest back
+    assert not Manifest(manifest.path, root).diff()
+
+
+def test_added_modified_and_deleted(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1', 'b/c': '2', 'd': '3'})
+    manifest.commit()
+    write(root, 'new', 'x')
+    write(root, 'b/c', 'changed')
+    os.remove(os.path.join(root, 'd'))
+    assert manifest.diff() == (['new'], ['b/c'], ['d'])
+
+
+def test_touched_files_are_modified_without_hashing(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1'})
+    manifest.commit()
+    touch(root, 'a')
+    assert manifest.diff().modified == ['a']
+
+
+def test_touched_files_keep_their_hash(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1', 'b': '2'}, hash_content=True)
+    manifest.commit()
+    touch(root, 'a')
+    write(root, 'b', '3')
+    touch(root, 'b')
+    assert manifest.diff() == ([], ['b'], [])
+    assert manifest.current['a'].hash == manifest.entries['a'].hash
+
+
+def test_excluded_files_are_left_out(tmpdir):
+    root, manifest = make(tmpdir, {'a.log': '1', 'keep': '2', 'cache/x': '3'}, excludes=['*.log', 'cache/'])
+    assert manifest.diff().added == ['keep']
+
+
+def test_unreadable_manifest_is_empty(tmpdir):
+    root, manifest = make(tmpdir, {'a': '1'})
+    manifest.commit()
+    with open(manifest.path, 'w') as f:
+        f.write('not json')
+    assert Manifest(manifest.path, root).diff().added == ['a']
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+
+from macrup import pack
+
+OPTIONS = dict(size=100, file_max=50, live=0.5, transfers=2)
+
+
+def push(directory, options=OPTIONS, full=False):
+    engine = pack.PackEngine(directory, options)
+    changes = directory.manifest.diff()
+    result = asyncio.run(engine.push_async(changes, full=full))
+    if result and not directory._dry_run:
+        directory.manifest.commit()
+    return result
+
+
+def pull(directory, options=OPTIONS, files=None):
+    return asyncio.run(pack.PackEngine(directory, options).pull_async(files=files))
+
+
+def index(directory):
+    with open(os.path.join(directory.remote_root, directory.bucket, pack.INDEX)) as f:
+        return json.load(f)
+
+
+def packs(directory):
+    return [name for name in directory.objects() if name.startswith('packs/')]
+
+
+def test_round_trip(directory):
+    for i in range(10):
+        directory.write('small/%s' % i, str(i).encode() * 20)
+    directory.write('large', b'L' * 200)
+    assert push(directory)
+    assert len(packs(directory)) == 2
+    assert 'files/large' in directory.objects()
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == directory.tree()
+    assert os.stat(os.path.join(restored.name, 'small/3')).st_mtime_ns == \
+        os.stat(os.path.join(directory.name, 'small/3')).st_mtime_ns
+
+
+def test_single_files_are_read_from_their_pack(directory):
+    for i in range(4):
+        directory.write('f%s' % i, str(i).encode() * 10)
+    assert push(directory)
+    restored = directory.elsewhere('restored')
+    assert pull(restored, files=['f2'])
+    assert restored.tree() == {'f2': b'2' * 10}
+
+
+def test_unknown_files_fail_the_restore(directory):
+    directory.write('a', b'a' * 10)
+    assert push(directory)
+    restored = directory.elsewhere('restored')
+    assert not pull(restored, files=['a', 'nope'])
+    assert restored.tree() == {'a': b'a' * 10}
+
+
+def test_a_file_that_shrank_is_restored_without_padding(directory):
+    directory.write('a', b'a' * 30)
+    directory.write('b', b'b' * 10)
+    changes = directory.manifest.diff()
+    # Shrinks between the scan and the push, its slot keeps the scanned size
+    directory.write('a', b'short')
+    assert asyncio.run(pack.PackEngine(directory, OPTIONS).push_async(changes))
+    entry = index(directory)['files']['a']
+    assert entry[0] == 30 and entry[4] == 5
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'a': b'short', 'b': b'b' * 10}
+
+
+def test_changes_repack_mostly_dead_packs(directory):
+    for i in range(4):
+        directory.write('f%s' % i, str(i).encode() * 25)
+    assert push(directory)
+    first = packs(directory)
+    assert len(first) == 1
+    for i in range(3):
+        os.remove(os.path.join(directory.name, 'f%s' % i))
+    assert push(directory)
+    # Only a quarter of the old pack was live, its last file moved to a new pack
+    assert len(packs(directory)) == 1 and packs(directory) != first
+    restored = directory.elsewhere('restored')
+    assert pull(restored)
+    assert restored.tree() == {'f3': b'3' * 25}
+
+
+def test_dry_run_stores_nothing(directory):
+    directory.write('a', b'a' * 10)
+    directory.write('large', b'L' * 200)
+    dry = directory.elsewhere('tree', dry_run=True)
+    assert push(dry)
+    assert not os.path.exists(os.path.join(directory.remote_root, directory.bucket))
+    assert pack.PackEngine(dry, OPTIONS).load_index() is None
+
+
+def test_no_index_no_restore(directory):
+    os.makedirs(os.path.join(directory.remote_root, directory.bucket, '.macrup'))
+    with open(os.path.join(directory.remote_root, directory.bucket, pack.INDEX), 'w') as f:
+        f.write('not json')
+    restored = directory.elsewhere('restored')
+    assert not pull(restored)
+    assert restored.tree() == {}
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+from macrup.plan import schedule
+
+
+def plan(bytes, speed=None):
+    return SimpleNamespace(bytes=bytes, speed=speed, guessed=False, eta=None)
+
+
+def test_one_worker_runs_them_one_after_another():
+    plans = [plan(100, 10), plan(300, 10), plan(0, 10)]
+    assert schedule(plans, workers=1) == pytest.approx(40)
+    assert [p.eta for p in plans] == [10, 30, 0]
+
+
+def test_workers_take_the_next_directory_as_they_free_up():
+    plans = [plan(300, 10), plan(100, 10), plan(100, 10), plan(100, 10)]
+    # The first worker is busy with the 30s directory while the second does the other three
+    assert schedule(plans, workers=2) == pytest.approx(30)
+    assert schedule(plans, workers=4) == pytest.approx(30)
+    assert schedule([plan(100, 10), plan(100, 10), plan(300, 10)], workers=2) == pytest.approx(40)
+
+
+def test_directories_without_a_speed_borrow_the_average():
+    plans = [plan(100, 10), plan(100, 30), plan(200)]
+    assert schedule(plans) == pytest.approx(10 + 100 / 30 + 10)
+    assert [p.guessed for p in plans] == [False, False, True]
+
+
+def test_nothing_to_send_is_not_a_guess():
+    plans = [plan(0), plan(100, 10)]
+    schedule(plans)
+    assert plans[0].eta == 0
+    assert not plans[0].guessed
+
+
+def test_unknown_without_any_speed():
+    plans = [plan(100), plan(200)]
+    assert schedule(plans, workers=2) is None
+    assert [p.eta for p in plans] == [None, None]
+
+
+def test_limit_caps_each_directory_and_the_total():
+    plans = [plan(100, 50), plan(100, 50)]
+    # Each alone would take 10s at the limit, but both share it
+    assert schedule(plans, workers=2, limit=10) == pytest.approx(20)
+    assert [p.eta for p in plans] == [10, 10]
+    assert schedule([plan(100, 5)], limit=10) == pytest.approx(20)
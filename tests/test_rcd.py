@@ -0,0 +1,70 @@
+from macrup.rcd import _split, _with_backend, translate
+
+
+def test_with_backend_adds_a_connection_string():
+    assert _with_backend('b2:bucket/dir', {'chunk_size': '96M'}) == 'b2,chunk_size=96M:bucket/dir'
+    assert _with_backend('b2:bucket', {'upload_cutoff': '200M', 'chunk_size': '96M'}) == \
+        'b2,chunk_size=96M,upload_cutoff=200M:bucket'
+
+
+def test_with_backend_leaves_local_paths_alone():
+    assert _with_backend('/home/me/docs', {'chunk_size': '96M'}) == '/home/me/docs'
+    assert _with_backend('relative/dir', {'chunk_size': '96M'}) == 'relative/dir'
+    assert _with_backend('b2:bucket', {}) == 'b2:bucket'
+
+
+def test_split_remote_paths():
+    assert _split('b2:bucket/dir/name') == ('b2:bucket/dir', 'name')
+    assert _split('b2:name') == ('b2:', 'name')
+
+
+def test_split_local_paths():
+    assert _split('/tmp/x/name') == ('/tmp/x', 'name')
+    assert _split('/name') == ('/', 'name')
+    assert _split('name') == ('.', 'name')
+
+
+def test_translate_sync():
+    method, params = translate(['-v', '--use-json-log', '--stats', '30s', 'sync', '/src', 'b2:bucket',
+                                '--transfers', '8', '--fast-list', '--exclude-from', '/tmp/ex'])
+    assert method == 'sync/sync'
+    assert params == {
+        'srcFs': '/src',
+        'dstFs': 'b2:bucket',
+        '_config': {'Transfers': 8, 'UseListR': True},
+        '_filter': {'ExcludeFrom': ['/tmp/ex']},
+    }
+
+
+def test_translate_repeated_filters_and_backend_options():
+    method, params = translate(['copy', 'b2:bucket', '/dest', '--exclude', 'a', '--exclude', 'b',
+                                '--b2-chunk-size', '96M', '--backup-dir', 'b2:bucket/.snapshots/x'])
+    assert method == 'sync/copy'
+    assert params['srcFs'] == 'b2,chunk_size=96M:bucket'
+    assert params['dstFs'] == '/dest'
+    assert params['_filter'] == {'ExcludeRule': ['a', 'b']}
+    # A backup dir only gets a server side move if it is on the same remote as the destination
+    assert params['_config'] == {'BackupDir': 'b2,chunk_size=96M:bucket/.snapshots/x'}
+
+
+def test_translate_copyto_names_the_file():
+    method, params = translate(['copyto', '/tmp/list.lst', 'b2:bucket/.macrup/generations/x.lst'])
+    assert method == 'operations/copyfile'
+    assert params == {
+        'srcFs': '/tmp',
+        'srcRemote': 'list.lst',
+        'dstFs': 'b2:bucket/.macrup/generations',
+        'dstRemote': 'x.lst',
+    }
+
+
+def test_translate_gives_up_on_what_rc_cant_express():
+    assert translate(['sync', '/src', 'b2:bucket', '--max-age', '1d']) is None
+    assert translate(['delete', 'b2:bucket']) is None
+    assert translate(['rcat', 'b2:bucket/x']) is None
+    assert translate(['sync', '/src']) is None
+
+
+def test_a_bwlimit_of_its_own_needs_a_forked_rclone():
+    # The rcd has one limit for all its jobs, a per directory one can't be honoured there
+    assert translate(['sync', '/src', 'b2:bucket', '--bwlimit', '1M']) is None
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from macrup.retry import RetryPolicy, retryable
+from macrup.stats import SyncResult
+
+
+def test_delay_doubles_from_the_backoff():
+    policy = RetryPolicy(attempts=5, backoff='30s', max_backoff='10m', jitter=0)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [30, 60, 120, 240, 480]
+
+
+def test_delay_is_capped():
+    policy = RetryPolicy(backoff='30s', max_backoff='1m', jitter=0)
+    assert policy.delay(3) == 60
+    assert policy.delay(50) == 60
+
+
+def test_jitter_only_shortens_the_delay():
+    policy = RetryPolicy(backoff='40s', max_backoff='10m', jitter=0.5)
+    for _ in range(100):
+        assert 20 <= policy.delay(1) <= 40
+        assert 40 <= policy.delay(2) <= 80
+
+
+def test_at_least_one_attempt():
+    assert RetryPolicy(attempts=0).attempts == 1
+
+
+def test_only_transient_failures_are_retried():
+    assert retryable(SyncResult(False, rc=5))
+    assert retryable(SyncResult(False, rc=2))
+    assert not retryable(SyncResult(False, rc=7))
+    assert not retryable(SyncResult(False, rc=4))
+    assert not retryable(SyncResult(False, rc=None))
+
+
+@pytest.mark.parametrize('rc, runs', [(5, 3), (7, 1)])
+def test_run_stops_on_success_or_a_fatal_error(rc, runs):
+    policy = RetryPolicy(attempts=3, backoff='0s', jitter=0)
+    calls = []
+
+    async def sync():
+        calls.append(1)
+        return SyncResult(False, rc=rc)
+
+    result = asyncio.run(policy.run('test', sync))
+    assert not result
+    assert result.attempts == runs
+    assert len(calls) == runs
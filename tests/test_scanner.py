@@ -0,0 +1,39 @@
+import os
+
+from macrup.scanner import Scanner, scan
+
+
+def tree(tmpdir, paths):
+    for rel in paths:
+        tmpdir.join(rel).write_binary(b'x' * len(rel), ensure=True)
+    return str(tmpdir)
+
+
+def test_every_file_is_found_once(tmpdir):
+    paths = ['a', 'b/c', 'b/d/e', 'b/d/f', 'g/h']
+    root = tree(tmpdir, paths)
+    found = list(Scanner(root, workers=3).scan())
+    assert sorted(rel for rel, _ in found) == paths
+    assert all(st.st_size == len(rel) for rel, st in found)
+
+
+def test_totals(tmpdir):
+    root = tree(tmpdir, ['a', 'b/c', 'b/skip.tmp', 'cache/x', 'cache/y'])
+    os.symlink('a', os.path.join(root, 'link'))
+    totals = scan(root, ['*.tmp', 'cache/'], workers=2)
+    # Symlinks aren't followed or counted, an excluded directory is never listed
+    assert (totals.files, totals.bytes, totals.dirs, totals.excluded, totals.errors) == (2, 4, 2, 2, 0)
+    assert totals.as_dict()['root'] == root
+
+
+def test_a_missing_root_is_an_error(tmpdir):
+    totals = scan(str(tmpdir.join('nope')))
+    assert (totals.files, totals.errors) == (0, 1)
+
+
+def test_stopping_early(tmpdir):
+    root = tree(tmpdir, ['d%s/f%s' % (i, j) for i in range(5) for j in range(5)])
+    scanner = Scanner(root, workers=2)
+    for _ in scanner.scan():
+        break
+    assert scanner.totals.files < 25
@@ -0,0 +1,50 @@
+import asyncio
+
+from macrup.scheduler import Scheduler, prioritize
+
+
+class FakeDirectory:
+    def __init__(self, name, bucket=None, fail=False, running=None):
+        self.name = name
+        self.bucket = bucket or 'pfx-%s' % name
+        self.fail = fail
+        self.running = running
+
+    def __repr__(self):
+        return self.name
+
+    async def push_async(self, **kwargs):
+        self.running['now'] += 1
+        self.running['most'] = max(self.running['most'], self.running['now'])
+        await asyncio.sleep(0.01)
+        self.running['now'] -= 1
+        if self.fail:
+            raise RuntimeError('broken')
+        return kwargs.get('full', True)
+
+
+def test_at_most_workers_run_at_once():
+    running = dict(now=0, most=0)
+    directories = [FakeDirectory(str(i), running=running) for i in range(6)]
+    done = []
+    results = Scheduler(2).push(directories, on_done=lambda d, r: done.append(d), full=True)
+    assert running['most'] == 2
+    assert results == [(d, True) for d in directories]
+    assert sorted(done, key=directories.index) == directories
+
+
+def test_an_error_fails_only_its_directory():
+    running = dict(now=0, most=0)
+    broken, fine = FakeDirectory('broken', fail=True, running=running), FakeDirectory('fine', running=running)
+
+    def on_done(directory, result):
+        raise ValueError('ignored')
+
+    assert Scheduler(2).push([broken, fine], on_done=on_done) == [(broken, False), (fine, True)]
+
+
+def test_prioritize():
+    a, b, c = FakeDirectory('a'), FakeDirectory('b'), FakeDirectory('c')
+    assert prioritize([a, b, c], ['c', 'pfx-b']) == [c, b, a]
+    sizes = {a: dict(bytes=30), b: None, c: dict(bytes=10)}
+    assert prioritize([a, b, c], sizes=sizes) == [c, a, b]
@@ -0,0 +1,137 @@
+import asyncio
+
+from macrup.snapshot import GENERATIONS, SNAPSHOTS, Retention, Snapshots
+from macrup.stats import SyncResult
+
+
+class FakeDirectory:
+    '''Just enough of a Directory for Snapshots, recording the rclone commands it would run'''
+    name = '/home/me/docs'
+    bucket = 'pfx-docs'
+    _remote = 'b2'
+
+    def __init__(self, labels, generations, listing=()):
+        self.labels = list(labels)
+        self.generations = set(generations)
+        self.listing = list(listing)
+        # Paths whose listing fails, as if B2 was unreachable
+        self.unlistable = set()
+        self.commands = []
+        self.syncs = []
+
+    async def _lsf_async(self, path, extra='', missing_ok=False):
+        if any(path.endswith(name) for name in self.unlistable):
+            return None
+        if path.endswith(GENERATIONS):
+            return ['%s.lst' % text for text in self.labels]
+        return ['%s/' % text for text in self.generations]
+
+    async def _command_async(self, command, *paths, extra=''):
+        self.commands.append((command,) + paths + ((extra,) if extra else ()))
+        return 0
+
+    async def _sync_async(self, src, dest, files=None, tuning=None, command='sync', **kwargs):
+        if command == 'copyto':
+            with open(dest, 'w') as list_file:
+                list_file.write(''.join(path + '\n' for path in self.listing))
+        else:
+            self.syncs.append((src, files))
+        return SyncResult(True)
+
+
+def snapshots_dir(text):
+    return 'pfx-docs/%s/%s' % (SNAPSHOTS, text)
+
+
+def test_retention_keeps_the_newest_per_period():
+    labels = ['20200101T100000', '20200101T110000', '20200102T090000', '20200102T180000', '20200103T080000']
+    assert Retention(daily=2).keep(labels) == {'20200103T080000', '20200102T180000'}
+    assert Retention(hourly=3).keep(labels) == {'20200103T080000', '20200102T180000', '20200102T090000'}
+    assert Retention(daily=10).keep(labels) == {'20200103T080000', '20200102T180000', '20200101T110000'}
+
+
+def test_retention_always_keeps_the_newest():
+    labels = ['20200101T100000', '20200102T100000']
+    assert Retention().keep(labels) == {'20200102T100000'}
+    assert Retention(weekly=5).keep([]) == set()
+
+
+def test_retention_weeks_are_iso_weeks():
+    # Sunday and the Monday after fall in different ISO weeks
+    labels = ['20200105T100000', '20200106T100000', '20200107T100000']
+    assert Retention(weekly=2).keep(labels) == {'20200107T100000', '20200105T100000'}
+
+
+def test_deleting_merges_into_the_next_older_generation():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000', '20200103T000000'],
+                              ['20200101T000000', '20200102T000000'])
+    result = asyncio.run(Snapshots(directory).delete(['20200102T000000']))
+    assert result
+    assert directory.commands == [
+        ('move', snapshots_dir('20200102T000000'), snapshots_dir('20200101T000000'), '--ignore-existing'),
+        ('purge', snapshots_dir('20200102T000000')),
+        ('deletefile', 'pfx-docs/%s/20200102T000000.lst' % GENERATIONS),
+    ]
+
+
+def test_deleting_several_merges_newest_first():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000', '20200103T000000', '20200104T000000'],
+                              ['20200102T000000', '20200103T000000'])
+    assert asyncio.run(Snapshots(directory).delete(['20200102T000000', '20200103T000000']))
+    moves = [command[1:3] for command in directory.commands if command[0] == 'move']
+    # What 03 held ends up in 02 first, then both go down to 01
+    assert moves == [
+        (snapshots_dir('20200103T000000'), snapshots_dir('20200102T000000')),
+        (snapshots_dir('20200102T000000'), snapshots_dir('20200101T000000')),
+    ]
+
+
+def test_deleting_the_oldest_drops_its_files():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000'], ['20200101T000000'])
+    assert asyncio.run(Snapshots(directory).delete(['20200101T000000']))
+    assert [command[0] for command in directory.commands] == ['purge', 'deletefile']
+
+
+def test_deleting_the_newest_is_refused():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000'], ['20200101T000000'])
+    assert not asyncio.run(Snapshots(directory).delete(['20200102T000000']))
+    assert directory.commands == []
+
+
+def test_restore_overlays_generations_newest_first():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000', '20200103T000000'],
+                              ['20200101T000000', '20200102T000000'], listing=['a', 'b/c'])
+    assert asyncio.run(Snapshots(directory).restore('20200102T000000'))
+    # The current tree, then every generation from the newest down to the snapshot, the last copy wins
+    assert directory.syncs == [
+        ('b2:pfx-docs', ['a', 'b/c']),
+        ('b2:%s' % snapshots_dir('20200102T000000'), ['a', 'b/c']),
+    ]
+
+
+def test_restore_latest_and_missing_files():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000'], ['20200101T000000'], listing=['a', 'b'])
+    result = asyncio.run(Snapshots(directory).restore('latest', files=['b', 'nope']))
+    assert not result
+    assert directory.syncs == [('b2:pfx-docs', ['b'])]
+
+
+def test_backup_dir_is_the_newest_snapshot():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000'], [])
+    assert asyncio.run(Snapshots(directory).backup_flags()) == \
+        "--backup-dir 'b2:%s'" % snapshots_dir('20200102T000000')
+    assert asyncio.run(Snapshots(FakeDirectory([], [])).backup_flags()) == ''
+
+
+def test_no_backup_dir_if_the_snapshots_cant_be_listed():
+    directory = FakeDirectory(['20200101T000000'], [])
+    directory.unlistable.add(GENERATIONS)
+    # Not '', a push without --backup-dir would overwrite what the snapshot holds
+    assert asyncio.run(Snapshots(directory).backup_flags()) is None
+
+
+def test_deleting_needs_a_listing_of_the_generations():
+    directory = FakeDirectory(['20200101T000000', '20200102T000000', '20200103T000000'], ['20200102T000000'])
+    directory.unlistable.add(SNAPSHOTS)
+    assert not asyncio.run(Snapshots(directory).delete(['20200102T000000']))
+    assert directory.commands == []
@@ -0,0 +1,60 @@
+from datetime import datetime
+from pathlib import PosixPath
+
+import pytest
+
+from macrup.error import ConfigError
+from macrup.state import SQLiteStore, YAMLStore, open_store
+from macrup.stats import SyncResult
+
+SYNCED = datetime(2020, 1, 2, 3, 4, 5)
+
+
+def record(path, bucket='pfx-docs', synced=SYNCED, failures=0):
+    return dict(path=PosixPath(path), bucket=bucket, synced=synced, full_synced=None, failures=failures)
+
+
+def run(store, command='backup', *results):
+    store.record_run(command, datetime(2020, 1, 1), datetime(2020, 1, 1, 0, 1), list(results))
+
+
+def test_yaml_state_is_migrated_once(tmp_path):
+    yaml_path = str(tmp_path / 'state')
+    YAMLStore(yaml_path).save([record('/home/me/docs'), record('/home/me/pics', 'pfx-pics', failures=2)])
+    store = SQLiteStore(str(tmp_path / 'state.db'), migrate_from=yaml_path)
+    assert store.load() == [record('/home/me/docs'), record('/home/me/pics', 'pfx-pics', failures=2)]
+    store.update(record('/home/me/docs', synced=datetime(2021, 1, 1)))
+    store.close()
+    # Reopening doesn't import the YAML again over what was saved since
+    store = SQLiteStore(str(tmp_path / 'state.db'), migrate_from=yaml_path)
+    assert store.load()[0]['synced'] == datetime(2021, 1, 1)
+
+
+def test_updates_leave_other_records_alone(tmp_path):
+    for store in (YAMLStore(str(tmp_path / 'state')), SQLiteStore(str(tmp_path / 'state.db'))):
+        store.save([record('/a'), record('/b')])
+        store.update_many([record('/b', failures=1), record('/c')])
+        assert [(r['path'].as_posix(), r['failures']) for r in store.load()] == [('/a', 0), ('/b', 1), ('/c', 0)]
+
+
+def test_runs_are_recorded(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'state.db'))
+    run(store, 'backup', (record('/a'), SyncResult(True, duration=2.0)), (record('/b'), SyncResult(False)),
+        (record('/c'), SyncResult(True, skipped=True)), (record('/d'), None))
+    [last] = store.history()
+    assert (last['command'], last['synced'], last['failed'], last['skipped']) == ('backup', 1, 1, 1)
+    assert [r['duration'] for r in store.directory_history('/a')] == [2.0]
+    assert store.directory_history('/a', command='restore') == []
+
+
+def test_only_the_last_runs_are_kept(tmp_path):
+    store = SQLiteStore(str(tmp_path / 'state.db'), runs=3)
+    for i in range(5):
+        run(store, 'backup', (record('/a'), SyncResult(True, duration=float(i))))
+    assert [r['id'] for r in store.history()] == [5, 4, 3]
+    assert [r['duration'] for r in store.directory_history('/a', limit=10)] == [4.0, 3.0, 2.0]
+
+
+def test_unknown_backends_are_refused(tmp_path):
+    with pytest.raises(ConfigError):
+        open_store('json', str(tmp_path / 'state'), str(tmp_path / 'state.db'))
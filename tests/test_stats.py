@@ -0,0 +1,38 @@
+import json
+
+from macrup.stats import SyncResult, TransferStats
+
+
+def line(**record):
+    return json.dumps(record)
+
+
+def test_stats_blocks_update_the_totals():
+    stats = TransferStats('docs')
+    stats.feed(line(level='info', msg='Transferred', stats=dict(bytes=10, totalBytes=100, transfers=1, speed=5.0)))
+    stats.feed(line(level='info', msg='Transferred', stats=dict(bytes=100, totalBytes=100, transfers=3,
+                                                              checks=7, errors=1, lastError='boom')))
+    assert (stats.bytes, stats.total_bytes, stats.transfers, stats.checks, stats.errors) == (100, 100, 3, 7, 1)
+    # Missing keys keep their last value
+    assert stats.speed == 5.0
+    assert stats.last_error == 'boom'
+
+
+def test_retries_are_counted():
+    stats = TransferStats('docs')
+    stats.feed(line(level='error', msg='Attempt 1/3 failed with 2 errors and: boom'))
+    stats.feed(line(level='error', msg='Attempt 2/3 failed with 1 errors and: boom'))
+    assert stats.retries == 2
+
+
+def test_other_output_is_ignored():
+    stats = TransferStats('docs')
+    for text in ('', '   ', 'not json', '[1, 2]', line(level='notice', msg='Serving')):
+        stats.feed(text)
+    assert stats.as_dict() == TransferStats('other').as_dict()
+
+
+def test_sync_result():
+    assert SyncResult(True) and not SyncResult(False)
+    assert SyncResult(True, stats=TransferStats('docs')).as_dict()['stats']['bytes'] == 0
+    assert SyncResult(False, rc=5).as_dict() == dict(ok=False, rc=5, skipped=False, duration=0.0, attempts=1, stats=None)